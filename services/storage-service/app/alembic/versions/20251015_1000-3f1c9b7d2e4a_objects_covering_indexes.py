@@ -0,0 +1,43 @@
+"""objects covering indexes
+
+Revision ID: 3f1c9b7d2e4a
+Revises: 6dc45c27a477
+Create Date: 2025-10-15 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9b7d2e4a'
+down_revision: Union[str, None] = '6dc45c27a477'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY and VACUUM cannot run inside the migration transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_objects_user_covering', 'objects', ['user_id'],
+            postgresql_include=['file_size', 'storage_tier', 'storage_type'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            'ix_objects_folder', 'objects', ['folder_id'],
+            postgresql_include=['file_size'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Refresh the visibility map so the planner can pick Index Only Scans
+        op.execute("VACUUM ANALYZE objects")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_objects_folder', table_name='objects', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_objects_user_covering', table_name='objects', postgresql_concurrently=True, if_exists=True)
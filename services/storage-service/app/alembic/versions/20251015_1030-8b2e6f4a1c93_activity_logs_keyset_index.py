@@ -0,0 +1,33 @@
+"""activity_logs keyset index
+
+Revision ID: 8b2e6f4a1c93
+Revises: 3f1c9b7d2e4a
+Create Date: 2025-10-15 10:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b2e6f4a1c93'
+down_revision: Union[str, None] = '3f1c9b7d2e4a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_activity_logs_user_created', 'activity_logs',
+            ['user_id', sa.text('created_at DESC'), sa.text('id DESC')],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_activity_logs_user_created', table_name='activity_logs', postgresql_concurrently=True, if_exists=True)
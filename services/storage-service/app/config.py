@@ -35,6 +35,9 @@ class Settings:
     CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", 67108864))  # Default 64MB
     MAX_FILE_SIZE: int = int(os.getenv("MAX_FILE_SIZE", 21474836480))  # Default 20GB
     COMPRESSION_LEVEL: int = int(os.getenv("COMPRESSION_LEVEL", 3))
+    COMPRESSION_THREADS: int = int(os.getenv("COMPRESSION_THREADS", -1))  # -1 = all cores
+    COMPRESSION_LONG_WINDOW_LOG: int = int(os.getenv("COMPRESSION_LONG_WINDOW_LOG", 27))  # 128MB long-range window for single objects
+    ZSTD_DICT_PATH: str = os.getenv("ZSTD_DICT_PATH", "")  # optional trained dictionary
     
     # Storage Thresholds
     INLINE_THRESHOLD: int = 1 * 1024 * 1024  # 1MB - store in Redis
@@ -42,6 +45,7 @@ class Settings:
     
     # Backup Configuration
     BACKUP_ENABLED: bool = os.getenv("BACKUP_ENABLED", "true").lower() == "true"
+    BACKUP_S3_ENABLED: bool = os.getenv("BACKUP_S3_ENABLED", "false").lower() == "true"
     BACKUP_S3_BUCKET: str = os.getenv("BACKUP_S3_BUCKET", "edge-cloud-backup")
     BACKUP_NODE_URL: str = os.getenv("BACKUP_NODE_URL", "")
     AWS_ACCESS_KEY: Optional[str] = os.getenv("AWS_ACCESS_KEY")
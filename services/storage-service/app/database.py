@@ -2,10 +2,19 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine,async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 import redis.asyncio as redis
+import orjson
 from .config import settings
 
-# Database Engine
-engine = create_async_engine(settings.DATABASE_URL, echo=False)
+def _json_serializer(value) -> str:
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
+# Database Engine (JSON/JSONB columns go through orjson instead of stdlib json)
+engine = create_async_engine(
+    settings.DATABASE_URL,
+    echo=False,
+    json_serializer=_json_serializer,
+    json_deserializer=orjson.loads,
+)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
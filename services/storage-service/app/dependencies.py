@@ -3,11 +3,11 @@ from typing import AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Request, Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError
-from sqlalchemy import select
+import jwt
 from .database import AsyncSessionLocal
-from .models.database import User, ActivityLog
-from .config import settings
+from .models.database import User
+from .services.auth import user_id_from_token, USER_BY_ID
+from .services.activity import activity_service
 
 # Security
 security = HTTPBearer()
@@ -25,14 +25,13 @@ async def get_current_user(
     token = credentials.credentials
     
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        user_id = payload.get("sub")
+        user_id = user_id_from_token(token)
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
+    except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    result = await db.execute(select(User).filter(User.id == user_id))
+    result = await db.execute(USER_BY_ID, {"user_id": user_id})
     user = result.scalar_one_or_none()
     
     if user is None:
@@ -54,22 +53,12 @@ async def get_current_user_ws(token: str):
             return None
         return user
 
-async def log_activity(
-    db: AsyncSession,
+def log_activity(
     user_id: str,
     action: str,
     object_id: str = None,
     metadata: dict = None,
     request: Request = None,
 ):
-    """Log user activity"""
-    activity = ActivityLog(
-        user_id=user_id,
-        action=action,
-        object_id=object_id,
-        ip_address=request.client.host if request else None,
-        user_agent=request.headers.get("user-agent") if request else None,
-        meta_data=metadata,
-    )
-    db.add(activity)
-    await db.commit()
\ No newline at end of file
+    """Log user activity (queued; written in batches by activity_service)"""
+    activity_service.log_activity(user_id, action, object_id, metadata, request)
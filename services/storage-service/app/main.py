@@ -1,16 +1,23 @@
 # services/storage-service/app/main.py
 import os
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from sqlalchemy import text
 
 from .config import settings
 from .database import init_redis, close_redis, engine, get_redis
 from .monitoring.metrics import metrics_collector
+from .services.access_tracker import access_tracker
+from .services.activity import activity_service
+from .services.backup import backup_service
+from .services.deduplication_enhanced import enhanced_dedup_service
+from .services.encryption import cipher_backend
+from .services.storage import ensure_storage_dirs
 
 # Routers (these already have their own prefixes inside each module)
 from .routers import auth, files, folders, upload, storage, websocket,deduplication
@@ -20,6 +27,8 @@ async def lifespan(app: FastAPI):
     """Manage application lifecycle"""
     # Startup
     print("🚀 Starting Edge Storage Service...")
+    print(f"🔁 Event loop: {type(asyncio.get_running_loop()).__module__}")
+    print(f"🔐 Encryption: {cipher_backend()}")
 
     # Initialize Redis
     try:
@@ -44,11 +53,30 @@ async def lifespan(app: FastAPI):
         print(f"⚠️ Database connection failed: {e}")
         # In prod, you might want to raise here.
 
+    # Background writer for batched last_accessed updates
+    access_flush_task = asyncio.create_task(access_tracker.run())
+    # Background writer for batched activity log inserts
+    activity_flush_task = asyncio.create_task(activity_service.run())
+
     print("✅ Application startup complete")
     yield
 
     # Shutdown
     print("👋 Shutting down Edge Storage Service...")
+    access_flush_task.cancel()
+    # Let a flush in progress unwind before the final one runs
+    await asyncio.gather(access_flush_task, return_exceptions=True)
+    try:
+        await access_tracker.flush()
+    except Exception as e:
+        print(f"⚠️ Final last_accessed flush failed: {e}")
+    activity_flush_task.cancel()
+    await asyncio.gather(activity_flush_task, return_exceptions=True)
+    try:
+        await activity_service.flush()
+    except Exception as e:
+        print(f"⚠️ Final activity log flush failed: {e}")
+    await backup_service.close()
     await close_redis()
     await engine.dispose()
     print("✅ Cleanup complete")
@@ -60,6 +88,7 @@ app = FastAPI(
     version=settings.VERSION,
     description="High-performance distributed storage service with encryption and multi-tier storage",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url="/docs",
     redoc_url="/redoc",
     openapi_url="/openapi.json",
@@ -114,6 +143,13 @@ async def create_storage_directories():
         # Objects directory for single-file storage mode
         os.makedirs(os.path.join(path, "objects"), exist_ok=True)
 
+    # Tier/object shard trees, marked ready so storage writes skip makedirs
+    ensure_storage_dirs()
+    # Upload router's shard tree, so chunk writes never need makedirs
+    upload.ensure_upload_dirs()
+    # CAS shard tree for the enhanced dedup service
+    enhanced_dedup_service.ensure_shard_dirs()
+
 
 # Root endpoint
 @app.get("/", tags=["Root"])
@@ -240,6 +276,8 @@ if __name__ == "__main__":
         "app.main:app",
         host="0.0.0.0",
         port=8001,
+        loop="uvloop",
+        http="httptools",
         timeout_keep_alive=600,
         timeout_graceful_shutdown=60,
         limit_max_requests=None,
@@ -29,7 +29,7 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import select, update, delete, func
 import json
-from jose import jwt
+import jwt
 from passlib.context import CryptContext
 from cryptography.fernet import Fernet
 import secrets
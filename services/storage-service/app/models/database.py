@@ -2,7 +2,7 @@
 
 from sqlalchemy import (
     Column, String, Integer, DateTime, Boolean, 
-    ForeignKey, JSON, BigInteger, Text,UniqueConstraint
+    ForeignKey, JSON, BigInteger, Text,UniqueConstraint, Index
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql import UUID
@@ -61,6 +61,13 @@ class Object(Base):
     version_count = Column(Integer, default=1)
     versioning_enabled = Column(Boolean, default=True)
     dedup_info = Column(JSON, nullable=True)
+    
+    # Covering indexes so per-user / per-folder aggregates are index-only scans
+    __table_args__ = (
+        Index('ix_objects_user_covering', 'user_id',
+              postgresql_include=['file_size', 'storage_tier', 'storage_type']),
+        Index('ix_objects_folder', 'folder_id', postgresql_include=['file_size']),
+    )
 
 class ActivityLog(Base):
     __tablename__ = "activity_logs"
@@ -73,6 +80,11 @@ class ActivityLog(Base):
     user_agent = Column(Text)
     meta_data = Column(JSON)
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Newest-first keyset pagination per user
+    __table_args__ = (
+        Index('ix_activity_logs_user_created', user_id, created_at.desc(), id.desc()),
+    )
 
 class FileVersion(Base):
     __tablename__ = "file_versions"
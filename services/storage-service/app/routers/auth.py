@@ -31,7 +31,7 @@ async def register(
     user = User(
         email=email,
         username=username,
-        password_hash=auth_service.get_password_hash(password),
+        password_hash=await auth_service.get_password_hash(password),
         user_type=user_type,
         storage_quota=settings.QUOTAS.get(user_type, settings.QUOTAS["individual"]),
     )
@@ -44,8 +44,8 @@ async def register(
     await db.commit()
     
     # Log activity
-    await log_activity(
-        db, user.id, "user_registered", 
+    log_activity(
+        user.id, "user_registered", 
         metadata={"user_type": user_type}, 
         request=request
     )
@@ -78,13 +78,13 @@ async def login(
     result = await db.execute(select(User).filter(User.email == email))
     user = result.scalar_one_or_none()
     
-    if not user or not auth_service.verify_password(password, user.password_hash):
+    if not user or not await auth_service.verify_password(password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     if not user.is_active:
         raise HTTPException(status_code=403, detail="Account deactivated")
     
-    await log_activity(db, user.id, "user_login", request=request)
+    log_activity(user.id, "user_login", request=request)
     
     access_token = auth_service.create_access_token({"sub": str(user.id), "email": email})
     
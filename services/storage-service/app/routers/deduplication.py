@@ -149,6 +149,38 @@ async def get_storage_savings(
         "storage_efficiency": round(stats.logical_size / stats.physical_size, 2) if stats.physical_size > 0 else 1
     }
 
+OPTIMIZE_READ_SIZE = 1024 * 1024
+
+
+async def _read_plaintext(path: str, file_key=None):
+    """Yield a single-file object's plaintext in OPTIMIZE_READ_SIZE pieces.
+    Encrypted objects are nonce + ciphertext + tag; the tag is read up front so
+    the ciphertext can be decrypted as it streams, and checked at the end."""
+    from ..services.encryption import encryption_service, NONCE_SIZE, GCM_TAG_SIZE
+    
+    size = os.path.getsize(path)
+    async with aiofiles.open(path, 'rb') as f:
+        decryptor = None
+        remaining = size
+        if file_key is not None:
+            nonce = await f.read(NONCE_SIZE)
+            await f.seek(size - GCM_TAG_SIZE)
+            tag = await f.read(GCM_TAG_SIZE)
+            await f.seek(NONCE_SIZE)
+            decryptor = encryption_service.file_decryptor(file_key, nonce, tag)
+            remaining = size - NONCE_SIZE - GCM_TAG_SIZE
+        while remaining > 0:
+            piece = await f.read(min(OPTIMIZE_READ_SIZE, remaining))
+            if not piece:
+                raise IOError(f"{path} is truncated")
+            remaining -= len(piece)
+            yield decryptor.update(piece) if decryptor else piece
+        if decryptor:
+            # Raises InvalidTag; blocks already written are removed by the caller
+            tail = decryptor.finalize()
+            if tail:
+                yield tail
+
 @router.post("/optimize/{file_id}")
 async def optimize_file_dedup(
     file_id: str,
@@ -182,18 +214,14 @@ async def optimize_file_dedup(
         if not os.path.exists(file_obj.object_path):
             raise HTTPException(404, "File data not found")
         
-        async with aiofiles.open(file_obj.object_path, 'rb') as f:
-            file_data = await f.read()
-        
-        # Decrypt if needed
+        file_key = None
         if file_obj.encryption_key:
             from ..services.encryption import encryption_service
             file_key = encryption_service.decrypt_key(file_obj.encryption_key)
-            file_data = encryption_service.decrypt_file(file_data, file_key)
         
-        # Perform deduplication
-        dedup_result = await enhanced_dedup_service.store_deduplicated_file(
-            file_data=file_data,
+        # Perform deduplication, streaming (and decrypting) the object from disk
+        dedup_result = await enhanced_dedup_service.store_deduplicated_stream(
+            _read_plaintext(file_obj.object_path, file_key),
             file_name=file_obj.file_name,
             user_id=str(current_user.id),
             db=db,
@@ -1,30 +1,41 @@
 # services/storage-service/app/routers/files.py
 
-from fastapi import APIRouter, Depends, HTTPException, Request,Header, Response
+from fastapi import APIRouter, Depends, HTTPException, Request,Header, Response, Query
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, delete
 from typing import List, Optional
 import os
 import json
-from datetime import datetime
 from ..dependencies import get_db, log_activity, get_current_user
-from ..services.storage import storage_service
-from ..services.encryption import encryption_service
+from ..services.storage import storage_service, chunk_path_list
+from ..services.encryption import encryption_service, FileKey
+from ..services.access_tracker import access_tracker
 from ..models.database import User, Object
 from ..models.schemas import FileResponse
 from ..database import get_redis
 from ..config import settings
+from ..utils.compression import decompressor
+from ..utils.encoding import b64decode
+from ..utils.cache import (
+    file_list_key, invalidate_file_list, invalidate_storage_stats, invalidate_object_meta, FILE_LIST_TTL
+)
 from pydantic import BaseModel
+import orjson
 import re
-import base64
-import aiofiles
+import functools
+import asyncio
 from typing import Optional, Tuple, AsyncGenerator
 
-RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)", re.ASCII)
 USE_X_ACCEL = bool(os.environ.get("USE_X_ACCEL", False))
 NGINX_STORAGE_BASE = "/app/storage"  # must match nginx alias path
 
+# Streaming block sizes, picked per file size (see _pick_block)
+SMALL_BLOCK_SIZE = 64 * 1024           # 64KB for files < 1MB
+MEDIUM_BLOCK_SIZE = 1024 * 1024        # 1MB for files < 100MB
+LARGE_BLOCK_SIZE = 4 * 1024 * 1024     # 4MB for larger files
+
 class BulkDeleteRequest(BaseModel):
     file_ids: List[str]
 
@@ -34,58 +45,113 @@ router = APIRouter(prefix="/api/v1/files", tags=["files"])
 @router.get("/", response_model=List[FileResponse])
 async def list_files(
     folder_id: Optional[str] = None,
+    # No default cap: the web frontend lists folders without paginating
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    offset: int = Query(0, ge=0),
     current_user: User = Depends(get_current_user),  # Use get_current_user from dependencies
     db: AsyncSession = Depends(get_db),
 ):
-    """List user's files"""
-    query = select(Object).filter(Object.user_id == current_user.id)
+    """List user's files (paginated when limit is given, pages cached briefly in Redis)"""
+    redis_client = await get_redis()
+    cache_key = file_list_key(current_user.id, folder_id, offset, limit)
+    
+    cached_page = await redis_client.get(cache_key) if redis_client else None
+    if cached_page is not None:
+        return Response(content=cached_page, media_type="application/json")
+    
+    # Only pull the columns the listing needs
+    query = select(
+        Object.id, Object.file_name, Object.file_size, Object.mime_type,
+        Object.folder_id, Object.storage_tier, Object.backup_status,
+        Object.created_at, Object.last_accessed,
+    ).filter(Object.user_id == current_user.id)
     if folder_id:
         query = query.filter(Object.folder_id == folder_id)
     else:
         query = query.filter(Object.folder_id == None)
+    query = query.order_by(Object.created_at, Object.id).offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
     
     result = await db.execute(query)
-    files = result.scalars().all()
-    
-    return [
-        FileResponse(
-            id=str(f.id),
-            name=f.file_name,
-            size=f.file_size,
-            mime_type=f.mime_type,
-            folder_id=str(f.folder_id) if f.folder_id else None,
-            storage_tier=f.storage_tier,
-            backup_status=f.backup_status,
-            created_at=f.created_at,
-            last_accessed=f.last_accessed,
-        )
-        for f in files
-    ]
+    
+    page = orjson.dumps([
+        {
+            "id": str(f.id),
+            "name": f.file_name,
+            "size": f.file_size,
+            "mime_type": f.mime_type,
+            "folder_id": str(f.folder_id) if f.folder_id else None,
+            "storage_tier": f.storage_tier,
+            "backup_status": f.backup_status,
+            "created_at": f.created_at,
+            "last_accessed": f.last_accessed,
+        }
+        for f in result
+    ])
+    
+    if redis_client:
+        await redis_client.setex(cache_key, FILE_LIST_TTL, page)
+    
+    return Response(content=page, media_type="application/json")
 
 ###########Download with Range Support##################################
-async def parse_range_header(range_header: Optional[str], file_size: int) -> Optional[Tuple[int, int]]:
+def _pick_block(file_size: int, storage_tier: Optional[str] = None) -> int:
+    """Pick a streaming block size for a file based on its size and storage tier."""
+    # Cold tier sits on slow sequential media - always use big requests there
+    if storage_tier == "cold" or file_size >= 100 * 1024 * 1024:
+        return LARGE_BLOCK_SIZE
+    if file_size < 1024 * 1024:
+        return SMALL_BLOCK_SIZE
+    return MEDIUM_BLOCK_SIZE
+
+def _fast_range(range_header: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """Fast path for the common "bytes=N-" and "bytes=N-M" shapes; None means use the general parser."""
+    if not range_header.startswith("bytes="):
+        return None
+    start_str, dash, end_str = range_header[6:].partition("-")
+    # isascii() too: isdigit() also accepts e.g. "²", which int() then rejects
+    if not dash or not (start_str.isascii() and start_str.isdigit()):
+        return None
+    if not end_str:
+        return (int(start_str), None)
+    if end_str.isascii() and end_str.isdigit():
+        return (int(start_str), int(end_str))
+    return None
+
+@functools.lru_cache(maxsize=256)
+def _parse_raw_range(range_header: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """Parse a Range header into (start, end) with None for omitted bounds; None if malformed."""
+    match = RANGE_RE.fullmatch(range_header.strip())
+    if not match:
+        return None
+    start_str, end_str = match.groups()
+    if start_str == "" and end_str == "":
+        return None
+    return (
+        int(start_str) if start_str else None,
+        int(end_str) if end_str else None,
+    )
+
+def parse_range_header(range_header: Optional[str], file_size: int) -> Optional[Tuple[int, int]]:
     """Parse Range header and return (start, end) inclusive byte offsets."""
     if not range_header:
         return None
     
-    match = RANGE_RE.match(range_header.strip())
-    if not match:
+    parsed = _fast_range(range_header) or _parse_raw_range(range_header)
+    if parsed is None:
         raise HTTPException(status_code=416, detail="Invalid Range header")
     
-    start_str, end_str = match.groups()
+    start, end = parsed
     
     # Handle suffix-byte-range-spec (e.g., "bytes=-500" for last 500 bytes)
-    if start_str == "":
-        if end_str == "":
-            raise HTTPException(status_code=416, detail="Invalid Range header")
-        suffix_len = int(end_str)
-        if suffix_len == 0:
+    if start is None:
+        if end == 0:
             return None
-        start = max(0, file_size - suffix_len)
+        start = max(0, file_size - end)
+        end = file_size - 1
+    elif end is None:
         end = file_size - 1
-    else:
-        start = int(start_str)
-        end = int(end_str) if end_str != "" else file_size - 1
     
     # Validate range
     if start > end or start >= file_size:
@@ -96,31 +162,60 @@ async def parse_range_header(range_header: Optional[str], file_size: int) -> Opt
         )
     
     # Clamp end to file size
-    end = min(end, file_size - 1)
-    
-    return (start, end)
+    return (start, min(end, file_size - 1))
+
+async def _pread(fd: int, size: int, offset: int) -> bytes:
+    """Positional read on a worker thread (cheaper than aiofiles per call)."""
+    return await asyncio.to_thread(os.pread, fd, size, offset)
 
-async def stream_file_range_disk(path: str, start: int, end: int, block_size: int = 1024 * 1024):
+def _read_whole_file(path: str) -> bytes:
+    """Read an entire file in one go; meant to be run via asyncio.to_thread."""
+    with open(path, "rb") as f:
+        return f.read()
+
+def _decode_inline(storage_key: str) -> bytes:
+    """Decode a base64 inline payload (SIMD codec when pybase64 is installed)."""
+    return b64decode(storage_key)
+
+def _advise_sequential(fd: int, offset: int, length: int):
+    """Hint the kernel to read ahead for a sequential scan (no-op where unsupported)."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+async def stream_file_range_disk(path: str, start: int, end: int, block_size: int = MEDIUM_BLOCK_SIZE):
     """Stream a byte range from a disk file."""
-    async with aiofiles.open(path, "rb") as f:
-        await f.seek(start)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _advise_sequential(fd, start, end - start + 1)
+        offset = start
         remaining = end - start + 1
         while remaining > 0:
-            read_size = min(block_size, remaining)
-            chunk = await f.read(read_size)
+            chunk = await _pread(fd, min(block_size, remaining), offset)
             if not chunk:
                 break
             yield chunk
+            offset += len(chunk)
             remaining -= len(chunk)
+    finally:
+        os.close(fd)
 
-async def stream_full_file_disk(path: str, block_size: int = 1024 * 1024):
+async def stream_full_file_disk(path: str, block_size: int = MEDIUM_BLOCK_SIZE):
     """Stream entire file from disk."""
-    async with aiofiles.open(path, "rb") as f:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _advise_sequential(fd, 0, 0)
+        offset = 0
         while True:
-            chunk = await f.read(block_size)
+            chunk = await _pread(fd, block_size, offset)
             if not chunk:
                 break
             yield chunk
+            offset += len(chunk)
+    finally:
+        os.close(fd)
 
 async def stream_chunked_range(
     file_obj, 
@@ -128,67 +223,200 @@ async def stream_chunked_range(
     end: int, 
     file_key, 
     encryption_service,
-    block_size: int = 1024 * 1024
+    block_size: int = MEDIUM_BLOCK_SIZE
 ) -> AsyncGenerator[bytes, None]:
     """Stream byte range from chunked storage."""
     chunk_info = file_obj.chunk_info or {}
     
-    # Get chunk metadata
+    # Get chunk metadata once, outside the chunk loop
     upload_id = chunk_info.get("upload_id", str(file_obj.id))
     total_chunks = chunk_info.get("count", 0)
-    chunk_paths = chunk_info.get("paths", {})
+    chunk_paths = chunk_path_list(chunk_info)
     
     if total_chunks == 0:
         raise HTTPException(status_code=500, detail="No chunks found")
     
+    # Pick the codec once instead of re-checking per chunk
+    decompress = decompressor.decompress if chunk_info.get("compressed", False) else None
+    
     # Determine chunk size (from first chunk or estimate)
     estimated_chunk_size = file_obj.file_size // total_chunks if total_chunks > 1 else file_obj.file_size
     
-    # Track position in file
-    current_pos = 0
-    
-    for chunk_idx in range(total_chunks):
-        # Get chunk path
-        chunk_path = chunk_paths.get(str(chunk_idx))
+    def load_chunk(chunk_idx: int) -> bytes:
+        """Read + decrypt (+ decompress) one chunk; runs on a worker thread"""
+        chunk_path = chunk_paths[chunk_idx]
         if not chunk_path:
             shard = upload_id[:2] if len(upload_id) >= 2 else "00"
             chunk_path = f"/app/storage/cache/{shard}/{upload_id}_chunk_{chunk_idx}.enc"
-        
-        if not os.path.exists(chunk_path):
+        try:
+            encrypted_chunk = _read_whole_file(chunk_path)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail=f"Chunk {chunk_idx} missing")
         
-        # Read and decrypt chunk
-        async with aiofiles.open(chunk_path, "rb") as f:
-            encrypted_chunk = await f.read()
-        
-        decrypted_chunk = encryption_service.decrypt_chunk(encrypted_chunk, file_key, chunk_idx)
-        
-        # Handle compression
-        was_compressed = chunk_info.get("compressed", False)
-        if was_compressed:
-            from ..utils.compression import compressor
-            decrypted_chunk = compressor.decompress(decrypted_chunk)
-        
-        chunk_size = len(decrypted_chunk)
-        chunk_end = current_pos + chunk_size - 1
-        
-        # Check if this chunk is in range
-        if chunk_end < start:
+        data = encryption_service.decrypt_chunk(encrypted_chunk, file_key, chunk_idx)
+        # zstd contexts are per-thread, so decompression can run off the loop too
+        return decompress(data) if decompress else data
+    
+    # Double buffering: chunk N+1 is read and decrypted while chunk N is being sent
+    current_pos = 0
+    pending = asyncio.create_task(asyncio.to_thread(load_chunk, 0))
+    try:
+        for chunk_idx in range(total_chunks):
+            decrypted_chunk = await pending
+            pending = None
+            
+            chunk_size = len(decrypted_chunk)
+            chunk_end = current_pos + chunk_size - 1
+            
+            if current_pos > end:
+                break
+            if chunk_idx + 1 < total_chunks and chunk_end < end:
+                pending = asyncio.create_task(asyncio.to_thread(load_chunk, chunk_idx + 1))
+            
+            # Check if this chunk is in range
+            if chunk_end < start:
+                current_pos += chunk_size
+                continue
+            
+            # Calculate slice to yield
+            slice_start = max(0, start - current_pos)
+            slice_end = min(chunk_size, end - current_pos + 1)
+            
+            # Yield the relevant portion in block_size pieces; StreamingResponse
+            # only passes bytes through as-is (anything else gets .encode()d)
+            for block_start in range(slice_start, slice_end, block_size):
+                yield decrypted_chunk[block_start:min(block_start + block_size, slice_end)]
+            
             current_pos += chunk_size
-            continue
-        
-        if current_pos > end:
-            break
-        
-        # Calculate slice to yield
-        slice_start = max(0, start - current_pos)
-        slice_end = min(chunk_size, end - current_pos + 1)
-        
-        # Yield the relevant portion
-        if slice_start < slice_end:
-            yield decrypted_chunk[slice_start:slice_end]
-        
-        current_pos += chunk_size
+            if pending is None:
+                break
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+def _is_compressed(file_obj) -> bool:
+    meta = file_obj.file_metadata
+    return isinstance(meta, dict) and meta.get("compressed", False)
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header (list, weak or "*") against our strong ETag"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def _base_headers(file_obj) -> dict:
+    """Per-file headers shared by every response for this object"""
+    filename = file_obj.file_name.replace('"', '\\"')
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Type": file_obj.mime_type or "application/octet-stream",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+    }
+    if file_obj.content_hash:
+        headers["ETag"] = f'"{file_obj.content_hash[:16]}"'
+    return headers
+
+def _content_headers(base_headers: dict, parsed_range, total_size: int) -> Tuple[int, dict]:
+    """Status code and headers for a full (200) or partial (206) body"""
+    if parsed_range:
+        start, end = parsed_range
+        return 206, {
+            **base_headers,
+            "Content-Range": f"bytes {start}-{end}/{total_size}",
+            "Content-Length": str(end - start + 1),
+        }
+    return 200, {**base_headers, "Content-Length": str(total_size)}
+
+async def _respond_inline(file_obj, parsed_range, base_headers: dict, block_size: int):
+    file_key = encryption_service.decrypt_key(file_obj.encryption_key)
+    
+    # Decode and decrypt inline data, dropping the ciphertext as soon as possible
+    encrypted_data = _decode_inline(file_obj.storage_key)
+    data = encryption_service.decrypt_file(encrypted_data, file_key)
+    del encrypted_data
+    
+    if _is_compressed(file_obj):
+        data = decompressor.decompress(data)
+    
+    if parsed_range:
+        start, end = parsed_range
+        data = data[start:end + 1]
+    status_code, headers = _content_headers(base_headers, parsed_range, file_obj.file_size or 0)
+    # Inline bodies are fully materialized, so report their real length
+    headers["Content-Length"] = str(len(data))
+    return Response(content=data, status_code=status_code, headers=headers)
+
+async def _respond_single(file_obj, parsed_range, base_headers: dict, block_size: int):
+    # Ensure on-disk path exists
+    if not os.path.exists(file_obj.object_path):
+        raise HTTPException(status_code=404, detail="File not found on disk")
+
+    # If configured, offload plain (non-encrypted) files to nginx via X-Accel-Redirect.
+    # Requires: USE_X_ACCEL=True in env and a boolean flag on the object (e.g. on_disk_plain)
+    if USE_X_ACCEL and getattr(file_obj, "on_disk_plain", False):
+        # Compute relative path under the storage base that nginx alias maps to.
+        # NGINX_STORAGE_BASE must match nginx 'alias' path (e.g. /app/storage)
+        internal_rel = os.path.relpath(file_obj.object_path, NGINX_STORAGE_BASE)
+        accel_path = f"/internal_protected/{internal_rel}"
+
+        headers = {
+            **base_headers,
+            "X-Accel-Redirect": accel_path,
+            # Leave Content-Disposition in base_headers; nginx will handle Range and Content-Length.
+        }
+        # Return 200 — nginx will take over serving the file (handles ranges).
+        return Response(status_code=200, headers=headers)
+
+    # ---------- FALLBACK: encrypted or non-offloadable file: decrypt & stream in Python ----------
+    # Read on-disk encrypted file, decrypt and stream. Support Range if requested.
+    file_key = encryption_service.decrypt_key(file_obj.encryption_key)
+    encrypted_data = await asyncio.to_thread(_read_whole_file, file_obj.object_path)
+    
+    data = encryption_service.decrypt_file(encrypted_data, file_key)
+    
+    if _is_compressed(file_obj):
+        data = decompressor.decompress(data)
+    
+    async def stream_decrypted_data():
+        if parsed_range:
+            start, end = parsed_range
+            yield data[start:end + 1]
+        else:
+            # Stream in blocks to avoid memory issues
+            for i in range(0, len(data), block_size):
+                yield data[i:i + block_size]
+    
+    status_code, headers = _content_headers(base_headers, parsed_range, file_obj.file_size or 0)
+    return StreamingResponse(
+        stream_decrypted_data(),
+        status_code=status_code,
+        headers=headers,
+        media_type=base_headers["Content-Type"]
+    )
+
+async def _respond_chunked(file_obj, parsed_range, base_headers: dict, block_size: int):
+    file_key = FileKey.from_any(encryption_service.decrypt_key(file_obj.encryption_key))
+    total_size = file_obj.file_size or 0
+    start, end = parsed_range or (0, total_size - 1)
+    
+    status_code, headers = _content_headers(base_headers, parsed_range, total_size)
+    return StreamingResponse(
+        stream_chunked_range(file_obj, start, end, file_key, encryption_service, block_size),
+        status_code=status_code,
+        headers=headers,
+        media_type=base_headers["Content-Type"]
+    )
+
+DOWNLOAD_HANDLERS = {
+    "inline": _respond_inline,
+    "single": _respond_single,
+    "chunked": _respond_chunked,
+}
 
 @router.get("/{file_id}/download")
 @router.head("/{file_id}/download")
@@ -215,182 +443,41 @@ async def download_file(
     if not file_obj:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Decrypt key
-    file_key = encryption_service.decrypt_key(file_obj.encryption_key)
-    
-    # File metadata
     total_size = file_obj.file_size or 0
-    mime_type = file_obj.mime_type or "application/octet-stream"
-    filename = file_obj.file_name.replace('"', '\\"')
+    base_headers = _base_headers(file_obj)
+    etag = base_headers.get("ETag")
     
-    # Common headers
-    base_headers = {
-        "Accept-Ranges": "bytes",
-        "Content-Type": mime_type,
-        "Content-Disposition": f'attachment; filename="{filename}"',
-        "Cache-Control": "no-cache, no-store, must-revalidate",
-        "ETag": f'"{file_obj.content_hash[:16]}"' if file_obj.content_hash else None,
-    }
+    # Conditional GET: client already has this version, skip the whole decrypt pipeline
+    if etag and _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": base_headers["Cache-Control"]})
     
-    # Remove None values
-    base_headers = {k: v for k, v in base_headers.items() if v is not None}
+    # If-Range: only honour Range when the client's validator still matches
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range.strip() != etag:
+        range_header = None
     
     # Handle HEAD request
     if request.method == "HEAD":
-        headers = {**base_headers, "Content-Length": str(total_size)}
-        return Response(status_code=200, headers=headers)
+        return Response(status_code=200, headers={**base_headers, "Content-Length": str(total_size)})
+    
+    handler = DOWNLOAD_HANDLERS.get(file_obj.storage_type)
+    if handler is None:
+        raise HTTPException(status_code=500, detail="Unknown storage type")
     
     # Parse range header
-    parsed_range = await parse_range_header(range_header, total_size)
+    parsed_range = parse_range_header(range_header, total_size)
     
-    # Update last accessed
-    file_obj.last_accessed = datetime.utcnow()
-    await db.commit()
+    # Record access; written back in batches by access_tracker
+    await access_tracker.record(file_id)
     
     # Log activity
-    await log_activity(
-        db, current_user.id, "file_downloaded", str(file_id),
+    log_activity(
+        current_user.id, "file_downloaded", str(file_id),
         {"file_name": file_obj.file_name, "partial": parsed_range is not None},
         request
     )
     
-    # Handle different storage types
-    
-    # INLINE STORAGE
-    if file_obj.storage_type == "inline":
-        # Decode and decrypt inline data
-        encrypted_data = base64.b64decode(file_obj.storage_key)
-        data = encryption_service.decrypt_file(encrypted_data, file_key)
-        
-        # Handle compression
-        if file_obj.file_metadata and isinstance(file_obj.file_metadata, dict) and file_obj.file_metadata.get("compressed", False):
-            from ..utils.compression import compressor
-            data = compressor.decompress(data)
-        
-        # Handle range request
-        if parsed_range:
-            start, end = parsed_range
-            chunk = data[start:end + 1]
-            headers = {
-                **base_headers,
-                "Content-Range": f"bytes {start}-{end}/{total_size}",
-                "Content-Length": str(len(chunk)),
-            }
-            return Response(content=chunk, status_code=206, headers=headers)
-        else:
-            headers = {
-                **base_headers,
-                "Content-Length": str(len(data)),
-            }
-            return Response(content=data, status_code=200, headers=headers)
-    
-    # SINGLE FILE STORAGE
-    elif file_obj.storage_type == "single":
-        # Ensure on-disk path exists
-        if not os.path.exists(file_obj.object_path):
-            raise HTTPException(status_code=404, detail="File not found on disk")
-
-        # If configured, offload plain (non-encrypted) files to nginx via X-Accel-Redirect.
-        # Requires: USE_X_ACCEL=True in env and a boolean flag on the object (e.g. on_disk_plain)
-        if USE_X_ACCEL and getattr(file_obj, "on_disk_plain", False):
-            # Compute relative path under the storage base that nginx alias maps to.
-            # NGINX_STORAGE_BASE must match nginx 'alias' path (e.g. /app/storage)
-            internal_rel = os.path.relpath(file_obj.object_path, NGINX_STORAGE_BASE)
-            accel_path = f"/internal_protected/{internal_rel}"
-
-            headers = {
-                **base_headers,
-                "X-Accel-Redirect": accel_path,
-                # Leave Content-Disposition in base_headers; nginx will handle Range and Content-Length.
-            }
-            # Return 200 — nginx will take over serving the file (handles ranges).
-            return Response(status_code=200, headers=headers)
-
-        # ---------- FALLBACK: encrypted or non-offloadable file: decrypt & stream in Python ----------
-        # Read on-disk encrypted file, decrypt and stream. Support Range if requested.
-        async with aiofiles.open(file_obj.object_path, "rb") as f:
-            encrypted_data = await f.read()
-
-        
-        data = encryption_service.decrypt_file(encrypted_data, file_key)
-        
-        # Handle compression
-        if file_obj.file_metadata and isinstance(file_obj.file_metadata, dict) and file_obj.file_metadata.get("compressed", False):
-            from ..utils.compression import compressor
-            data = compressor.decompress(data)
-        
-        # Convert to streaming response
-        async def stream_decrypted_data():
-            if parsed_range:
-                start, end = parsed_range
-                yield data[start:end + 1]
-            else:
-                # Stream in chunks to avoid memory issues
-                chunk_size = 1024 * 1024  # 1MB chunks
-                for i in range(0, len(data), chunk_size):
-                    yield data[i:i + chunk_size]
-        
-        if parsed_range:
-            start, end = parsed_range
-            headers = {
-                **base_headers,
-                "Content-Range": f"bytes {start}-{end}/{total_size}",
-                "Content-Length": str(end - start + 1),
-            }
-            return StreamingResponse(
-                stream_decrypted_data(),
-                status_code=206,
-                headers=headers,
-                media_type=mime_type
-            )
-        else:
-            headers = {
-                **base_headers,
-                "Content-Length": str(total_size),
-            }
-            return StreamingResponse(
-                stream_decrypted_data(),
-                status_code=200,
-                headers=headers,
-                media_type=mime_type
-            )
-    
-    # CHUNKED STORAGE
-    elif file_obj.storage_type == "chunked":
-        if parsed_range:
-            start, end = parsed_range
-            content_length = end - start + 1
-            headers = {
-                **base_headers,
-                "Content-Range": f"bytes {start}-{end}/{total_size}",
-                "Content-Length": str(content_length),
-            }
-            generator = stream_chunked_range(
-                file_obj, start, end, file_key, encryption_service
-            )
-            return StreamingResponse(
-                generator,
-                status_code=206,
-                headers=headers,
-                media_type=mime_type
-            )
-        else:
-            headers = {
-                **base_headers,
-                "Content-Length": str(total_size),
-            }
-            generator = stream_chunked_range(
-                file_obj, 0, total_size - 1, file_key, encryption_service
-            )
-            return StreamingResponse(
-                generator,
-                status_code=200,
-                headers=headers,
-                media_type=mime_type
-            )
-    
-    else:
-        raise HTTPException(status_code=500, detail="Unknown storage type")
+    return await handler(file_obj, parsed_range, base_headers, _pick_block(total_size, file_obj.storage_tier))
 
 
 @router.get("/{file_id}/preview")
@@ -400,7 +487,6 @@ async def get_file_preview(
     db: AsyncSession = Depends(get_db),
 ):
     """Get file preview with support for all storage types"""
-    import base64
     import aiofiles
     
     result = await db.execute(
@@ -414,7 +500,7 @@ async def get_file_preview(
     if not file_obj.mime_type or not file_obj.mime_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="Preview only available for images")
     
-    file_key = encryption_service.decrypt_key(file_obj.encryption_key)
+    file_key = FileKey.from_any(encryption_service.decrypt_key(file_obj.encryption_key))
     
     # Check if file was compressed
     was_compressed = False
@@ -427,13 +513,13 @@ async def get_file_preview(
         """Stream preview content based on storage type"""
         if file_obj.storage_type == "inline":
             # Decrypt inline data
-            encrypted_data = base64.b64decode(file_obj.storage_key)
+            encrypted_data = _decode_inline(file_obj.storage_key)
             file_data = encryption_service.decrypt_file(encrypted_data, file_key)
+            del encrypted_data
             
             # Decompress if needed
             if was_compressed:
-                from ..utils.compression import compressor
-                file_data = compressor.decompress(file_data)
+                file_data = decompressor.decompress(file_data)
             
             yield file_data
         
@@ -449,8 +535,7 @@ async def get_file_preview(
             
             # Decompress if needed
             if was_compressed:
-                from ..utils.compression import compressor
-                file_data = compressor.decompress(file_data)
+                file_data = decompressor.decompress(file_data)
             
             yield file_data
         
@@ -459,11 +544,11 @@ async def get_file_preview(
             chunk_info = file_obj.chunk_info
             upload_id = chunk_info.get("upload_id", str(file_obj.id))
             chunk_count = min(chunk_info.get("count", 0), 2)  # Limit preview to first 2 chunks
-            chunk_paths = chunk_info.get("paths", {})
+            chunk_paths = chunk_path_list(chunk_info)
             
             for i in range(chunk_count):
                 # Get chunk path from stored paths or construct it
-                chunk_path = chunk_paths.get(str(i))
+                chunk_path = chunk_paths[i]
                 
                 if not chunk_path:
                     # Fallback: construct path if not stored
@@ -485,8 +570,7 @@ async def get_file_preview(
                 
                 # Decompress if needed
                 if was_compressed:
-                    from ..utils.compression import compressor
-                    decrypted_chunk = compressor.decompress(decrypted_chunk)
+                    decrypted_chunk = decompressor.decompress(decrypted_chunk)
                 
                 yield decrypted_chunk
     
@@ -495,6 +579,42 @@ async def get_file_preview(
         media_type=file_obj.mime_type,
     )
 
+UNLINK_CONCURRENCY = 64
+
+async def _release_storage(redis_client, file_obj, paths_to_remove: List[str]):
+    """Drop a file's Redis data/chunk refs and collect on-disk paths to unlink later"""
+    if file_obj.storage_type == "inline":
+        if file_obj.storage_key:
+            await redis_client.delete(file_obj.storage_key)
+    
+    elif file_obj.storage_type == "single":
+        if file_obj.object_path:
+            paths_to_remove.append(file_obj.object_path)
+    
+    else:  # chunked
+        if file_obj.chunk_info:
+            for chunk_hash in file_obj.chunk_info.get("chunks", []):
+                refs = await redis_client.decr(f"chunk:refs:{chunk_hash}")
+                if refs <= 0:
+                    chunk_info = await redis_client.get(f"chunk:{chunk_hash}")
+                    if chunk_info:
+                        chunk_data = json.loads(chunk_info)
+                        paths_to_remove.append(chunk_data["path"])
+                        await redis_client.delete(f"chunk:{chunk_hash}", f"chunk:refs:{chunk_hash}")
+
+async def _remove_paths(paths: List[str]):
+    """Unlink files off the event loop with bounded concurrency (missing files are ignored)"""
+    sem = asyncio.Semaphore(UNLINK_CONCURRENCY)
+    
+    async def rm(path: str):
+        async with sem:
+            await asyncio.to_thread(os.unlink, path)
+    
+    results = await asyncio.gather(*[rm(p) for p in paths], return_exceptions=True)
+    for path, res in zip(paths, results):
+        if isinstance(res, Exception) and not isinstance(res, FileNotFoundError):
+            print(f"Failed to delete file {path}: {res}")
+
 @router.delete("/{file_id}")
 async def delete_file(
     file_id: str,
@@ -514,39 +634,21 @@ async def delete_file(
         raise HTTPException(status_code=404, detail="File not found")
     
     # Handle different storage types
-    if file_obj.storage_type == "inline":
-        if file_obj.storage_key:
-            await redis_client.delete(file_obj.storage_key)
-    
-    elif file_obj.storage_type == "single":
-        if file_obj.object_path and os.path.exists(file_obj.object_path):
-            try:
-                os.remove(file_obj.object_path)
-            except Exception as e:
-                print(f"Failed to delete file: {e}")
-    
-    else:  # chunked
-        if file_obj.chunk_info:
-            for chunk_hash in file_obj.chunk_info.get("chunks", []):
-                refs = await redis_client.decr(f"chunk:refs:{chunk_hash}")
-                if refs <= 0:
-                    chunk_info = await redis_client.get(f"chunk:{chunk_hash}")
-                    if chunk_info:
-                        chunk_data = json.loads(chunk_info)
-                        try:
-                            os.remove(chunk_data["path"])
-                        except Exception:
-                            pass
-                        await redis_client.delete(f"chunk:{chunk_hash}")
-                        await redis_client.delete(f"chunk:refs:{chunk_hash}")
+    paths_to_remove = []
+    await _release_storage(redis_client, file_obj, paths_to_remove)
     
     # Update user storage and delete from DB
     current_user.storage_used -= file_obj.file_size
     await db.delete(file_obj)
     await db.commit()
+    await invalidate_file_list(current_user.id)
+    await invalidate_storage_stats(current_user.id)
+    await invalidate_object_meta(file_id)
+    
+    await _remove_paths(paths_to_remove)
     
-    await log_activity(
-        db, current_user.id, "file_deleted", str(file_id),
+    log_activity(
+        current_user.id, "file_deleted", str(file_id),
         {"file_name": file_obj.file_name, "storage_type": file_obj.storage_type},
         request
     )
@@ -563,48 +665,34 @@ async def bulk_delete_files(
     """Delete multiple files"""
     file_ids = request_data.file_ids
     redis_client = await get_redis()
-    deleted_count = 0
     freed_space = 0
+    paths_to_remove = []
     
-    for file_id in file_ids:
-        result = await db.execute(
-            select(Object).filter(Object.id == file_id, Object.user_id == current_user.id)
+    result = await db.execute(
+        select(Object).filter(Object.id.in_(file_ids), Object.user_id == current_user.id)
+    )
+    file_objs = result.scalars().all()
+    
+    for file_obj in file_objs:
+        # Handle different storage types (same logic as single delete)
+        await _release_storage(redis_client, file_obj, paths_to_remove)
+        freed_space += file_obj.file_size
+    
+    if file_objs:
+        await db.execute(
+            delete(Object)
+            .where(Object.id.in_([f.id for f in file_objs]))
+            .execution_options(synchronize_session=False)
         )
-        file_obj = result.scalar_one_or_none()
-        
-        if file_obj:
-            # Handle different storage types (same logic as single delete)
-            if file_obj.storage_type == "inline":
-                if file_obj.storage_key:
-                    await redis_client.delete(file_obj.storage_key)
-            
-            elif file_obj.storage_type == "single":
-                if file_obj.object_path and os.path.exists(file_obj.object_path):
-                    try:
-                        os.remove(file_obj.object_path)
-                    except Exception:
-                        pass
-            
-            else:  # chunked
-                if file_obj.chunk_info:
-                    for chunk_hash in file_obj.chunk_info.get("chunks", []):
-                        refs = await redis_client.decr(f"chunk:refs:{chunk_hash}")
-                        if refs <= 0:
-                            chunk_info = await redis_client.get(f"chunk:{chunk_hash}")
-                            if chunk_info:
-                                chunk_data = json.loads(chunk_info)
-                                try:
-                                    os.remove(chunk_data["path"])
-                                except Exception:
-                                    pass
-                                await redis_client.delete(f"chunk:{chunk_hash}")
-                                await redis_client.delete(f"chunk:refs:{chunk_hash}")
-            
-            freed_space += file_obj.file_size
-            await db.delete(file_obj)
-            deleted_count += 1
+    deleted_count = len(file_objs)
     
     current_user.storage_used -= freed_space
     await db.commit()
+    await invalidate_file_list(current_user.id)
+    await invalidate_storage_stats(current_user.id)
+    await invalidate_object_meta(*[f.id for f in file_objs])
+    
+    # Unlink everything in parallel once the DB no longer references it
+    await _remove_paths(paths_to_remove)
     
-    return {"deleted": deleted_count, "freed_space": freed_space}
\ No newline at end of file
+    return {"deleted": deleted_count, "freed_space": freed_space}
@@ -2,16 +2,40 @@
 
 from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, delete, exists, cast, func, literal, bindparam, String
+from sqlalchemy.orm import aliased
 from typing import List, Optional
-import os
+from datetime import datetime
+import uuid
 from ..dependencies import get_db, get_current_user, log_activity
 from ..services.auth import auth_service
-from ..models.database import User, Folder
+from ..models.database import User, Folder, Object
 from ..models.schemas import FolderCreate, FolderResponse
+from ..utils.cache import invalidate_file_list, invalidate_storage_stats, invalidate_object_meta
 
 router = APIRouter(prefix="/api/v1/folders", tags=["folders"])
 
+# Statements built once at import; handlers only bind parameters
+FOLDER_BY_ID = select(Folder).where(
+    Folder.id == bindparam("id"),
+    Folder.user_id == bindparam("user_id")
+)
+_FOLDER_ROWS = select(
+    cast(Folder.id, String),
+    Folder.name,
+    Folder.path,
+    cast(Folder.parent_id, String),
+    Folder.created_at,
+).where(Folder.user_id == bindparam("user_id"))
+ROOT_FOLDER_ROWS = _FOLDER_ROWS.where(Folder.parent_id == None)
+FOLDER_ROWS_BY_PARENT = _FOLDER_ROWS.where(Folder.parent_id == bindparam("parent_id"))
+HAS_SUBFOLDERS = select(exists().where(Folder.parent_id == bindparam("folder_id")))
+HAS_OBJECTS = select(exists().where(Object.folder_id == bindparam("folder_id")))
+
+def _child_path(parent_path, name: str):
+    """SQL expression for a child path under parent_path (os.path.join semantics)"""
+    return func.rtrim(parent_path, "/", type_=String) + literal(f"/{name}", String)
+
 @router.post("/", response_model=FolderResponse)
 async def create_folder(
     folder_data: FolderCreate,
@@ -20,34 +44,48 @@ async def create_folder(
     request: Request = None,
 ):
     """Create a new folder"""
-    parent_path = "/"
+    new_id = uuid.uuid4()
+    created_at = datetime.utcnow()
+    columns = ["id", "user_id", "parent_id", "name", "path", "created_at"]
+    
     if folder_data.parent_id:
-        result = await db.execute(
-            select(Folder).filter(
-                Folder.id == folder_data.parent_id, 
-                Folder.user_id == current_user.id
-            )
+        # Parent check + path derivation + insert in one statement:
+        # INSERT INTO folders (...) SELECT ..., rtrim(p.path, '/') || '/' || :name
+        # FROM folders p WHERE p.id = :parent_id AND p.user_id = :user_id
+        parent_rows = select(
+            literal(new_id, Folder.id.type),
+            Folder.user_id,
+            Folder.id,
+            literal(folder_data.name, String),
+            _child_path(Folder.path, folder_data.name),
+            literal(created_at, Folder.created_at.type),
+        ).filter(
+            Folder.id == folder_data.parent_id,
+            Folder.user_id == current_user.id
+        )
+        stmt = insert(Folder).from_select(columns, parent_rows)
+    else:
+        stmt = insert(Folder).values(
+            id=new_id,
+            user_id=current_user.id,
+            parent_id=None,
+            name=folder_data.name,
+            path=f"/{folder_data.name}",
+            created_at=created_at,
         )
-        parent = result.scalar_one_or_none()
-        if not parent:
-            raise HTTPException(status_code=404, detail="Parent folder not found")
-        parent_path = parent.path
-    
-    # Construct folder path
-    folder_path = os.path.join(parent_path, folder_data.name) if parent_path != "/" else f"/{folder_data.name}"
     
-    folder = Folder(
-        user_id=current_user.id,
-        parent_id=folder_data.parent_id,
-        name=folder_data.name,
-        path=folder_path,
+    # RETURNING gives back the stored row - no SELECT-after-insert
+    result = await db.execute(
+        stmt.returning(Folder.id, Folder.name, Folder.path, Folder.parent_id, Folder.created_at)
     )
-    db.add(folder)
+    folder = result.first()
+    if folder is None:
+        raise HTTPException(status_code=404, detail="Parent folder not found")
     await db.commit()
     
-    await log_activity(
-        db, current_user.id, "folder_created", str(folder.id),
-        {"name": folder_data.name}, request
+    log_activity(
+        current_user.id, "folder_created", str(folder.id),
+        {"name": folder.name}, request
     )
     
     return FolderResponse(
@@ -65,24 +103,23 @@ async def list_folders(
     db: AsyncSession = Depends(get_db),
 ):
     """List user's folders"""
-    query = select(Folder).filter(Folder.user_id == current_user.id)
+    # Plain column rows (no ORM instances); UUIDs are cast to text in SQL
     if parent_id:
-        query = query.filter(Folder.parent_id == parent_id)
+        result = await db.execute(
+            FOLDER_ROWS_BY_PARENT, {"user_id": current_user.id, "parent_id": parent_id}
+        )
     else:
-        query = query.filter(Folder.parent_id == None)
-    
-    result = await db.execute(query)
-    folders = result.scalars().all()
+        result = await db.execute(ROOT_FOLDER_ROWS, {"user_id": current_user.id})
     
     return [
         FolderResponse(
-            id=str(f.id),
-            name=f.name,
-            path=f.path,
-            parent_id=str(f.parent_id) if f.parent_id else None,
-            created_at=f.created_at,
+            id=folder_id,
+            name=name,
+            path=path,
+            parent_id=folder_parent_id,
+            created_at=created_at,
         )
-        for f in folders
+        for folder_id, name, path, folder_parent_id, created_at in result.all()
     ]
 
 @router.get("/{folder_id}", response_model=FolderResponse)
@@ -92,12 +129,7 @@ async def get_folder(
     db: AsyncSession = Depends(get_db),
 ):
     """Get a specific folder"""
-    result = await db.execute(
-        select(Folder).filter(
-            Folder.id == folder_id,
-            Folder.user_id == current_user.id
-        )
-    )
+    result = await db.execute(FOLDER_BY_ID, {"id": folder_id, "user_id": current_user.id})
     folder = result.scalar_one_or_none()
     
     if not folder:
@@ -120,51 +152,41 @@ async def update_folder(
     request: Request = None,
 ):
     """Update folder name or move to different parent"""
-    result = await db.execute(
-        select(Folder).filter(
-            Folder.id == folder_id,
-            Folder.user_id == current_user.id
+    # Check for circular reference (known ids, no query needed)
+    if folder_data.parent_id and folder_data.parent_id == folder_id:
+        raise HTTPException(status_code=400, detail="Cannot move folder into itself")
+    
+    # Ownership check, rename, re-parent and path derivation in one UPDATE
+    stmt = update(Folder).where(Folder.id == folder_id, Folder.user_id == current_user.id)
+    if folder_data.parent_id:
+        parent = aliased(Folder)
+        stmt = stmt.where(
+            parent.id == folder_data.parent_id,
+            parent.user_id == current_user.id
+        ).values(
+            name=folder_data.name,
+            parent_id=parent.id,
+            path=_child_path(parent.path, folder_data.name)
         )
-    )
-    folder = result.scalar_one_or_none()
+    else:
+        # Moving to root
+        stmt = stmt.values(name=folder_data.name, parent_id=None, path=f"/{folder_data.name}")
     
+    result = await db.execute(
+        stmt.returning(Folder.id, Folder.name, Folder.path, Folder.parent_id)
+        .execution_options(synchronize_session=False)
+    )
+    folder = result.first()
     if not folder:
-        raise HTTPException(status_code=404, detail="Folder not found")
-    
-    # Update name if changed
-    if folder_data.name != folder.name:
-        folder.name = folder_data.name
-    
-    # Update parent if changed
-    if folder_data.parent_id != folder.parent_id:
-        if folder_data.parent_id:
-            # Verify new parent exists and belongs to user
-            parent_result = await db.execute(
-                select(Folder).filter(
-                    Folder.id == folder_data.parent_id,
-                    Folder.user_id == current_user.id
-                )
-            )
-            parent = parent_result.scalar_one_or_none()
-            if not parent:
-                raise HTTPException(status_code=404, detail="Parent folder not found")
-            
-            # Check for circular reference
-            if str(parent.id) == folder_id:
-                raise HTTPException(status_code=400, detail="Cannot move folder into itself")
-            
-            # Update path
-            folder.parent_id = folder_data.parent_id
-            folder.path = os.path.join(parent.path, folder.name)
-        else:
-            # Moving to root
-            folder.parent_id = None
-            folder.path = f"/{folder.name}"
+        # Only on the error path: tell a missing folder from a missing parent
+        if not (await db.execute(FOLDER_BY_ID, {"id": folder_id, "user_id": current_user.id})).first():
+            raise HTTPException(status_code=404, detail="Folder not found")
+        raise HTTPException(status_code=404, detail="Parent folder not found")
     
     await db.commit()
     
-    await log_activity(
-        db, current_user.id, "folder_updated", str(folder_id),
+    log_activity(
+        current_user.id, "folder_updated", str(folder_id),
         {"name": folder.name}, request
     )
     
@@ -185,12 +207,7 @@ async def delete_folder(
     request: Request = None,
 ):
     """Delete a folder (must be empty unless force=True)"""
-    result = await db.execute(
-        select(Folder).filter(
-            Folder.id == folder_id,
-            Folder.user_id == current_user.id
-        )
-    )
+    result = await db.execute(FOLDER_BY_ID, {"id": folder_id, "user_id": current_user.id})
     folder = result.scalar_one_or_none()
     
     if not folder:
@@ -202,57 +219,67 @@ async def delete_folder(
     
     if not force:
         # Check if folder has subfolders
-        subfolders = await db.execute(
-            select(Folder).filter(Folder.parent_id == folder_id)
-        )
-        if subfolders.scalar_one_or_none():
+        if (await db.execute(HAS_SUBFOLDERS, {"folder_id": folder_id})).scalar():
             raise HTTPException(
                 status_code=400, 
                 detail="Folder contains subfolders. Use force=true to delete recursively"
             )
         
         # Check if folder has files
-        from ..models.database import Object
-        files = await db.execute(
-            select(Object).filter(Object.folder_id == folder_id)
-        )
-        if files.scalar_one_or_none():
+        if (await db.execute(HAS_OBJECTS, {"folder_id": folder_id})).scalar():
             raise HTTPException(
                 status_code=400,
                 detail="Folder contains files. Use force=true to delete all contents"
             )
     else:
         # Force delete - recursively delete all contents
-        await delete_folder_contents_recursive(db, folder_id, current_user.id)
+        deleted_file_ids = await delete_folder_contents_recursive(db, folder_id, current_user.id)
     
     await db.delete(folder)
     await db.commit()
     
-    await log_activity(
-        db, current_user.id, "folder_deleted", str(folder_id),
+    if force:
+        await invalidate_file_list(current_user.id)
+        await invalidate_storage_stats(current_user.id)
+        await invalidate_object_meta(*deleted_file_ids)
+    
+    log_activity(
+        current_user.id, "folder_deleted", str(folder_id),
         {"name": folder.name, "forced": force}, request
     )
     
     return {"status": "success", "message": "Folder deleted"}
 
 async def delete_folder_contents_recursive(db: AsyncSession, folder_id: str, user_id: str):
-    """Recursively delete folder contents"""
-    from ..models.database import Object
-    
-    # Delete all files in this folder
-    files_result = await db.execute(
-        select(Object).filter(Object.folder_id == folder_id)
+    """Delete everything below a folder using one recursive CTE over the subtree.
+    Returns the ids of the deleted files."""
+    # WITH RECURSIVE subtree(id) AS (root UNION children of subtree)
+    # UNION (not UNION ALL) drops ids already seen, so a parent_id cycle
+    # terminates instead of recursing forever.
+    subtree = (
+        select(Folder.id)
+        .where(Folder.id == folder_id, Folder.user_id == user_id)
+        .cte("subtree", recursive=True)
     )
-    files = files_result.scalars().all()
-    for file in files:
-        await db.delete(file)
-    
-    # Recursively delete subfolders
-    subfolders_result = await db.execute(
-        select(Folder).filter(Folder.parent_id == folder_id)
+    subtree = subtree.union(
+        select(Folder.id)
+        .join(subtree, Folder.parent_id == subtree.c.id)
+        .where(Folder.user_id == user_id)
     )
-    subfolders = subfolders_result.scalars().all()
     
-    for subfolder in subfolders:
-        await delete_folder_contents_recursive(db, str(subfolder.id), user_id)
-        await db.delete(subfolder)
\ No newline at end of file
+    # Files anywhere in the subtree, then every folder below the root
+    # (the root itself is deleted by the caller). No ORM instances are loaded,
+    # so there is nothing in the session to synchronize.
+    deleted = await db.execute(
+        delete(Object)
+        .where(Object.folder_id.in_(select(subtree.c.id)))
+        .returning(Object.id)
+        .execution_options(synchronize_session=False)
+    )
+    deleted_file_ids = deleted.scalars().all()
+    await db.execute(
+        delete(Folder)
+        .where(Folder.id.in_(select(subtree.c.id)), Folder.id != folder_id)
+        .execution_options(synchronize_session=False)
+    )
+    return deleted_file_ids
@@ -1,80 +1,185 @@
 # services/storage-service/app/routers/storage.py
 
-from fastapi import APIRouter, Depends, BackgroundTasks, Request,HTTPException
+from fastapi import APIRouter, Depends, BackgroundTasks, Request, Response, HTTPException, Header
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, text, update, tuple_, bindparam
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import Dict, Any
 from datetime import datetime, timedelta
-import json
 import secrets
+import asyncio
+import uuid
+import orjson
+from redis.exceptions import ResponseError
+from urllib.parse import urlencode
 from ..dependencies import get_db, get_current_user, log_activity
-from ..services.auth import auth_service, pwd_context
+from ..services.auth import auth_service
 from ..models.database import User, Object, ActivityLog
 from ..models.schemas import StorageStats, ShareCreate, ShareResponse, ActivityResponse, ThemeUpdate
 from ..database import get_redis, AsyncSessionLocal
 from ..services.storage import storage_service
+from .files import parse_range_header
 from ..config import settings
-from ..utils.cache import cached
+from ..utils.cache import cached, storage_stats_key, invalidate_storage_stats, STORAGE_STATS_TTL
 from typing import Optional, List
 
 router = APIRouter(prefix="/api/v1", tags=["storage"])
 
+SHARE_PREFETCH_DEPTH = 4  # chunks fetched ahead of the client in download_shared
+SHARE_BLOCK_SIZE = 64 * 1024  # bytes per write when streaming a shared file
+SHARE_DECODE_BATCH = 4  # chunks decrypted + decompressed in parallel on worker threads
+TIER_MOVE_CONCURRENCY = 32  # parallel chunk moves in optimize_user_storage
+
+# share:{token} is written once and never rewritten; downloads only touch the
+# share:{token}:dl counter. INCR it unless that would exceed ARGV[1] (0 = unlimited).
+# Returns the new count, -1 when the limit is reached, -2 when the share is gone.
+SHARE_DOWNLOAD_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+local max = tonumber(ARGV[1]) or 0
+local n = redis.call('INCR', KEYS[1])
+if max > 0 and n > max then
+    redis.call('DECR', KEYS[1])
+    return -1
+end
+return n
+"""
+_share_download_script = None
+
+# KEYS: share:{token}, share:{token}:dl. ARGV[1] = download count so far, then field/value
+# pairs. Rewrites a legacy JSON-string share as the hash layout, keeping its TTL; no-op
+# if another request already converted it.
+SHARE_MIGRATE_LUA = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' then return 0 end
+local ttl = redis.call('PTTL', KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+    redis.call('SET', KEYS[2], ARGV[1], 'PX', ttl, 'NX')
+else
+    redis.call('SET', KEYS[2], ARGV[1], 'NX')
+end
+return 1
+"""
+_share_migrate_script = None
+
+async def _load_share(redis_client, share_key: str) -> dict:
+    """share:{token} as a str dict ({} if missing). Links created before shares were
+    stored as hashes are JSON strings; they are converted in place on first read."""
+    try:
+        stored = await redis_client.hgetall(share_key)
+    except ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            raise
+        raw = await redis_client.get(share_key)
+        if raw is None:
+            return {}
+        legacy = orjson.loads(raw)
+        fields = {
+            "token": legacy.get("token") or "",
+            "file_id": legacy["file_id"],
+            "user_id": legacy.get("user_id") or "",
+            "password": legacy.get("password") or "",
+            "expires_at": legacy.get("expires_at") or "",
+            "max_downloads": legacy.get("max_downloads") or 0,
+        }
+        global _share_migrate_script
+        if _share_migrate_script is None:
+            _share_migrate_script = redis_client.register_script(SHARE_MIGRATE_LUA)
+        await _share_migrate_script(
+            keys=[share_key, f"{share_key}:dl"],
+            args=[legacy.get("download_count") or 0, *(x for kv in fields.items() for x in kv)],
+        )
+        stored = await redis_client.hgetall(share_key)
+    return {k.decode(): v.decode() for k, v in stored.items()}
+
+# Activity pages, newest first; built once at import
+ACTIVITY_PAGE = (
+    select(
+        ActivityLog.id,
+        ActivityLog.action,
+        ActivityLog.object_id,
+        ActivityLog.ip_address,
+        ActivityLog.meta_data,
+        ActivityLog.created_at,
+    )
+    .where(ActivityLog.user_id == bindparam("user_id"))
+    .order_by(ActivityLog.created_at.desc(), ActivityLog.id.desc())
+    .limit(bindparam("limit"))
+)
+ACTIVITY_PAGE_BEFORE = ACTIVITY_PAGE.where(
+    tuple_(ActivityLog.created_at, ActivityLog.id)
+    < tuple_(bindparam("before_ts", type_=ActivityLog.created_at.type),
+             bindparam("before_id", type_=ActivityLog.id.type))
+)
+
+# GROUP BY GROUPING SETS ((), (storage_tier), (storage_type)); grouping(col) is 1
+# when the row is aggregated over that column. The writeback skips the users row
+# if another request holds it and only fires when the cached value is >1KB off.
+STORAGE_STATS_SQL = text("""
+    WITH stats AS (
+        SELECT storage_tier, storage_type,
+               grouping(storage_tier) AS g_tier,
+               grouping(storage_type) AS g_type,
+               count(id) AS count,
+               coalesce(sum(file_size), 0) AS size
+        FROM objects
+        WHERE user_id = :user_id
+        GROUP BY GROUPING SETS ((), (storage_tier), (storage_type))
+    ),
+    total AS (
+        SELECT size FROM stats WHERE g_tier = 1 AND g_type = 1
+    ),
+    writeback AS (
+        UPDATE users SET storage_used = (SELECT size FROM total)
+        WHERE id IN (
+            SELECT id FROM users WHERE id = :user_id
+            FOR NO KEY UPDATE SKIP LOCKED
+        )
+        AND abs(coalesce(storage_used, 0) - (SELECT size FROM total)) > 1024
+        RETURNING storage_used
+    )
+    SELECT stats.*, (SELECT count(*) FROM writeback) AS updated FROM stats
+""")
+
 
 @router.get("/storage/stats", response_model=StorageStats)
 async def get_storage_stats(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    """Get user storage statistics (live calculation from objects table)"""
+    """Get user storage statistics (live calculation from objects table, cached briefly)"""
+    redis_client = await get_redis()
+    stats_key = storage_stats_key(current_user.id)
+    if redis_client:
+        cached_stats = await redis_client.get(stats_key)
+        if cached_stats:
+            return StorageStats.model_validate_json(cached_stats)
     
-    # Calculate total storage used from objects table
-    result = await db.execute(
-        select(
-            func.coalesce(func.sum(Object.file_size), 0).label('total_used'),
-            func.count(Object.id).label('total_files')
-        )
-        .filter(Object.user_id == current_user.id)
-    )
-    stats = result.first()
-    total_used = stats.total_used or 0
-    total_files = stats.total_files or 0
-    
-    # Get distribution by storage tier
-    tier_result = await db.execute(
-        select(
-            Object.storage_tier, 
-            func.count(Object.id).label('count'), 
-            func.coalesce(func.sum(Object.file_size), 0).label('size')
-        )
-        .filter(Object.user_id == current_user.id)
-        .group_by(Object.storage_tier)
-    )
+    # Totals, per-tier and per-type breakdowns in one pass, with the cached
+    # users.storage_used written back in the same statement when it drifted.
+    result = await db.execute(STORAGE_STATS_SQL, {"user_id": current_user.id})
     
+    total_used = 0
+    total_files = 0
     distribution = {}
-    for tier, count, size in tier_result:
-        distribution[tier] = {"count": count, "size": size}
-    
-    # Get storage by type (inline, single, chunked)
-    type_result = await db.execute(
-        select(
-            Object.storage_type,
-            func.count(Object.id).label('count'),
-            func.coalesce(func.sum(Object.file_size), 0).label('size')
-        )
-        .filter(Object.user_id == current_user.id)
-        .group_by(Object.storage_type)
-    )
+    type_distribution = {}  # inline, single, chunked
+    storage_used_written = False
+    for tier, storage_type, g_tier, g_type, count, size, updated in result:
+        storage_used_written = storage_used_written or bool(updated)
+        if g_tier and g_type:
+            total_used, total_files = size or 0, count or 0
+        elif not g_tier:
+            distribution[tier] = {"count": count, "size": size}
+        else:
+            type_distribution[storage_type] = {"count": count, "size": size}
     
-    type_distribution = {}
-    for storage_type, count, size in type_result:
-        type_distribution[storage_type] = {"count": count, "size": size}
-    
-    # Optionally update the user's storage_used field for caching
-    if abs(current_user.storage_used - total_used) > 1024:  # Only update if difference > 1KB
-        current_user.storage_used = total_used
+    # Only pay for a commit when the writeback actually touched users
+    if storage_used_written:
         await db.commit()
+        set_committed_value(current_user, "storage_used", total_used)
     
-    return StorageStats(
+    stats = StorageStats(
         quota=current_user.storage_quota,
         used=total_used,
         available=max(0, current_user.storage_quota - total_used),
@@ -87,6 +192,10 @@ async def get_storage_stats(
         distribution=distribution,
         type_distribution=type_distribution
     )
+    
+    if redis_client:
+        await redis_client.setex(stats_key, STORAGE_STATS_TTL, stats.model_dump_json())
+    return stats
 
 @router.get("/users/{user_id}/quota")
 @cached(expire=60)  # Cache for 1 minute
@@ -149,24 +258,30 @@ async def create_share_link(
     
     share_token = secrets.token_urlsafe(32)
     
+    password_hash = (
+        await auth_service.get_password_hash(share_data.password)
+        if share_data.password else None
+    )
+    
     share_info = {
         "token": share_token,
         "file_id": str(file_id),
         "user_id": str(current_user.id),
-        "password": pwd_context.hash(share_data.password) if share_data.password else None,
+        "password": password_hash or "",
         "expires_at": (datetime.utcnow() + timedelta(hours=share_data.expires_hours)).isoformat(),
-        "max_downloads": share_data.max_downloads,
-        "download_count": 0,
+        "max_downloads": share_data.max_downloads or 0,
     }
     
-    await redis_client.setex(
-        f"share:{share_token}",
-        share_data.expires_hours * 3600,
-        json.dumps(share_info)
-    )
+    # Immutable share record plus a separate download counter, same lifetime
+    ttl = share_data.expires_hours * 3600
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(f"share:{share_token}", mapping=share_info)
+        pipe.expire(f"share:{share_token}", ttl)
+        pipe.set(f"share:{share_token}:dl", 0, ex=ttl)
+        await pipe.execute()
     
-    await log_activity(
-        db, current_user.id, "share_created", str(file_id),
+    log_activity(
+        current_user.id, "share_created", str(file_id),
         {"expires_hours": share_data.expires_hours, "has_password": bool(share_data.password)},
         request,
     )
@@ -184,69 +299,137 @@ async def create_share_link(
 async def download_shared(
     share_token: str,
     password: Optional[str] = None,
+    range_header: Optional[str] = Header(None, alias="range"),
     db: AsyncSession = Depends(get_db)
 ):
-    """Download shared file"""
+    """Download shared file (supports single-range requests for resume)"""
     from fastapi import HTTPException
     from fastapi.responses import StreamingResponse
     redis_client = await get_redis()
     
-    share_data = await redis_client.get(f"share:{share_token}")
-    if not share_data:
+    share_key = f"share:{share_token}"
+    share = await _load_share(redis_client, share_key)
+    if not share:
         raise HTTPException(status_code=404, detail="Share link expired or not found")
     
-    share = json.loads(share_data)
-    
     if share["password"]:
-        if not password or not pwd_context.verify(password, share["password"]):
+        if not password or not await auth_service.verify_password(password, share["password"]):
             raise HTTPException(status_code=401, detail="Invalid password")
     
-    if share["max_downloads"] and share["download_count"] >= share["max_downloads"]:
-        raise HTTPException(status_code=403, detail="Download limit exceeded")
-    
     result = await db.execute(select(Object).filter(Object.id == share["file_id"]))
     file_obj = result.scalar_one_or_none()
     
     if not file_obj:
         raise HTTPException(status_code=404, detail="File not found")
     
-    share["download_count"] += 1
-    await redis_client.set(f"share:{share_token}", json.dumps(share))
+    chunk_hashes = file_obj.chunk_info["chunks"]
+    total_size = file_obj.file_size or 0
+    # Validate the range before counting: a 416 must not use up a download
+    parsed_range = parse_range_header(range_header, total_size)
+    start, end = parsed_range or (0, total_size - 1)
     
-    from ..services.encryption import encryption_service
-    file_key = encryption_service.decrypt_key(file_obj.encryption_key)
+    # Count the download and enforce the limit atomically. Only requests from byte 0
+    # count: a resumed or segmented download fetches the rest with further ranges.
+    if start == 0:
+        global _share_download_script
+        if _share_download_script is None:
+            _share_download_script = redis_client.register_script(SHARE_DOWNLOAD_LUA)
+        download_count = await _share_download_script(
+            keys=[f"{share_key}:dl"], args=[share["max_downloads"]]
+        )
+        if download_count == -2:
+            raise HTTPException(status_code=404, detail="Share link expired or not found")
+        if download_count == -1:
+            raise HTTPException(status_code=403, detail="Download limit exceeded")
+    
+    from ..services.encryption import encryption_service, FileKey
+    file_key = FileKey.from_any(encryption_service.decrypt_key(file_obj.encryption_key))
+    
+    # Map the byte range onto chunks so a resumed download skips what it already has
+    first, skip, last = 0, start, len(chunk_hashes) - 1
+    if parsed_range:
+        sizes = file_obj.chunk_info.get("sizes") or await storage_service.get_chunk_sizes(chunk_hashes)
+        pos = 0
+        for i, size in enumerate(sizes):
+            if pos + size <= start:
+                first, skip = i + 1, start - pos - size
+            if pos + size > end:
+                last = i
+                break
+            pos += size
+    selected = chunk_hashes[first:last + 1]
     
     async def stream_chunks():
-        for chunk_hash in file_obj.chunk_info["chunks"]:
-            chunk_data = await storage_service.get_chunk(chunk_hash, file_key)
-            yield chunk_data
+        # Fetch up to SHARE_PREFETCH_DEPTH chunks ahead while the client drains
+        queue: asyncio.Queue = asyncio.Queue(SHARE_PREFETCH_DEPTH)
+        
+        async def producer():
+            try:
+                for i in range(0, len(selected), SHARE_DECODE_BATCH):
+                    batch = selected[i:i + SHARE_DECODE_BATCH]
+                    for chunk in await storage_service.get_chunks_batch(batch, file_key):
+                        await queue.put(chunk)
+            except Exception as e:
+                await queue.put(e)
+                return
+            await queue.put(None)
+        
+        task = asyncio.create_task(producer())
+        offset, remaining = skip, end - start + 1
+        try:
+            while remaining > 0 and (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                # Forward the chunk in SHARE_BLOCK_SIZE bytes slices rather than one big
+                # write (StreamingResponse only passes bytes through unencoded)
+                stop = min(len(item), offset + remaining)
+                for pos in range(offset, stop, SHARE_BLOCK_SIZE):
+                    yield item[pos:min(pos + SHARE_BLOCK_SIZE, stop)]
+                offset, remaining = 0, remaining - max(0, stop - offset)
+        finally:
+            # Client went away (or we finished) - stop fetching
+            task.cancel()
+    
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{file_obj.file_name}"',
+        "Content-Length": str(end - start + 1),
+    }
+    if parsed_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{total_size}"
     
     return StreamingResponse(
         stream_chunks(),
+        status_code=206 if parsed_range else 200,
         media_type=file_obj.mime_type or "application/octet-stream",
-        headers={
-            "Content-Disposition": f'attachment; filename="{file_obj.file_name}"',
-            "Content-Length": str(file_obj.file_size),
-        },
+        headers=headers,
     )
 
 @router.get("/activity", response_model=List[ActivityResponse])
 async def get_activity_logs(
+    response: Response,
     limit: int = 50,
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[uuid.UUID] = None,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    """Get user activity logs"""
-    from typing import List
+    """Get user activity logs, newest first (keyset-paginated via before_ts/before_id)"""
+    params = {"user_id": current_user.id, "limit": limit}
+    if before_ts and before_id:
+        query = ACTIVITY_PAGE_BEFORE
+        params.update(before_ts=before_ts, before_id=before_id)
+    else:
+        query = ACTIVITY_PAGE
     
-    result = await db.execute(
-        select(ActivityLog)
-        .filter(ActivityLog.user_id == current_user.id)
-        .order_by(ActivityLog.created_at.desc())
-        .limit(limit)
-    )
+    rows = (await db.execute(query, params)).all()
     
-    activities = result.scalars().all()
+    # Full page -> tell the client where the next one starts
+    if len(rows) == limit:
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = urlencode(
+            {"before_ts": last.created_at.isoformat(), "before_id": str(last.id)}
+        )
     
     return [
         ActivityResponse(
@@ -257,7 +440,7 @@ async def get_activity_logs(
             metadata=a.meta_data,
             created_at=a.created_at,
         )
-        for a in activities
+        for a in rows
     ]
 
 @router.get("/users/profile")
@@ -290,23 +473,46 @@ async def update_theme(
 # Background task for storage optimization
 async def optimize_user_storage(user_id: str):
     """Background task to optimize storage"""
+    sem = asyncio.Semaphore(TIER_MOVE_CONCURRENCY)
+    
+    async def move(chunk_hash: str, tier: str):
+        async with sem:
+            await storage_service.move_to_tier(chunk_hash, tier)
+    
     async with AsyncSessionLocal() as db:
-        result = await db.execute(select(Object).filter(Object.user_id == user_id))
-        files = result.scalars().all()
+        result = await db.execute(
+            select(Object.id, Object.storage_tier, Object.last_accessed, Object.chunk_info)
+            .filter(Object.user_id == user_id, Object.storage_tier.in_(("cache", "warm")))
+        )
         
-        for file in files:
-            age_days = (datetime.utcnow() - file.last_accessed).days
+        moves = []
+        new_tier_ids = {"warm": [], "cold": []}
+        for file_id, tier, last_accessed, chunk_info in result.all():
+            age_days = (datetime.utcnow() - last_accessed).days
+            chunks = (chunk_info or {}).get("chunks", [])
             
-            if age_days > 30 and file.storage_tier == "cache":
-                for chunk_hash in file.chunk_info.get("chunks", []):
-                    await storage_service.move_to_tier(chunk_hash, "warm")
-                file.storage_tier = "warm"
-            elif age_days > 90 and file.storage_tier == "warm":
-                for chunk_hash in file.chunk_info.get("chunks", []):
-                    await storage_service.move_to_tier(chunk_hash, "cold")
-                file.storage_tier = "cold"
+            if age_days > 30 and tier == "cache":
+                target = "warm"
+            elif age_days > 90 and tier == "warm":
+                target = "cold"
+            else:
+                continue
+            moves.extend(move(chunk_hash, target) for chunk_hash in chunks)
+            new_tier_ids[target].append(file_id)
         
+        # All chunk moves run concurrently (capped), then one UPDATE per tier
+        await asyncio.gather(*moves)
+        for target, ids in new_tier_ids.items():
+            if ids:
+                await db.execute(
+                    update(Object)
+                    .where(Object.id.in_(ids))
+                    .values(storage_tier=target)
+                    .execution_options(synchronize_session=False)
+                )
         await db.commit()
+    
+    await invalidate_storage_stats(user_id)
 
 from fastapi import HTTPException
 from typing import Optional, List
\ No newline at end of file
@@ -3,43 +3,69 @@
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, cast, String
 from typing import Optional, AsyncGenerator
 import uuid
 import json
+import orjson
 import os
 import io
-import base64
+import mmap
 import hashlib
 import mimetypes
 from datetime import datetime
 from ..dependencies import get_db, log_activity, get_current_user
 from ..services.auth import auth_service
-from ..services.storage import storage_service
-from ..services.encryption import encryption_service
+from ..services.storage import storage_service, chunk_path_list
+from ..services.encryption import encryption_service, FileKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from ..models.database import User, Object
 from ..models.schemas import UploadInitResponse, UploadStatusResponse
 from ..database import get_redis
 from ..config import settings
+from ..utils.compression import compressor, decompressor, codec_metadata
+from ..utils.hashing import chunk_hasher, combined_hash, tagged_fingerprint, CHUNK_HASH_ALGO, PLAINTEXT_FINGERPRINT
+from ..utils.encoding import b64encode_str, b64decode
+from ..utils.fileio import write_file, ensure_dir
 from aiokafka import AIOKafkaProducer
 import aiofiles
-from ..utils.cache import cached
+from ..utils.cache import (
+    cached, invalidate_file_list, invalidate_storage_stats, object_meta_key, OBJECT_META_TTL
+)
 from ..monitoring.metrics import (
     upload_initiated, upload_completed, upload_duration,
     active_uploads, chunk_processing_duration, errors_total
 )
 import time
 import asyncio
+from types import SimpleNamespace
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from collections import deque
 from ..services.deduplication_enhanced import enhanced_dedup_service
+from ..services.redis_batcher import redis_batcher
 
 router = APIRouter(prefix="/api/v1/upload", tags=["upload"])
 
 # Global resources
 kafka_producer = None
 kafka_lock = asyncio.Lock()
-executor = ThreadPoolExecutor(max_workers=8)  # For parallel processing
+# Chunks carry independent GCM nonces, so they encrypt in parallel; AES-GCM
+# runs in OpenSSL with the GIL released, so one worker per core keeps every
+# core's AES-NI/VAES units busy when several chunks are in flight
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', os.cpu_count() or 8))
+executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload-crypto")
+# Compressed chunks (zstd + disk) go to their own pool so they never queue
+# ahead of the short AES-only jobs in the crypto pool
+io_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="upload-io")
+# Chunks of one upload in flight at once, so a huge upload can't starve others
+PER_UPLOAD_CONCURRENCY = int(os.getenv('PER_UPLOAD_CONCURRENCY', 4))
+_upload_slots: dict = {}
+
+# upload_id -> FileKey: the key is unwrapped once per upload instead of once
+# per chunk. Dict order doubles as LRU order.
+_session_key_cache: dict = {}
+SESSION_CACHE_MAX = 1024
 
 # Optimized buffer sizes
 # Read from environment variables with fallbacks
@@ -47,6 +73,18 @@ STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_SIZE', 8 * 1024 * 1024))  # 8M
 INLINE_THRESHOLD = int(os.getenv('INLINE_THRESHOLD', 512 * 1024))  # 512KB
 SINGLE_OBJECT_THRESHOLD = int(os.getenv('SINGLE_OBJECT_THRESHOLD', 50 * 1024 * 1024))  # 50MB
 CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 32 * 1024 * 1024))  # 32MB default - CRITICAL CHANGE
+# Payloads up to this size are encrypted on the event loop: AES-GCM on AES-NI
+# finishes faster than the thread pool round-trip would take
+AES_INLINE_MAX = int(os.getenv('AES_INLINE_MAX', 1024 * 1024))  # 1MB
+SESSION_TTL = 3600  # upload session keys in Redis
+UPLOAD_CACHE_DIR = "/app/storage/cache"
+# Chunk files are written once and read back rarely: write them with O_DIRECT
+# so they don't evict hot pages (CAS blocks, inline reads) from the page cache
+CHUNK_DIRECT_IO = os.getenv('CHUNK_DIRECT_IO', 'true').lower() == 'true' and hasattr(os, 'O_DIRECT')
+DIRECT_IO_MIN = 1024 * 1024  # below this the aligned copy isn't worth it
+DIRECT_IO_ALIGN = 4096
+# Chunks read + decrypted ahead of the one being sent (memory: N * CHUNK_SIZE)
+DOWNLOAD_PREFETCH = int(os.getenv('DOWNLOAD_PREFETCH', 4))
 
 # Files that are already compressed - DO NOT compress these
 COMPRESSED_FORMATS = {'.zip', '.gz', '.rar', '.7z', '.bz2', '.xz', 
@@ -66,8 +104,8 @@ def should_compress(filename: str, size: int) -> bool:
     if ext in COMPRESSED_FORMATS:
         return False
     
-    # Only compress text formats larger than 1MB
-    if ext in COMPRESSIBLE_FORMATS and size > 1024 * 1024:
+    # zstd is fast enough to pay off for text formats from 64KB up
+    if ext in COMPRESSIBLE_FORMATS and size > 64 * 1024:
         return True
     
     return False
@@ -98,37 +136,141 @@ async def get_kafka_producer():
     
     return kafka_producer
 
-async def get_user_storage_info_fast(user_id: str, db: AsyncSession):
-    """Lightweight storage check"""
-    result = await db.execute(
-        select(User.storage_quota, User.storage_used)
-        .where(User.id == user_id)
-    )
-    data = result.first()
-    
-    if not data:
-        return {"quota": 0, "used": 0}
-    
-    return {
-        "quota": int(data.storage_quota or 0),
-        "used": int(data.storage_used or 0)
-    }
+def get_session_key(upload_id: str, encrypted_key: str) -> FileKey:
+    """Return the cached FileKey for an upload session"""
+    file_key = _session_key_cache.pop(upload_id, None)
+    if file_key is None:
+        file_key = FileKey.from_any(encryption_service.decrypt_key(encrypted_key))
+        if len(_session_key_cache) >= SESSION_CACHE_MAX:
+            # Abandoned uploads never reach complete; drop the oldest
+            _session_key_cache.pop(next(iter(_session_key_cache)))
+    _session_key_cache[upload_id] = file_key
+    return file_key
+
+def upload_slot(upload_id: str) -> asyncio.Semaphore:
+    """Per-upload semaphore bounding how many of its chunks are processed at once"""
+    slot = _upload_slots.get(upload_id)
+    if slot is None:
+        if len(_upload_slots) >= SESSION_CACHE_MAX:
+            _upload_slots.pop(next(iter(_upload_slots)))
+        slot = _upload_slots[upload_id] = asyncio.Semaphore(PER_UPLOAD_CONCURRENCY)
+    return slot
+
+def evict_session_key(upload_id: str):
+    _session_key_cache.pop(upload_id, None)
+    _upload_slots.pop(upload_id, None)
+
+# Record one chunk: fails (-1) if the session expired or completed meanwhile,
+# otherwise HSETs the chunk, refreshes both TTLs and returns the done count
+CHUNK_PROGRESS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return redis.call('HLEN', KEYS[2])
+"""
+_chunk_progress_script = None
+
+def ensure_upload_dirs():
+    """Create the 00..ff shard dirs and objects/ under UPLOAD_CACHE_DIR (startup)"""
+    for name in [f"{i:02x}" for i in range(256)] + ["objects"]:
+        ensure_dir(f"{UPLOAD_CACHE_DIR}/{name}")
 
-def process_chunk_cpu_bound(chunk_data: bytes, file_key: bytes, chunk_index: int, compress: bool = False):
+def storage_dir_for(name: str) -> str:
+    """Shard dir path; only touches the filesystem if startup didn't create it"""
+    return ensure_dir(f"{UPLOAD_CACHE_DIR}/{name}")
+
+def chunks_key(upload_id: str) -> str:
+    """Per-upload HASH of chunk_index -> [chunk_hash, storage_path]"""
+    return f"up:{upload_id}:chunks"
+
+async def load_chunk_progress(redis_client, upload_id: str, session: dict) -> dict:
+    """Fill session done/hashes/chunk_paths (index order) from the progress hash"""
+    entries = await redis_client.hgetall(chunks_key(upload_id))
+    if entries:
+        progress = sorted((int(idx), orjson.loads(val)) for idx, val in entries.items())
+        session["done"] = [idx for idx, _ in progress]
+        session["hashes"] = [chunk_hash for _, (chunk_hash, _path) in progress]
+        session["chunk_paths"] = {str(idx): path for idx, (_hash, path) in progress}
+    else:
+        session.setdefault("done", [])
+        session.setdefault("hashes", [])
+        session.setdefault("chunk_paths", {})
+    return session
+
+def process_chunk_cpu_bound(chunk_data: bytes, file_key: FileKey, chunk_index: int, compress: bool = False, hash_algo: str = "sha256"):
     """CPU-intensive operations in thread pool"""
+    if not compress:
+        # Hash and encrypt the same bytes: one tiled pass over the chunk
+        return encryption_service.encrypt_and_hash_chunk(chunk_data, file_key, chunk_index, chunk_hasher(hash_algo))
+    
     # Hash calculation (before any processing)
-    original_hash = hashlib.sha256(chunk_data).hexdigest()
+    hasher = chunk_hasher(hash_algo)
+    hasher.update(chunk_data)
+    original_hash = hasher.hexdigest()
     
     # Optional compression (only for compressible files)
-    if compress:
-        from ..utils.compression import compressor
-        chunk_data = compressor.compress(chunk_data)
+    chunk_data = compressor.compress(chunk_data)
     
     # Encryption (AES-GCM is fast with hardware acceleration)
     encrypted_chunk = encryption_service.encrypt_chunk(chunk_data, file_key, chunk_index)
     
     return encrypted_chunk, original_hash
 
+def _read_sequential(path: str) -> Optional[bytes]:
+    """Whole-file read with a sequential-access hint; None if the file is gone"""
+    try:
+        with open(path, 'rb') as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _write_direct(path: str, data: bytes):
+    """
+    Write through O_DIRECT (bypassing the page cache) from a page-aligned
+    anonymous mmap padded to DIRECT_IO_ALIGN, then truncate the padding off.
+    Filesystems without O_DIRECT support (tmpfs, some overlays) fall back to
+    a buffered write.
+    """
+    size = len(data)
+    padded = -(-size // DIRECT_IO_ALIGN) * DIRECT_IO_ALIGN
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+    except OSError:
+        return write_file(path, data)
+    
+    buf = mmap.mmap(-1, padded)
+    try:
+        buf.write(data)
+        view = memoryview(buf)
+        try:
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            view.release()
+        os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        fd = None
+        write_file(path, data)
+    finally:
+        if fd is not None:
+            os.close(fd)
+        buf.close()
+
+def process_chunk_to_disk(src_file, storage_path: str, file_key: FileKey, chunk_index: int, compress: bool = False, hash_algo: str = "sha256") -> str:
+    """Read, hash, compress, encrypt and write one chunk in a single worker-thread hop"""
+    chunk_data = src_file.read()
+    encrypted_chunk, chunk_hash = process_chunk_cpu_bound(chunk_data, file_key, chunk_index, compress, hash_algo)
+    del chunk_data
+    if CHUNK_DIRECT_IO and len(encrypted_chunk) >= DIRECT_IO_MIN:
+        _write_direct(storage_path, encrypted_chunk)
+    else:
+        write_file(storage_path, encrypted_chunk)
+    return chunk_hash
+
 @router.post("/init", response_model=UploadInitResponse)
 async def init_upload(
     file_name: str,
@@ -144,9 +286,9 @@ async def init_upload(
     
     redis_client = await get_redis()
     
-    # Check storage quota
-    storage_info = await get_user_storage_info_fast(str(current_user.id), db)
-    if storage_info['used'] + file_size > storage_info['quota']:
+    # Check storage quota. get_current_user just loaded this row in the same
+    # session, so re-selecting quota/usage would only add a round trip.
+    if int(current_user.storage_used or 0) + file_size > int(current_user.storage_quota or 0):
         raise HTTPException(status_code=413, detail="Storage quota exceeded")
     
     # Determine storage strategy
@@ -177,15 +319,14 @@ async def init_upload(
         "folder": folder_id,
         "strategy": storage_strategy,
         "chunks": total_chunks,
-        "done": [],
-        "hashes": [],
-        "chunk_paths": {},
         "key": encrypted_key,
         "compress": use_compression,  # Store compression decision
+        "hash_algo": CHUNK_HASH_ALGO,  # chunk fingerprint algorithm
         "start": datetime.utcnow().isoformat(),
     }
     
-    await redis_client.setex(f"up:{upload_id}", 3600, json.dumps(session_data))
+    # Metadata only: per-chunk progress lives in the up:{id}:chunks hash
+    await redis_client.setex(f"up:{upload_id}", SESSION_TTL, orjson.dumps(session_data))
     
     # Metrics
     upload_initiated.labels(
@@ -215,55 +356,65 @@ async def upload_chunk(
     """Optimized chunk upload with smart compression"""
     redis_client = await get_redis()
     
-    session_data = await redis_client.get(f"up:{upload_id}")
+    # Session metadata and the already-uploaded check in one round trip
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(f"up:{upload_id}")
+    pipe.hexists(chunks_key(upload_id), chunk_index)
+    session_data, already_done = await pipe.execute()
     if not session_data:
         raise HTTPException(status_code=404, detail="Upload session not found")
     
-    session = json.loads(session_data)
+    session = orjson.loads(session_data)
     
     if session["user"] != str(current_user.id):
         raise HTTPException(status_code=403, detail="Unauthorized")
     
-    if chunk_index in session["done"]:
+    if already_done:
         return {"status": "already_uploaded", "chunk_index": chunk_index}
     
-    # Prepare storage path
-    storage_tier = "cache"
-    shard = f"{upload_id[:2]}"
-    storage_dir = f"/app/storage/{storage_tier}/{shard}"
-    os.makedirs(storage_dir, exist_ok=True)
+    # Prepare storage path (shard dirs are created at startup)
+    storage_dir = storage_dir_for(upload_id[:2])
     storage_path = f"{storage_dir}/{upload_id}_chunk_{chunk_index}.enc"
     
-    # Read chunk data
-    chunk_data = await chunk.read()
+    # Get encryption key (unwrapped once per upload session)
+    file_key = get_session_key(upload_id, session["key"])
     
-    # Get encryption key
-    file_key = encryption_service.decrypt_key(session["key"])
-    
-    # Process in thread pool (encryption + optional compression)
+    # Read from the spooled upload, encrypt (+ optional compression) and write
+    # to disk in one thread pool job instead of separate read/crypto/write hops
     loop = asyncio.get_event_loop()
     use_compression = session.get("compress", False)
     
-    encrypted_chunk, chunk_hash = await loop.run_in_executor(
-        executor,
-        partial(process_chunk_cpu_bound, chunk_data, file_key, chunk_index, use_compression)
-    )
-    
-    # Write encrypted data asynchronously with larger buffer
-    async with aiofiles.open(storage_path, 'wb', buffering=STREAM_BUFFER_SIZE) as f:
-        await f.write(encrypted_chunk)
-    
-    # Update session
-    session["done"].append(chunk_index)
-    session["hashes"].append(chunk_hash)
-    session["chunk_paths"][str(chunk_index)] = storage_path
-    
-    # Fire-and-forget Redis update
-    asyncio.create_task(
-        redis_client.setex(f"up:{upload_id}", 3600, json.dumps(session))
+    hash_algo = session.get("hash_algo", "sha256")
+    if not use_compression and (chunk.size or 0) <= AES_INLINE_MAX:
+        # Small tail chunk: hash + AES on the loop beat the executor hop; only the
+        # file I/O leaves it (read() stays in memory under Starlette's 1MB spool)
+        encrypted_chunk, chunk_hash = process_chunk_cpu_bound(
+            await chunk.read(), file_key, chunk_index, False, hash_algo
+        )
+        await asyncio.to_thread(write_file, storage_path, encrypted_chunk)
+    else:
+        job = partial(
+            process_chunk_to_disk, chunk.file, storage_path, file_key, chunk_index,
+            use_compression, hash_algo
+        )
+        async with upload_slot(upload_id):
+            chunk_hash = await loop.run_in_executor(io_executor if use_compression else executor, job)
+    
+    # Record this chunk only (O(1)) instead of rewriting the whole session;
+    # one server-side script, so the session can't vanish between the steps.
+    # Concurrent chunk requests share one pipelined round trip per 10ms window.
+    global _chunk_progress_script
+    if _chunk_progress_script is None:
+        _chunk_progress_script = redis_client.register_script(CHUNK_PROGRESS_LUA)
+    done_count = await redis_batcher.run_script(
+        _chunk_progress_script,
+        keys=[f"up:{upload_id}", chunks_key(upload_id)],
+        args=[chunk_index, orjson.dumps([chunk_hash, storage_path]), SESSION_TTL],
     )
+    if done_count == -1:
+        raise HTTPException(status_code=404, detail="Upload session not found")
     
-    progress = len(session["done"]) / session["chunks"] * 100 if session["chunks"] > 0 else 100
+    progress = done_count / session["chunks"] * 100 if session["chunks"] > 0 else 100
     
     return {
         "status": "success",
@@ -287,7 +438,7 @@ async def upload_direct(
     if not session_data:
         raise HTTPException(status_code=404, detail="Upload session not found")
     
-    session = json.loads(session_data)
+    session = orjson.loads(session_data)
     
     if session["user"] != str(current_user.id):
         raise HTTPException(status_code=403, detail="Unauthorized")
@@ -303,7 +454,6 @@ async def upload_direct(
     def process_file():
         # Optional compression
         if use_compression:
-            from ..utils.compression import compressor
             file_data_processed = compressor.compress(file_data)
         else:
             file_data_processed = file_data
@@ -313,21 +463,22 @@ async def upload_direct(
         file_hash = hashlib.sha256(file_data).hexdigest()  # Hash of original data
         return encrypted_data, file_hash
     
-    encrypted_data, file_hash = await loop.run_in_executor(executor, process_file)
+    if not use_compression and len(file_data) <= AES_INLINE_MAX:
+        encrypted_data, file_hash = process_file()
+    else:
+        encrypted_data, file_hash = await loop.run_in_executor(executor, process_file)
     
     # Determine storage location
     file_id = session["id"]
-    storage_tier = "cache"
     
     if session["strategy"] == "inline":
-        # For inline, store in database
-        session["encrypted_data"] = base64.b64encode(encrypted_data).decode()
+        # For inline, store in database. Until completion the ciphertext sits
+        # raw in its own key so the JSON session stays metadata-only.
+        await redis_client.setex(f"up:{upload_id}:blob", SESSION_TTL, encrypted_data)
         session["storage_type"] = "inline"
     else:  # single
         # For single files, store on disk
-        shard = "objects"
-        storage_dir = f"/app/storage/{storage_tier}/{shard}"
-        os.makedirs(storage_dir, exist_ok=True)
+        storage_dir = storage_dir_for("objects")
         
         storage_path = f"{storage_dir}/{file_id}.enc"
         
@@ -339,7 +490,7 @@ async def upload_direct(
     
     session["hash"] = file_hash
     
-    await redis_client.setex(f"up:{upload_id}", 3600, json.dumps(session))
+    await redis_client.setex(f"up:{upload_id}", SESSION_TTL, orjson.dumps(session))
     
     return {
         "status": "success",
@@ -363,12 +514,14 @@ async def complete_upload(
     if not session_data:
         raise HTTPException(status_code=404, detail="Upload session not found")
     
-    session = json.loads(session_data)
+    session = orjson.loads(session_data)
     
     if session["user"] != str(current_user.id):
         raise HTTPException(status_code=403, detail="Unauthorized")
     
     storage_strategy = session.get("strategy", "chunked")
+    if storage_strategy == "chunked":
+        await load_chunk_progress(redis_client, upload_id, session)
     start_time = datetime.fromisoformat(session["start"])
     
     # Verify upload completion
@@ -384,154 +537,181 @@ async def complete_upload(
     if enable_dedup:
         print(f"🔍 Checking deduplication for {session['name']} ({session['size']/1024/1024:.1f}MB)")
         
-        # CRITICAL: We need to get the ORIGINAL file data, not the encrypted version
-        file_data = None
-        file_key = encryption_service.decrypt_key(session["key"])
+        # CRITICAL: We need to get the ORIGINAL file data, not the encrypted version.
+        # It is streamed piece by piece so only one chunk is ever resident.
+        file_key = FileKey.from_any(encryption_service.decrypt_key(session["key"]))
+        compressed = session.get("compress", False)
         
-        if storage_strategy == "single":
-            # Read and DECRYPT the single file to get original data
-            storage_path = session.get("storage_path")
-            if storage_path and os.path.exists(storage_path):
-                async with aiofiles.open(storage_path, 'rb') as f:
-                    encrypted_data = await f.read()
-                
-                # Decrypt to get original data
-                file_data = encryption_service.decrypt_file(encrypted_data, file_key)
-                
-                # Decompress if needed to get truly original data
-                if session.get("compress", False):
-                    from ..utils.compression import compressor
-                    file_data = compressor.decompress(file_data)
+        def load_original(path: str, index: Optional[int]) -> Optional[bytes]:
+            """Read + decrypt (+ decompress) one stored piece on a worker thread"""
+            encrypted = _read_sequential(path)
+            if encrypted is None:
+                return None
+            if index is None:
+                plain = encryption_service.decrypt_file(encrypted, file_key)
+            else:
+                plain = encryption_service.decrypt_chunk(encrypted, file_key, index)
+            del encrypted
+            # Decompress if needed to get truly original data
+            return decompressor.decompress(plain) if compressed else plain
         
-        elif storage_strategy == "chunked":
-            # Assemble and decrypt chunks to get original file
-            chunks_data = []
+        async def original_pieces():
+            if storage_strategy == "single":
+                # Read and DECRYPT the single file to get original data
+                storage_path = session.get("storage_path")
+                if storage_path:
+                    file_data = await asyncio.to_thread(load_original, storage_path, None)
+                    if file_data is not None:
+                        yield file_data
+                return
             
-            for i in range(session["chunks"]):
-                chunk_path = session.get("chunk_paths", {}).get(str(i))
-                if not chunk_path:
-                    shard = upload_id[:2]
-                    chunk_path = f"/app/storage/cache/{shard}/{upload_id}_chunk_{i}.enc"
-                
-                if os.path.exists(chunk_path):
-                    async with aiofiles.open(chunk_path, 'rb') as f:
-                        encrypted_chunk = await f.read()
-                    
-                    # Decrypt chunk to get original data
-                    decrypted_chunk = encryption_service.decrypt_chunk(encrypted_chunk, file_key, i)
-                    
-                    # Decompress if needed
-                    if session.get("compress", False):
-                        from ..utils.compression import compressor
-                        decrypted_chunk = compressor.decompress(decrypted_chunk)
-                    
-                    chunks_data.append(decrypted_chunk)
+            # Chunked: decrypt chunks in order; chunk i+1 is read and decrypted
+            # while the dedup pass works on chunk i
+            def chunk_path_for(i: int) -> str:
+                return session.get("chunk_paths", {}).get(str(i)) or \
+                    f"/app/storage/cache/{upload_id[:2]}/{upload_id}_chunk_{i}.enc"
             
-            if chunks_data:
-                file_data = b''.join(chunks_data)
-        
-        # Now we have the ORIGINAL file data, perform deduplication
-        if file_data:
+            total = session["chunks"]
+            pending = asyncio.create_task(asyncio.to_thread(load_original, chunk_path_for(0), 0)) if total else None
             try:
+                for i in range(total):
+                    decrypted_chunk = await pending
+                    pending = None
+                    if i + 1 < total:
+                        pending = asyncio.create_task(
+                            asyncio.to_thread(load_original, chunk_path_for(i + 1), i + 1)
+                        )
+                    if decrypted_chunk is not None:
+                        yield decrypted_chunk
+            finally:
+                if pending is not None:
+                    pending.cancel()
+        
+        # Fingerprint computed while the upload was encrypted: the plaintext
+        # hash for single uploads, the ordered chunk-hash digest for chunked
+        if storage_strategy == "single":
+            fingerprint = tagged_fingerprint(PLAINTEXT_FINGERPRINT, session["hash"]) if session.get("hash") else None
+        else:
+            hash_algo = session.get("hash_algo", "sha256")
+            fingerprint = tagged_fingerprint(f"chunks-{hash_algo}", combined_hash(session["hashes"], hash_algo))
+        dedup_metadata = {
+            'mime_type': mimetypes.guess_type(session["name"])[0],
+            'folder_id': session.get("folder")
+        }
+        
+        # Perform deduplication on the ORIGINAL content
+        try:
+            # Full duplicates are caught from the fingerprint alone, without
+            # reading back and decrypting what was just written
+            dedup_result = await enhanced_dedup_service.register_precomputed(
+                fingerprint,
+                file_name=session["name"],
+                user_id=str(current_user.id),
+                total_size=session["size"],
+                db=db,
+                metadata=dedup_metadata,
+            )
+            if dedup_result is None:
                 # This will now properly deduplicate based on original content
-                dedup_result = await enhanced_dedup_service.store_deduplicated_file(
-                    file_data=file_data,
+                dedup_result = await enhanced_dedup_service.store_deduplicated_stream(
+                    original_pieces(),
                     file_name=session["name"],
                     user_id=str(current_user.id),
                     db=db,
-                    metadata={
-                        'mime_type': mimetypes.guess_type(session["name"])[0],
-                        'folder_id': session.get("folder")
-                    },
-                    encrypt=True  # Will encrypt with a new key for CAS storage
+                    metadata=dedup_metadata,
+                    encrypt=True,  # Will encrypt with a new key for CAS storage
+                    fingerprint=fingerprint,
                 )
+            
+            # If deduplication succeeded, clean up original storage
+            if dedup_result['status'] in ['stored_with_dedup', 'full_duplicate']:
+                # Calculate actual savings
+                actual_saved = dedup_result.get('saved_size', 0)
+                
+                # For full duplicates, the entire file is saved
+                if dedup_result['status'] == 'full_duplicate':
+                    actual_saved = session["size"]
+                
+                print(f"✅ Deduplication successful! Saved {actual_saved/1024/1024:.1f}MB ({dedup_result.get('dedup_ratio', 0):.1f}%)")
+                
+                # Clean up original encrypted files since we now have deduplicated storage
+                if storage_strategy == "single" and session.get("storage_path"):
+                    try:
+                        os.remove(session["storage_path"])
+                        print(f"🗑️ Removed original encrypted file: {session['storage_path']}")
+                    except Exception as e:
+                        print(f"⚠️ Could not remove original file: {e}")
                 
-                # If deduplication succeeded, clean up original storage
-                if dedup_result['status'] in ['stored_with_dedup', 'full_duplicate']:
-                    # Calculate actual savings
-                    actual_saved = dedup_result.get('saved_size', 0)
-                    
-                    # For full duplicates, the entire file is saved
-                    if dedup_result['status'] == 'full_duplicate':
-                        actual_saved = session["size"]
-                    
-                    print(f"✅ Deduplication successful! Saved {actual_saved/1024/1024:.1f}MB ({dedup_result.get('dedup_ratio', 0):.1f}%)")
-                    
-                    # Clean up original encrypted files since we now have deduplicated storage
-                    if storage_strategy == "single" and session.get("storage_path"):
+                elif storage_strategy == "chunked":
+                    removed_count = 0
+                    for path in session.get("chunk_paths", {}).values():
                         try:
-                            os.remove(session["storage_path"])
-                            print(f"🗑️ Removed original encrypted file: {session['storage_path']}")
-                        except Exception as e:
-                            print(f"⚠️ Could not remove original file: {e}")
-                    
-                    elif storage_strategy == "chunked":
-                        removed_count = 0
-                        for path in session.get("chunk_paths", {}).values():
-                            try:
-                                os.remove(path)
-                                removed_count += 1
-                            except:
-                                pass
-                        print(f"🗑️ Removed {removed_count} original encrypted chunks")
-                    
-                    # Update user storage with actual usage
-                    if hasattr(current_user, 'storage_used'):
-                        # Only add the actual storage used (after deduplication)
-                        actual_used = session["size"] - actual_saved
-                        current_user.storage_used = (current_user.storage_used or 0) + actual_used
-                    
-                    await db.commit()
-                    
-                    # Log activity
-                    await log_activity(
-                        db, current_user.id, "file_uploaded", dedup_result['file_id'],
-                        {
-                            "file_name": session["name"], 
-                            "size": session["size"],
-                            "storage_type": "deduplicated",
-                            "saved_size": actual_saved,
-                            "dedup_ratio": dedup_result.get('dedup_ratio', 0)
-                        },
-                        request,
-                    )
-                    
-                    # Clean up Redis
-                    await redis_client.delete(f"up:{upload_id}")
-                    
-                    # Metrics
-                    duration = (datetime.utcnow() - start_time).total_seconds()
-                    upload_completed.labels(
-                        user_type=getattr(current_user, 'user_type', 'standard'),
-                        storage_strategy="deduplicated",
-                        status="success"
-                    ).inc()
-                    upload_duration.labels(storage_strategy="deduplicated").observe(duration)
-                    active_uploads.dec()
-                    
-                    return {
-                        "status": "success",
-                        "file_id": dedup_result['file_id'],
-                        "file_name": session["name"],
-                        "file_size": session["size"],
+                            os.remove(path)
+                            removed_count += 1
+                        except:
+                            pass
+                    print(f"🗑️ Removed {removed_count} original encrypted chunks")
+                
+                # Update user storage with actual usage
+                if hasattr(current_user, 'storage_used'):
+                    # Only add the actual storage used (after deduplication)
+                    actual_used = session["size"] - actual_saved
+                    current_user.storage_used = (current_user.storage_used or 0) + actual_used
+                
+                await db.commit()
+                
+                # Log activity
+                log_activity(
+                    current_user.id, "file_uploaded", dedup_result['file_id'],
+                    {
+                        "file_name": session["name"], 
+                        "size": session["size"],
                         "storage_type": "deduplicated",
-                        "deduplication": {
-                            "enabled": True,
-                            "saved_size": actual_saved,
-                            "dedup_ratio": dedup_result.get('dedup_ratio', 0),
-                            "status": dedup_result['status'],
-                            "unique_blocks": dedup_result.get('unique_blocks', 0),
-                            "duplicate_blocks": len(dedup_result.get('duplicate_blocks', []))
-                        },
-                        "encrypted": True,
-                        "duration": round(duration, 2)
-                    }
-                    
-            except Exception as e:
-                print(f"⚠️ Deduplication failed, falling back to normal storage: {str(e)}")
-                import traceback
-                traceback.print_exc()
-    
+                        "saved_size": actual_saved,
+                        "dedup_ratio": dedup_result.get('dedup_ratio', 0)
+                    },
+                    request,
+                )
+                
+                # Clean up Redis
+                await redis_client.delete(f"up:{upload_id}", chunks_key(upload_id))
+                evict_session_key(upload_id)
+                await invalidate_file_list(current_user.id)
+                await invalidate_storage_stats(current_user.id)
+                
+                # Metrics
+                duration = (datetime.utcnow() - start_time).total_seconds()
+                upload_completed.labels(
+                    user_type=getattr(current_user, 'user_type', 'standard'),
+                    storage_strategy="deduplicated",
+                    status="success"
+                ).inc()
+                upload_duration.labels(storage_strategy="deduplicated").observe(duration)
+                active_uploads.dec()
+                
+                return {
+                    "status": "success",
+                    "file_id": dedup_result['file_id'],
+                    "file_name": session["name"],
+                    "file_size": session["size"],
+                    "storage_type": "deduplicated",
+                    "deduplication": {
+                        "enabled": True,
+                        "saved_size": actual_saved,
+                        "dedup_ratio": dedup_result.get('dedup_ratio', 0),
+                        "status": dedup_result['status'],
+                        "unique_blocks": dedup_result.get('unique_blocks', 0),
+                        "duplicate_blocks": len(dedup_result.get('duplicate_blocks', []))
+                    },
+                    "encrypted": True,
+                    "duration": round(duration, 2)
+                }
+                
+        except Exception as e:
+            print(f"⚠️ Deduplication failed, falling back to normal storage: {str(e)}")
+            import traceback
+            traceback.print_exc()
+
     # ============ DEDUPLICATION INTEGRATION END ============
     
     file_id = uuid.uuid4()
@@ -539,6 +719,12 @@ async def complete_upload(
     
     # Create database record based on storage type
     if storage_strategy == "inline":
+        # storage_key is a text column: base64 once, here, at persistence time
+        blob = await redis_client.get(f"up:{upload_id}:blob")
+        storage_key = (
+            b64encode_str(blob)
+            if blob is not None else session.get("encrypted_data", "")
+        )
         file_obj = Object(
             id=file_id,
             user_id=current_user.id,
@@ -547,11 +733,11 @@ async def complete_upload(
             file_size=session["size"],
             mime_type=mime_type,
             storage_type="inline",
-            storage_key=session.get("encrypted_data", ""),
+            storage_key=storage_key,
             content_hash=session.get("hash", ""),
             encryption_key=session["key"],
             storage_tier="cache",
-            file_metadata={"compressed": session.get("compress", False)}
+            file_metadata=codec_metadata(session.get("compress", False))
         )
     
     elif storage_strategy == "single":
@@ -567,11 +753,13 @@ async def complete_upload(
             content_hash=session.get("hash", ""),
             encryption_key=session["key"],
             storage_tier="cache",
-            file_metadata={"compressed": session.get("compress", False)}
+            file_metadata=codec_metadata(session.get("compress", False))
         )
     
     else:  # chunked
-        combined_hash = hashlib.sha256("".join(session["hashes"]).encode()).hexdigest()
+        # Sessions created before hash_algo existed are all SHA-256
+        hash_algo = session.get("hash_algo", "sha256")
+        file_hash = combined_hash(session["hashes"], hash_algo)
         
         file_obj = Object(
             id=file_id,
@@ -581,15 +769,16 @@ async def complete_upload(
             file_size=session["size"],
             mime_type=mime_type,
             storage_type="chunked",
-            content_hash=combined_hash,
+            content_hash=file_hash,
             encryption_key=session["key"],
             chunk_info={
                 "chunks": session["hashes"],
                 "count": session["chunks"],
-                "paths": session.get("chunk_paths", {}),
+                "paths": [session.get("chunk_paths", {}).get(str(i)) for i in range(session["chunks"])],
                 "upload_id": upload_id,
                 "compressed": session.get("compress", False)
             },
+            file_metadata={**codec_metadata(session.get("compress", False)), "hash_algo": hash_algo},
             storage_tier="cache",
         )
     
@@ -603,8 +792,8 @@ async def complete_upload(
     await db.commit()
     
     # Log activity
-    await log_activity(
-        db, current_user.id, "file_uploaded", str(file_id),
+    log_activity(
+        current_user.id, "file_uploaded", str(file_id),
         {
             "file_name": session["name"], 
             "size": session["size"], 
@@ -615,7 +804,10 @@ async def complete_upload(
     )
     
     # Clean up Redis
-    await redis_client.delete(f"up:{upload_id}")
+    await redis_client.delete(f"up:{upload_id}", f"up:{upload_id}:blob", chunks_key(upload_id))
+    evict_session_key(upload_id)
+    await invalidate_file_list(current_user.id)
+    await invalidate_storage_stats(current_user.id)
     
     # Metrics
     duration = (datetime.utcnow() - start_time).total_seconds()
@@ -641,6 +833,37 @@ async def complete_upload(
         "throughput_mbps": round(throughput, 2)
     }
 
+# Only the columns download_file needs; cached as one Redis value per object
+DOWNLOAD_META_COLUMNS = (
+    cast(Object.id, String).label("id"),
+    cast(Object.user_id, String).label("user_id"),
+    Object.storage_type,
+    Object.object_path,
+    Object.storage_key,
+    Object.chunk_info,
+    Object.encryption_key,
+    Object.mime_type,
+    Object.file_name,
+    Object.file_metadata,
+)
+
+async def get_object_meta(file_id: str, db: AsyncSession) -> Optional[dict]:
+    """Download metadata for an object, cached for OBJECT_META_TTL seconds"""
+    redis_client = await get_redis()
+    key = object_meta_key(file_id)
+    if redis_client:
+        cached_meta = await redis_client.get(key)
+        if cached_meta:
+            return orjson.loads(cached_meta)
+    
+    row = (await db.execute(select(*DOWNLOAD_META_COLUMNS).where(Object.id == file_id))).first()
+    if row is None:
+        return None
+    meta = dict(row._mapping)
+    if redis_client:
+        await redis_client.setex(key, OBJECT_META_TTL, orjson.dumps(meta))
+    return meta
+
 @router.get("/download/{file_id}")
 async def download_file(
     file_id: str,
@@ -648,39 +871,37 @@ async def download_file(
     db: AsyncSession = Depends(get_db),
 ):
     """Download and decrypt file with streaming"""
-    # Get file metadata
-    result = await db.execute(
-        select(Object).where(Object.id == file_id)
-    )
-    file_obj = result.scalar_one_or_none()
+    # Get file metadata (Redis first, Postgres on a miss)
+    meta = await get_object_meta(file_id, db)
     
-    if not file_obj:
+    if not meta:
         raise HTTPException(404, "File not found")
     
-    if file_obj.user_id != current_user.id:
+    if meta["user_id"] != str(current_user.id):
         raise HTTPException(403, "Unauthorized")
     
+    file_obj = SimpleNamespace(**meta)
+    
     # Get encryption key
-    file_key = encryption_service.decrypt_key(file_obj.encryption_key)
+    file_key = FileKey.from_any(encryption_service.decrypt_key(file_obj.encryption_key))
     
     # Check if file was compressed
     was_compressed = False
-    if file_obj.metadata and isinstance(file_obj.metadata, dict):
-        was_compressed = file_obj.metadata.get("compressed", False)
-    elif file_obj.chunk_info and isinstance(file_obj.chunk_info, dict):
+    if isinstance(file_obj.file_metadata, dict):
+        was_compressed = file_obj.file_metadata.get("compressed", False)
+    if not was_compressed and isinstance(file_obj.chunk_info, dict):
         was_compressed = file_obj.chunk_info.get("compressed", False)
     
     async def stream_file() -> AsyncGenerator[bytes, None]:
         """Stream file content in chunks"""
         if file_obj.storage_type == "inline":
             # Decrypt inline data
-            encrypted_data = base64.b64decode(file_obj.storage_key)
+            encrypted_data = b64decode(file_obj.storage_key)
             file_data = encryption_service.decrypt_file(encrypted_data, file_key)
             
             # Decompress if needed
             if was_compressed:
-                from ..utils.compression import compressor
-                file_data = compressor.decompress(file_data)
+                file_data = decompressor.decompress(file_data)
             
             yield file_data
         
@@ -696,8 +917,7 @@ async def download_file(
             
             # Decompress if needed
             if was_compressed:
-                from ..utils.compression import compressor
-                file_data = compressor.decompress(file_data)
+                file_data = decompressor.decompress(file_data)
             
             # Stream in chunks
             chunk_size = 8 * 1024 * 1024  # 8MB chunks
@@ -705,32 +925,44 @@ async def download_file(
                 yield file_data[i:i+chunk_size]
         
         else:  # chunked
-            # Stream chunks sequentially
+            # Read + decrypt up to DOWNLOAD_PREFETCH chunks ahead on worker
+            # threads; yield strictly in order
             chunk_info = file_obj.chunk_info
             upload_id = chunk_info.get("upload_id", str(file_obj.id))
+            chunk_paths = chunk_path_list(chunk_info)
+            total_chunks = chunk_info["count"]
             
-            for i in range(chunk_info["count"]):
-                chunk_path = chunk_info.get("paths", {}).get(str(i))
-                
+            def load_chunk(i: int) -> bytes:
+                chunk_path = chunk_paths[i]
                 if not chunk_path:
                     shard = upload_id[:2]
                     chunk_path = f"/app/storage/cache/{shard}/{upload_id}_chunk_{i}.enc"
-                
-                if not os.path.exists(chunk_path):
+                try:
+                    with open(chunk_path, 'rb') as f:
+                        encrypted_chunk = f.read()
+                except FileNotFoundError:
                     raise HTTPException(404, f"Chunk {i} not found")
                 
-                async with aiofiles.open(chunk_path, 'rb') as f:
-                    encrypted_chunk = await f.read()
-                
-                # Decrypt chunk
                 decrypted_chunk = encryption_service.decrypt_chunk(encrypted_chunk, file_key, i)
-                
-                # Decompress if needed
-                if was_compressed:
-                    from ..utils.compression import compressor
-                    decrypted_chunk = compressor.decompress(decrypted_chunk)
-                
-                yield decrypted_chunk
+                del encrypted_chunk
+                return decompressor.decompress(decrypted_chunk) if was_compressed else decrypted_chunk
+            
+            pending = deque()
+            next_idx = 0
+            try:
+                while next_idx < total_chunks and len(pending) < DOWNLOAD_PREFETCH:
+                    pending.append(asyncio.create_task(asyncio.to_thread(load_chunk, next_idx)))
+                    next_idx += 1
+                while pending:
+                    decrypted_chunk = await pending.popleft()
+                    if next_idx < total_chunks:
+                        pending.append(asyncio.create_task(asyncio.to_thread(load_chunk, next_idx)))
+                        next_idx += 1
+                    yield decrypted_chunk
+            finally:
+                # Client went away or a chunk failed: drop the read-ahead
+                for task in pending:
+                    task.cancel()
     
     return StreamingResponse(
         stream_file(),
@@ -752,10 +984,11 @@ async def get_upload_status(
     if not session_data:
         raise HTTPException(status_code=404, detail="Upload session not found")
     
-    session = json.loads(session_data)
+    session = orjson.loads(session_data)
     if session["user"] != str(current_user.id):
         raise HTTPException(status_code=403, detail="Unauthorized")
     
+    await load_chunk_progress(redis_client, upload_id, session)
     if session["strategy"] == "chunked":
         missing_chunks = set(range(session["chunks"])) - set(session["done"])
         progress = len(session["done"]) / session["chunks"] * 100 if session["chunks"] > 0 else 100
@@ -772,14 +1005,20 @@ async def get_upload_status(
         progress=progress,
     )
 
+async def _read_into(file: UploadFile, buf: bytearray) -> int:
+    """readinto() on the spooled upload file, off the event loop"""
+    return await asyncio.to_thread(file.file.readinto, buf)
+
 @router.post("/test-speed")
 async def test_speed(file: UploadFile = File(...)):
     """Test raw upload speed without any processing"""
     start = time.time()
     total = 0
     
-    while content := await file.read(64 * 1024 * 1024):
-        total += len(content)
+    # One reusable buffer: the loop measures IO, not 64MB allocations
+    buf = bytearray(64 * 1024 * 1024)
+    while n := await _read_into(file, buf):
+        total += n
     
     elapsed = time.time() - start
     speed_mbps = (total / (1024 * 1024)) / elapsed if elapsed > 0 else 0
@@ -797,14 +1036,52 @@ async def test_speed_encrypted(file: UploadFile = File(...)):
     """Test upload speed with encryption only"""
     start = time.time()
     total = 0
-    file_key = encryption_service.generate_file_key()
-    
-    chunk_index = 0
-    while content := await file.read(CHUNK_SIZE):
-        # Encrypt chunk
-        encrypted = encryption_service.encrypt_chunk(content, file_key, chunk_index)
-        total += len(content)
-        chunk_index += 1
+    cipher = AESGCM(encryption_service.generate_file_key())
+    loop = asyncio.get_running_loop()
+    # Reader and encryptor overlap: the next chunk is read while the previous one encrypts.
+    # Buffers cycle through a free-list, which also bounds how many are in flight.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=4)
+    free: asyncio.Queue = asyncio.Queue()
+    for _ in range(4):
+        free.put_nowait(bytearray(CHUNK_SIZE))
+    
+    failure: Optional[Exception] = None
+    
+    async def encrypt_worker():
+        nonlocal failure
+        chunk_index = 0
+        try:
+            while (item := await queue.get()) is not None:
+                buf, n = item
+                await loop.run_in_executor(
+                    executor, encryption_service.encrypt_chunk, memoryview(buf)[:n], cipher, chunk_index
+                )
+                free.put_nowait(buf)
+                chunk_index += 1
+        except Exception as e:
+            # The reader waits on the free-list, so hand it the error instead of a buffer.
+            # If the reader already hit EOF it never looks again; it re-raises failure
+            # after awaiting this task, so don't also leave it on the task unretrieved.
+            failure = e
+            free.put_nowait(e)
+    
+    worker = asyncio.create_task(encrypt_worker())
+    try:
+        while True:
+            buf = await free.get()
+            if isinstance(buf, Exception):
+                raise buf
+            n = await _read_into(file, buf)
+            if not n:
+                break
+            await queue.put((buf, n))
+            total += n
+        await queue.put(None)
+        await worker
+        if failure is not None:
+            raise failure
+    finally:
+        worker.cancel()
     
     elapsed = time.time() - start
     speed_mbps = (total / (1024 * 1024)) / elapsed if elapsed > 0 else 0
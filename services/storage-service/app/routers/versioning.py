@@ -1,6 +1,7 @@
 # services/storage-service/app/routers/versioning.py
 
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi.responses import StreamingResponse, FileResponse
 from typing import List
 from ..services.versioning import versioning_service
 from ..services.auth import get_current_user
@@ -31,12 +32,14 @@ async def create_new_version(
     if not file_obj:
         raise HTTPException(404, "File not found")
     
-    # Read file content
-    content = await file.read()
+    # Stream the upload; the service never holds the whole version in memory
+    async def content():
+        while chunk := await file.read(1 << 20):
+            yield chunk
     
     # Create new version
     version = await versioning_service.create_version(
-        db, file_id, content, str(current_user.id), comment
+        db, file_id, content(), str(current_user.id), comment
     )
     
     return {
@@ -92,15 +95,21 @@ async def download_version(
         raise HTTPException(404, "Version not found")
     
     # Get file content based on storage type
-    if version.chunk_info.get('storage_type') == 'inline':
-        content = await storage_service.retrieve_file(version, decrypt_key)
-    else:
-        # Read from path
-        async with aiofiles.open(version.storage_path, 'rb') as f:
-            content = await f.read()
+    if version.chunk_info.get('storage_type') != 'inline':
+        # Plain file on disk: let Starlette stream it (zero-copy where the server supports it)
+        return FileResponse(
+            version.storage_path,
+            media_type="application/octet-stream",
+            filename=f"version_{version_number}.dat",
+        )
+    
+    content = await storage_service.retrieve_file(version, decrypt_key)
+    
+    async def stream_version():
+        yield content
     
     return StreamingResponse(
-        io.BytesIO(content),
+        stream_version(),
         media_type="application/octet-stream",
         headers={
             "Content-Disposition": f"attachment; filename=version_{version_number}.dat"
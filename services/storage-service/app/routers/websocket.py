@@ -1,8 +1,9 @@
 # services/storage-service/app/routers/websocket.py
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
-from typing import Dict, Set
-import json, uuid, asyncio
+from typing import Dict, List, Optional, Set, Tuple
+import json, uuid, asyncio, time
+import orjson
 from datetime import datetime
 from ..database import get_redis, async_session
 from ..services.auth import auth_service
@@ -11,20 +12,49 @@ import websockets  # to catch low-level connection closed exceptions
 
 router = APIRouter(prefix="/api/v1")
 
+SUBS_SYNC_INTERVAL = 2  # seconds between subscription mirrors to Redis
+
+# Second-resolution timestamp for the per-frame hot path, formatted once per second
+_ts_cache = [0, ""]
+
+def _now_iso() -> str:
+    second = int(time.time())
+    if second != _ts_cache[0]:
+        _ts_cache[0] = second
+        _ts_cache[1] = datetime.utcfromtimestamp(second).isoformat()
+    return _ts_cache[1]
+
+# Pong is the most frequent frame: rebuilt from a template once per second, never JSON-encoded
+_PONG_TEMPLATE = '{"type":"pong","timestamp":"%s"}'
+_pong_cache = ["", ""]
+
+def _pong_frame() -> str:
+    ts = _now_iso()
+    if ts is not _pong_cache[0]:
+        _pong_cache[0] = ts
+        _pong_cache[1] = _PONG_TEMPLATE % ts
+    return _pong_cache[1]
+
 class ConnectionManager:
     def __init__(self):
-        # Store active connections: user_id -> set of websockets
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
-        # Store websocket to user mapping for cleanup
-        self.websocket_to_user: Dict[WebSocket, str] = {}
+        # Store active connections: user_id -> slot list of websockets.
+        # Disconnects leave a None tombstone so fan-out can iterate without copying.
+        self.active_connections: Dict[str, List[Optional[WebSocket]]] = {}
+        # Store websocket -> (user_id, slot) for O(1) cleanup
+        self.websocket_to_user: Dict[WebSocket, Tuple[str, int]] = {}
+        self._tombstones: Dict[str, int] = {}
         
     async def safe_send_json(self, websocket: WebSocket, payload: dict) -> bool:
         """
         Send JSON to a websocket safely — catch common disconnect/transport errors.
         Returns True if send succeeded, False if socket is closed or failed.
         """
+        return await self.safe_send_text(websocket, orjson.dumps(payload).decode())
+
+    async def safe_send_text(self, websocket: WebSocket, text: str) -> bool:
+        """Send an already-serialized JSON message (text frame, as clients JSON.parse it)"""
         try:
-            await websocket.send_json(payload)
+            await websocket.send_text(text)
             return True
         except (WebSocketDisconnect, websockets.exceptions.ConnectionClosedError) as e:
             # Client disconnected, mark for removal by caller
@@ -45,12 +75,11 @@ class ConnectionManager:
             pass
         
         # Add to user's connections
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = set()
-        self.active_connections[user_id].add(websocket)
+        conns = self.active_connections.setdefault(user_id, [])
+        conns.append(websocket)
         
         # Store reverse mapping
-        self.websocket_to_user[websocket] = user_id
+        self.websocket_to_user[websocket] = (user_id, len(conns) - 1)
         
         # Send connection confirmation safely
         ok = await self.safe_send_json(websocket, {
@@ -69,57 +98,63 @@ class ConnectionManager:
     
     def disconnect(self, websocket: WebSocket):
         """Remove a WebSocket connection"""
-        # Get user_id from reverse mapping
-        user_id = self.websocket_to_user.get(websocket)
+        # Get user_id and slot from reverse mapping
+        entry = self.websocket_to_user.pop(websocket, None)
+        if entry is None:
+            return
+        user_id, slot = entry
         
-        if user_id:
-            # Remove from user's connections
-            if user_id in self.active_connections:
-                try:
-                    self.active_connections[user_id].discard(websocket)
-                except Exception:
-                    pass
-                
-                # Clean up empty sets
-                if not self.active_connections[user_id]:
-                    del self.active_connections[user_id]
-            
-            # Remove reverse mapping safely
-            try:
-                del self.websocket_to_user[websocket]
-            except Exception:
-                pass
-            
-            print(f"WebSocket disconnected for user: {user_id}")
+        conns = self.active_connections.get(user_id)
+        if conns is not None:
+            conns[slot] = None
+            dead = self._tombstones.get(user_id, 0) + 1
+            if dead == len(conns):
+                # Clean up users with no live sockets
+                del self.active_connections[user_id]
+                self._tombstones.pop(user_id, None)
+            elif dead * 2 > len(conns):
+                # Compact once more than half the slots are tombstones
+                conns[:] = [ws for ws in conns if ws is not None]
+                for i, ws in enumerate(conns):
+                    self.websocket_to_user[ws] = (user_id, i)
+                self._tombstones[user_id] = 0
+            else:
+                self._tombstones[user_id] = dead
+        
+        print(f"WebSocket disconnected for user: {user_id}")
+    
+    async def _send_or_drop(self, websocket: WebSocket, text: str):
+        if not await self.safe_send_text(websocket, text):
+            self.disconnect(websocket)
     
     async def send_to_user(self, user_id: str, message: dict):
         """Send message to all connections for a specific user"""
         if user_id not in self.active_connections:
             return
-        
-        # iterate over a shallow copy to avoid mutation while iterating
-        connections = list(self.active_connections.get(user_id, set()))
-        disconnected = []
-        
-        for websocket in connections:
-            ok = await self.safe_send_json(websocket, message)
-            if not ok:
-                disconnected.append(websocket)
-        
-        # Clean up disconnected websockets
-        for ws in disconnected:
-            self.disconnect(ws)
+        await self.send_text_to_user(user_id, orjson.dumps(message).decode())
+    
+    async def send_text_to_user(self, user_id: str, text: str):
+        """Fan a pre-serialized message out to every connection of a user"""
+        conns = self.active_connections.get(user_id)
+        if not conns:
+            return
+        # All socket writes overlap: latency is the slowest send, not the sum.
+        # Failed sockets are dropped by _send_or_drop.
+        await asyncio.gather(*(self._send_or_drop(ws, text) for ws in conns if ws is not None))
     
     async def broadcast_to_users(self, user_ids: list, message: dict):
         """Send message to multiple users"""
-        for user_id in user_ids:
-            await self.send_to_user(user_id, message)
+        # Serialize once for the whole fan-out
+        text = orjson.dumps(message).decode()
+        await asyncio.gather(*(self.send_text_to_user(user_id, text) for user_id in user_ids))
     
     async def broadcast_all(self, message: dict):
         """Broadcast message to all connected users"""
+        text = orjson.dumps(message).decode()
         # iterate over a shallow copy of keys
-        for user_id in list(self.active_connections.keys()):
-            await self.send_to_user(user_id, message)
+        await asyncio.gather(
+            *(self.send_text_to_user(user_id, text) for user_id in list(self.active_connections.keys()))
+        )
 
 # Create global connection manager
 manager = ConnectionManager()
@@ -167,75 +202,122 @@ async def websocket_endpoint(
         return
     
     # Get Redis for pub/sub
-    redis_client = await get_redis()
+    subs = _Subscriptions(await get_redis(), user_id)
+    mirror_task = asyncio.create_task(subs.mirror())
     
     try:
         # Main message loop
         while True:
             # Receive message from client (this will raise WebSocketDisconnect on client close)
-            data = await websocket.receive_json()
-            
-            # Handle different message types
-            message_type = data.get("type")
-            
-            if message_type == "ping":
-                # Heartbeat
-                await manager.safe_send_json(websocket, {
-                    "type": "pong",
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-            
-            elif message_type == "upload_progress":
-                # Broadcast upload progress to user's other sessions
-                await manager.send_to_user(user_id, {
-                    "type": "upload_progress",
-                    "file_id": data.get("file_id"),
-                    "progress": data.get("progress"),
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-            
-            elif message_type == "file_operation":
-                # Handle file operations (delete, rename, move)
-                operation = data.get("operation")
-                file_id = data.get("file_id")
-                
-                # Broadcast to user's other sessions
-                await manager.send_to_user(user_id, {
-                    "type": "file_update",
-                    "operation": operation,
-                    "file_id": file_id,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            data = orjson.loads(message.get("text") or message.get("bytes") or b"null")
+            if not isinstance(data, dict):
+                continue
             
-            elif message_type == "subscribe":
-                # Subscribe to specific events
-                channel = data.get("channel")
-                if channel:
-                    # Store subscription in Redis
-                    await redis_client.sadd(f"ws:subs:{user_id}", channel)
-            
-            elif message_type == "unsubscribe":
-                # Unsubscribe from events
-                channel = data.get("channel")
-                if channel:
-                    await redis_client.srem(f"ws:subs:{user_id}", channel)
+            # Dispatch by message type; unknown types are dropped
+            handler = MESSAGE_HANDLERS.get(data.get("type"))
+            if handler:
+                await handler(websocket, user_id, data, subs)
                     
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        # Clean up Redis subscriptions
-        try:
-            await redis_client.delete(f"ws:subs:{user_id}")
-        except Exception:
-            pass
+        pass
         
     except Exception as e:
         print(f"WebSocket error for user {user_id}: {e}")
+    
+    finally:
+        mirror_task.cancel()
         manager.disconnect(websocket)
+        # Clean up Redis subscriptions
         try:
-            await redis_client.delete(f"ws:subs:{user_id}")
+            await subs.redis_client.delete(subs.key)
         except Exception:
             pass
 
+class _Subscriptions:
+    """
+    Per-connection channel set; Redis gets a pipelined mirror every few seconds.
+    Each connection mirrors to its own key, so rewriting (or deleting) it never
+    touches the subscriptions of the user's other tabs.
+    """
+    
+    def __init__(self, redis_client, user_id: str):
+        self.redis_client = redis_client
+        self.user_id = user_id
+        self.key = f"ws:subs:{user_id}:{uuid.uuid4().hex}"
+        self.channels: Set[str] = set()
+        self.dirty = False
+    
+    def add(self, channel: str):
+        if channel not in self.channels:
+            self.channels.add(channel)
+            self.dirty = True
+    
+    def discard(self, channel: str):
+        if channel in self.channels:
+            self.channels.discard(channel)
+            self.dirty = True
+    
+    async def mirror(self):
+        while True:
+            await asyncio.sleep(SUBS_SYNC_INTERVAL)
+            if not self.dirty:
+                continue
+            self.dirty = False
+            try:
+                pipe = self.redis_client.pipeline(transaction=True)
+                pipe.delete(self.key)
+                if self.channels:
+                    pipe.sadd(self.key, *self.channels)
+                await pipe.execute()
+            except Exception as e:
+                self.dirty = True
+                print(f"⚠️ Subscription mirror failed for user {self.user_id}: {e}")
+
+# Client message handlers: (websocket, user_id, data, subscriptions)
+
+async def _handle_ping(websocket: WebSocket, user_id: str, data: dict, subs: _Subscriptions):
+    """Heartbeat"""
+    await manager.safe_send_text(websocket, _pong_frame())
+
+async def _handle_upload_progress(websocket: WebSocket, user_id: str, data: dict, subs: _Subscriptions):
+    """Broadcast upload progress to user's other sessions"""
+    await manager.send_to_user(user_id, {
+        "type": "upload_progress",
+        "file_id": data.get("file_id"),
+        "progress": data.get("progress"),
+        "timestamp": _now_iso()
+    })
+
+async def _handle_file_operation(websocket: WebSocket, user_id: str, data: dict, subs: _Subscriptions):
+    """Broadcast file operations (delete, rename, move) to user's other sessions"""
+    await manager.send_to_user(user_id, {
+        "type": "file_update",
+        "operation": data.get("operation"),
+        "file_id": data.get("file_id"),
+        "timestamp": _now_iso()
+    })
+
+async def _handle_subscribe(websocket: WebSocket, user_id: str, data: dict, subs: _Subscriptions):
+    """Subscribe to specific events"""
+    channel = data.get("channel")
+    if channel:
+        subs.add(channel)
+
+async def _handle_unsubscribe(websocket: WebSocket, user_id: str, data: dict, subs: _Subscriptions):
+    """Unsubscribe from events"""
+    subs.discard(data.get("channel"))
+
+MESSAGE_HANDLERS = {
+    "ping": _handle_ping,
+    "upload_progress": _handle_upload_progress,
+    "file_operation": _handle_file_operation,
+    "subscribe": _handle_subscribe,
+    "unsubscribe": _handle_unsubscribe,
+}
+
 # Helper functions to send notifications from other parts of the app
 
 async def notify_file_uploaded(user_id: str, file_info: dict):
@@ -0,0 +1,81 @@
+# services/storage-service/app/services/access_tracker.py
+"""Batched last_accessed tracking"""
+import asyncio
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import update, bindparam
+from ..database import get_redis, AsyncSessionLocal
+from ..models.database import Object
+
+PENDING_KEY = "lastacc:pending"
+FLUSHING_KEY = "lastacc:flushing"
+
+# Core executemany: rows whose object was deleted meanwhile just match nothing
+# (an ORM bulk UPDATE by primary key raises StaleDataError for them)
+FLUSH_UPDATE = (
+    update(Object.__table__)
+    .where(Object.__table__.c.id == bindparam("b_id"))
+    .values(last_accessed=bindparam("b_last_accessed"))
+)
+
+class AccessTracker:
+    """
+    Records file accesses in a Redis hash and writes them back to the
+    objects table in one bulk UPDATE on a timer, so downloads stay read-only.
+    """
+
+    def __init__(self, interval: int = 30):
+        self.interval = interval
+
+    async def record(self, file_id: str):
+        """Mark a file as accessed now (cheap, no DB round-trip)"""
+        redis_client = await get_redis()
+        if redis_client:
+            await redis_client.hset(PENDING_KEY, str(file_id), int(time.time()))
+
+    async def flush(self) -> int:
+        """Write pending accesses to the database. Returns number of rows updated."""
+        redis_client = await get_redis()
+        if not redis_client:
+            return 0
+
+        # Swap the hash out atomically so accesses recorded during the flush are kept.
+        # A leftover FLUSHING_KEY means the previous flush failed - retry it first.
+        if not await redis_client.exists(FLUSHING_KEY):
+            if not await redis_client.exists(PENDING_KEY):
+                return 0
+            await redis_client.rename(PENDING_KEY, FLUSHING_KEY)
+        pending = await redis_client.hgetall(FLUSHING_KEY)
+        if not pending:
+            return 0
+
+        rows = []
+        for file_id, ts in pending.items():
+            try:
+                rows.append({
+                    "b_id": uuid.UUID(file_id.decode() if isinstance(file_id, bytes) else file_id),
+                    "b_last_accessed": datetime.utcfromtimestamp(int(ts)),
+                })
+            except ValueError:
+                continue  # malformed entry: drop it rather than retry it forever
+
+        if rows:
+            async with AsyncSessionLocal() as db:
+                await db.execute(FLUSH_UPDATE, rows)
+                await db.commit()
+        # Only once committed: if the write failed or was cancelled, FLUSHING_KEY stays
+        # and the next flush retries it (the UPDATE is idempotent)
+        await redis_client.delete(FLUSHING_KEY)
+        return len(rows)
+
+    async def run(self):
+        """Flush loop, started from the app lifespan"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ last_accessed flush failed: {e}")
+
+access_tracker = AccessTracker()
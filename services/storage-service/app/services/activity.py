@@ -1,32 +1,97 @@
 # services/storage-service/app/services/activity.py
 """Activity logging service"""
-from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+from datetime import datetime
+from sqlalchemy import insert
 from fastapi import Request
+from ..database import AsyncSessionLocal
 from ..models.database import ActivityLog
 
 class ActivityService:
-    """Handles activity logging"""
-    
-    @staticmethod
-    async def log_activity(
-        db: AsyncSession,
+    """
+    Collects activity rows in an in-process queue and writes them with one
+    multi-row INSERT per batch, so request handlers never wait on a commit.
+    """
+
+    def __init__(self, batch_size: int = 256, interval: float = 0.5, max_queued: int = 50_000):
+        self.batch_size = batch_size
+        self.interval = interval
+        # Bounded so a database outage can't grow the queue without limit
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._dropped = 0
+
+    def log_activity(
+        self,
         user_id: str,
         action: str,
         object_id: str = None,
         metadata: dict = None,
         request: Request = None,
     ):
-        """Log user activity"""
-        activity = ActivityLog(
-            user_id=user_id,
-            action=action,
-            object_id=object_id,
-            ip_address=request.client.host if request else None,
-            user_agent=request.headers.get("user-agent") if request else None,
-            meta_data=metadata,
-        )
-        db.add(activity)
-        await db.commit()
-        return activity
-
-activity_service = ActivityService()
\ No newline at end of file
+        """Queue an activity row (returns immediately)"""
+        self._put({
+            "user_id": user_id,
+            "action": action,
+            "object_id": object_id,
+            "ip_address": request.client.host if request and request.client else None,
+            "user_agent": request.headers.get("user-agent") if request else None,
+            "meta_data": metadata,
+            "created_at": datetime.utcnow(),
+        })
+
+    def _put(self, row: dict) -> bool:
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            self._dropped += 1
+            if self._dropped == 1 or self._dropped % 1000 == 0:
+                print(f"⚠️ Activity log queue full, {self._dropped} rows dropped")
+            return False
+
+    def _drain(self) -> list:
+        rows = []
+        while len(rows) < self.batch_size and not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        return rows
+
+    async def _insert(self, rows: list):
+        committed = False
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(ActivityLog), rows)
+                await db.commit()
+                committed = True
+        except BaseException:
+            # Put the batch back for the next flush (as far as the bound allows),
+            # also when cancelled at shutdown so the final flush still writes it
+            if not committed:
+                for row in rows:
+                    self._put(row)
+            raise
+
+    async def flush(self) -> int:
+        """Write everything queued so far. Returns number of rows inserted."""
+        total = 0
+        for _ in range(-(-self._queue.qsize() // self.batch_size)):
+            rows = self._drain()
+            if not rows:
+                break
+            await self._insert(rows)
+            total += len(rows)
+        return total
+
+    async def run(self):
+        """Flush loop, started from the app lifespan"""
+        while True:
+            # Wake on the first row, then give the batch a moment to fill
+            first = await self._queue.get()
+            await asyncio.sleep(self.interval)
+            try:
+                await self._insert([first] + self._drain())
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Activity log flush failed, batch re-queued: {e}")
+                await asyncio.sleep(self.interval)
+
+activity_service = ActivityService()
@@ -1,46 +1,108 @@
 # services/storage-service/app/services/auth.py
+import os
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import jwt, JWTError
-from passlib.context import CryptContext
+import jwt
+import bcrypt
+import xxhash
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, bindparam
 from ..config import settings
 from ..models.database import User
 from ..database import get_db 
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: bcrypt directly; existing passlib $2b$ hashes verify unchanged
+BCRYPT_ROUNDS = 12
+BCRYPT_MAX_BYTES = 72  # bcrypt only reads 72 bytes; passlib truncated the same way
+# bcrypt releases the GIL; its own pool keeps login spikes off the default executor
+_password_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="bcrypt")
+
+def _check_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return bcrypt.checkpw(
+            plain_password.encode()[:BCRYPT_MAX_BYTES], hashed_password.encode()
+        )
+    except ValueError:
+        # Malformed or non-bcrypt hash
+        return False
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(
+        password.encode()[:BCRYPT_MAX_BYTES], bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    ).decode()
+
 security = HTTPBearer()
 
+def decode_access_token(token: str) -> dict:
+    """Verify and decode an HS256 access token (raises jwt.PyJWTError)"""
+    return jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+
+# Built once at import; handlers only bind parameters
+USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
+
+# Verified tokens -> (token, user_id, valid_until); reconnects with the same token skip the HS256 verify.
+# Keyed by a fast non-cryptographic hash; the stored token is compared on every hit,
+# so a key collision is only ever a cache miss.
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX = 10000
+_token_cache: "OrderedDict[int, tuple]" = OrderedDict()
+
+def _token_key(token: str) -> int:
+    return xxhash.xxh3_64_intdigest(token)
+
+def user_id_from_token(token: str) -> Optional[str]:
+    """Return the token's subject, verifying the signature only on a cache miss.
+    Raises jwt.PyJWTError for invalid tokens."""
+    key = _token_key(token)
+    now = time.time()
+    hit = _token_cache.get(key)
+    if hit is not None:
+        if hit[0] == token and hit[2] > now:
+            _token_cache.move_to_end(key)
+            return hit[1]
+        del _token_cache[key]
+
+    payload = decode_access_token(token)
+    user_id = payload.get("sub")
+    if user_id:
+        # Never cache past the token's own expiry
+        valid_until = min(now + TOKEN_CACHE_TTL, payload.get("exp", now + TOKEN_CACHE_TTL))
+        _token_cache[key] = (token, user_id, valid_until)
+        if len(_token_cache) > TOKEN_CACHE_MAX:
+            _token_cache.popitem(last=False)
+    return user_id
+
 class AuthService:
     """Handles authentication and authorization"""
 
     async def get_current_user_from_token(self, token: str, db: AsyncSession):
         """Verify token and return user for WebSocket authentication"""
         try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-            user_id = payload.get("sub")
+            user_id = user_id_from_token(token)
             if not user_id:
                 return None
             
             # Get user from database
-            result = await db.execute(
-                select(User).filter(User.id == user_id)
-            )
+            result = await db.execute(USER_BY_ID, {"user_id": user_id})
             return result.scalar_one_or_none()
-        except JWTError:
+        except jwt.PyJWTError:
             return None
     
     @staticmethod
-    def verify_password(plain_password: str, hashed_password: str) -> bool:
-        return pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(plain_password: str, hashed_password: str) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, _check_password, plain_password, hashed_password)
     
     @staticmethod
-    def get_password_hash(password: str) -> str:
-        return pwd_context.hash(password)
+    async def get_password_hash(password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, _hash_password, password)
     
     @staticmethod
     def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -1,55 +1,157 @@
-import os, json, aiofiles, hashlib
+import os, json, aiofiles, asyncio
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple, Union
 import aiohttp
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-import boto3
+import aioboto3
 
 from ..models.database import ActivityLog
 from ..config import settings
-from ..database import redis_client
+from ..database import get_redis
+from ..utils.concurrency import AdaptiveLimiter, ServiceOverloadError
+from ..utils.fileio import write_file
 
+S3_PART_SIZE = 8 * 1024 * 1024  # multipart part size; smaller payloads use one put_object
+S3_PART_CONCURRENCY = 8
+OVERLOAD_STATUSES = (429, 503)  # remote asked us to back off
+BACKED_UP_CHUNKS_KEY = "backup:chunks"  # Redis SET of chunk hashes already backed up
+
+
+def _read_file(path: str) -> bytes:
+    """open+read in one call; run via asyncio.to_thread (one executor hop, unlike aiofiles)"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=64)
+def _resolve_strategy(strategy: str, node_ok: bool, s3_ok: bool) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    """Pure part of resolve_strategy: (effective strategy, ((reason, effective at that step), ...))"""
+    effective_strategy = strategy
+    fallbacks = []
+
+    # Node fallback
+    if "node" in strategy and not node_ok:
+        effective_strategy = effective_strategy.replace("+node", "")
+        fallbacks.append(("Node disabled globally", effective_strategy))
+
+    # S3 fallback
+    if "s3" in strategy and not s3_ok:
+        effective_strategy = effective_strategy.replace("+s3", "")
+        fallbacks.append(("S3 disabled globally", effective_strategy))
+
+    if not effective_strategy or effective_strategy == "+":
+        effective_strategy = "local"
+
+    return effective_strategy, tuple(fallbacks)
+
+
+def _versions_key(object_id: str) -> str:
+    return f"backup:versions:{object_id}"
+
+
+def _version_score(version: str) -> int:
+    """Versions are named YYYYmmddHHMMSS.bak, so the stem orders them"""
+    try:
+        return int(version.split(".", 1)[0])
+    except ValueError:
+        return 0
 
 class BackupService:
     """Production-grade Backup Service for Edge Cloud"""
 
     def __init__(self):
-        self.s3_client = None  # lazy init
+        self.s3_session = None  # lazy init
+        self._http_session: Optional[aiohttp.ClientSession] = None  # lazy init, shared keep-alive pool
         self.backup_root = settings.BACKUP_PATH
+        # Incremental chunk fan-out widens while targets keep up, halves on 503s
+        self._limiter = AdaptiveLimiter(initial=4, min_limit=1, max_limit=64)
 
     # =============================
     # 🔹 Helpers
     # =============================
-    def _sha256_file(self, file_path: str) -> str:
-        sha = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                sha.update(chunk)
-        return sha.hexdigest()
-
-    async def _save_local_version(self, object_id: str, data: bytes) -> str:
+    def _local_version_path(self, object_id: str) -> str:
         backup_dir = os.path.join(self.backup_root, str(object_id))
         os.makedirs(backup_dir, exist_ok=True)
 
         version_name = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-        local_backup = os.path.join(backup_dir, f"{version_name}.bak")
+        return os.path.join(backup_dir, f"{version_name}.bak")
 
-        async with aiofiles.open(local_backup, "wb") as f:
-            await f.write(data)
+    async def _record_version(self, object_id: str, local_path: str):
+        """Add a written version to the object's sorted version index"""
+        version = os.path.basename(local_path)
+        try:
+            redis_client = await get_redis()
+            await redis_client.zadd(_versions_key(object_id), {version: _version_score(version)})
+        except Exception as e:
+            # Index is only a cache; the next listing falls back to the directory
+            print(f"⚠️ Backup version index update failed for {object_id}: {e}")
 
-        return local_backup
+    async def _list_versions(self, object_id: str, backup_dir: str) -> List[str]:
+        """
+        Versions oldest-first. The Redis index can miss a version (a failed
+        _record_version), and the directory can miss one whose local copy is gone
+        but is still on S3, so the listing is their union; index gaps are repaired.
+        """
+        key = _versions_key(object_id)
+        on_disk = await asyncio.to_thread(os.listdir, backup_dir)
+        indexed = []
+        redis_client = None
+        try:
+            redis_client = await get_redis()
+            indexed = [v.decode() if isinstance(v, bytes) else v for v in await redis_client.zrange(key, 0, -1)]
+        except Exception:
+            redis_client = None
+
+        missing = set(on_disk).difference(indexed)
+        if missing and redis_client is not None:
+            try:
+                await redis_client.zadd(key, {v: _version_score(v) for v in missing})
+            except Exception:
+                pass
+        return sorted(set(indexed).union(on_disk), key=lambda v: (_version_score(v), v))
+
+    async def _fan_out(self, data: bytes, local_path: str, s3_key: str, node_id: str) -> list:
+        """Local write, S3 upload and node push are independent: run them together.
+        Returns the remote targets' results (bools or exceptions)."""
+        jobs = [asyncio.to_thread(write_file, local_path, data)]
+        if settings.BACKUP_S3_ENABLED:
+            jobs.append(self.backup_to_s3(data, s3_key))
+        if settings.BACKUP_NODE_URL:
+            jobs.append(self.backup_to_node(data, node_id, settings.BACKUP_NODE_URL))
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        # Remote targets report their own failures; the local copy must succeed
+        if isinstance(results[0], BaseException):
+            raise results[0]
+        await self._record_version(node_id, local_path)
+        return results[1:]
 
     def _get_s3_client(self):
+        """Async S3 client context manager (use with `async with`), or None if S3 is off"""
         if not settings.BACKUP_S3_ENABLED:
             return None
-        if not self.s3_client:
-            self.s3_client = boto3.client(
-                "s3",
+        if not self.s3_session:
+            self.s3_session = aioboto3.Session(
                 aws_access_key_id=settings.AWS_ACCESS_KEY,
                 aws_secret_access_key=settings.AWS_SECRET_KEY,
             )
-        return self.s3_client
+        return self.s3_session.client("s3")
+
+    async def _http(self) -> aiohttp.ClientSession:
+        """Shared node-backup session: one connector pool instead of a handshake per call"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=64, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=300),
+            )
+        return self._http_session
+
+    async def close(self):
+        """Release pooled connections (called on app shutdown)"""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
 
     # =============================
     # 🔹 Strategy Resolver
@@ -61,120 +163,169 @@ class BackupService:
         NOTE: Caller should commit db after calling if logging is used.
         """
         strategy = user_strategy or "local"
-        effective_strategy = strategy
-
-        # Node fallback
-        if "node" in strategy and not settings.BACKUP_NODE_URL:
-            effective_strategy = effective_strategy.replace("+node", "")
-            if user and db:
-                db.add(
-                    ActivityLog(
-                        user_id=user.id,
-                        action="backup_strategy_fallback",
-                        meta_data={
-                            "requested": strategy,
-                            "reason": "Node disabled globally",
-                            "effective": effective_strategy,
-                        },
-                    )
-                )
-
-        # S3 fallback
-        if "s3" in strategy and not settings.BACKUP_S3_ENABLED:
-            effective_strategy = effective_strategy.replace("+s3", "")
-            if user and db:
-                db.add(
-                    ActivityLog(
-                        user_id=user.id,
-                        action="backup_strategy_fallback",
-                        meta_data={
-                            "requested": strategy,
-                            "reason": "S3 disabled globally",
-                            "effective": effective_strategy,
-                        },
-                    )
+        effective_strategy, fallbacks = _resolve_strategy(
+            strategy, bool(settings.BACKUP_NODE_URL), bool(settings.BACKUP_S3_ENABLED)
+        )
+
+        if fallbacks and user and db:
+            # One add_all, so the caller's commit flushes both rows as a single batch
+            db.add_all([
+                ActivityLog(
+                    user_id=user.id,
+                    action="backup_strategy_fallback",
+                    meta_data={"requested": strategy, "reason": reason, "effective": effective},
                 )
-
-        if not effective_strategy or effective_strategy == "+":
-            effective_strategy = "local"
+                for reason, effective in fallbacks
+            ])
 
         return effective_strategy
 
     # =============================
     # 🔹 Backup Methods
     # =============================
-    async def backup_to_s3(self, file_path: str, s3_key: str) -> bool:
-        client = self._get_s3_client()
-        if not client:
+    async def backup_to_s3(self, payload: Union[bytes, str], s3_key: str) -> bool:
+        """Upload bytes (or a file path) to S3; large payloads go up as parallel multipart parts.
+        File payloads are never loaded whole: each part is pread straight from the fd."""
+        client_cm = self._get_s3_client()
+        if not client_cm:
             return False
+        bucket = settings.BACKUP_S3_BUCKET
+        fd = None
         try:
-            with open(file_path, "rb") as f:
-                client.upload_fileobj(f, settings.BACKUP_S3_BUCKET, s3_key)
+            if isinstance(payload, str):
+                fd = os.open(payload, os.O_RDONLY)
+                size = os.fstat(fd).st_size
+
+                async def read_part(offset: int) -> bytes:
+                    return await asyncio.to_thread(os.pread, fd, S3_PART_SIZE, offset)
+            else:
+                size = len(payload)
+
+                async def read_part(offset: int) -> bytes:
+                    return payload[offset:offset + S3_PART_SIZE]
+
+            async with client_cm as s3:
+                if size <= S3_PART_SIZE:
+                    await s3.put_object(Bucket=bucket, Key=s3_key, Body=await read_part(0))
+                    return True
+
+                upload_id = (await s3.create_multipart_upload(Bucket=bucket, Key=s3_key))["UploadId"]
+                limit = asyncio.Semaphore(S3_PART_CONCURRENCY)
+
+                async def upload_part(part_number: int, offset: int) -> Dict:
+                    # Read inside the slot: at most S3_PART_CONCURRENCY parts are in memory
+                    async with limit:
+                        resp = await s3.upload_part(
+                            Bucket=bucket, Key=s3_key, UploadId=upload_id,
+                            PartNumber=part_number, Body=await read_part(offset),
+                        )
+                    return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+                try:
+                    parts = await asyncio.gather(*(
+                        upload_part(i + 1, offset)
+                        for i, offset in enumerate(range(0, size, S3_PART_SIZE))
+                    ))
+                    await s3.complete_multipart_upload(
+                        Bucket=bucket, Key=s3_key, UploadId=upload_id,
+                        MultipartUpload={"Parts": parts},
+                    )
+                except Exception:
+                    await s3.abort_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id)
+                    raise
             return True
         except Exception as e:
+            status = (getattr(e, "response", None) or {}).get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if status in OVERLOAD_STATUSES:
+                raise ServiceOverloadError(f"S3 returned {status}") from e
             print(f"S3 backup failed: {e}")
             return False
+        finally:
+            if fd is not None:
+                os.close(fd)
 
     async def backup_to_node(self, file_data: bytes, file_id: str, node_url: str) -> bool:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{node_url}/backup/{file_id}", data=file_data
-                ) as response:
-                    return response.status == 200
+            session = await self._http()
+            async with session.post(
+                f"{node_url}/backup/{file_id}", data=file_data
+            ) as response:
+                if response.status in OVERLOAD_STATUSES:
+                    raise ServiceOverloadError(f"Backup node returned {response.status}")
+                return response.status == 200
+        except ServiceOverloadError:
+            raise
         except Exception as e:
             print(f"Node backup failed: {e}")
             return False
 
     async def backup_object(self, object_id: str, chunks: List[Dict]) -> str:
         """Full backup of an object (concatenated raw chunk data)."""
-        full_data = b""
-        for chunk_info in chunks:
-            meta = await redis_client.get(f"chunk:{chunk_info['hash']}")
+        redis_client = await get_redis()
+        # All chunk metadata in one round-trip
+        metas = await redis_client.mget([f"chunk:{c['hash']}" for c in chunks]) if chunks else []
+        paths = []
+        for chunk_info, meta in zip(chunks, metas):
             if not meta:
                 raise HTTPException(404, f"Chunk metadata missing for {chunk_info['hash']}")
-            meta_j = json.loads(meta)
-
-            async with aiofiles.open(meta_j["path"], "rb") as f:
-                raw_bytes = await f.read()
-            full_data += raw_bytes
-
-        local_backup = await self._save_local_version(object_id, full_data)
-
-        client = self._get_s3_client()
-        if client:
-            await self.backup_to_s3(local_backup, f"backups/{object_id}/{os.path.basename(local_backup)}")
+            paths.append(json.loads(meta)["path"])
 
-        if settings.BACKUP_NODE_URL:
-            await self.backup_to_node(full_data, object_id, settings.BACKUP_NODE_URL)
+        # Concurrent reads, joined once (no quadratic += concatenation)
+        full_data = b"".join(await asyncio.gather(*(asyncio.to_thread(_read_file, p) for p in paths)))
 
+        # Remote targets get the bytes already in memory rather than re-reading the local copy
+        local_backup = self._local_version_path(object_id)
+        await self._fan_out(
+            full_data, local_backup,
+            f"backups/{object_id}/{os.path.basename(local_backup)}", object_id,
+        )
         return local_backup
 
-    async def backup_incremental(self, object_id: str, chunks: List[Dict]) -> List[str]:
-        backed_up = []
-        for chunk_info in chunks:
-            if await redis_client.exists(f"backup:chunk:{chunk_info['hash']}"):
-                continue
-
-            meta = await redis_client.get(f"chunk:{chunk_info['hash']}")
-            if not meta:
-                continue
-            meta_j = json.loads(meta)
-
-            async with aiofiles.open(meta_j["path"], "rb") as f:
-                raw_bytes = await f.read()
-
-            chunk_path = await self._save_local_version(chunk_info["hash"], raw_bytes)
-            backed_up.append(chunk_path)
+    async def _process_chunk(self, chunk_hash: str, source_path: str) -> str:
+        raw_bytes = await asyncio.to_thread(_read_file, source_path)
 
-            client = self._get_s3_client()
-            if client:
-                await self.backup_to_s3(chunk_path, f"backups/chunks/{chunk_info['hash']}.bak")
-            if settings.BACKUP_NODE_URL:
-                await self.backup_to_node(raw_bytes, chunk_info["hash"], settings.BACKUP_NODE_URL)
-
-            await redis_client.set(f"backup:chunk:{chunk_info['hash']}", "1")
+        chunk_path = self._local_version_path(chunk_hash)
+        results = await self._fan_out(
+            raw_bytes, chunk_path, f"backups/chunks/{chunk_hash}.bak", chunk_hash,
+        )
+        # Surface overload to the limiter; the chunk stays unmarked and is retried next run
+        for result in results:
+            if isinstance(result, ServiceOverloadError):
+                raise result
+        return chunk_path
 
+    async def backup_incremental(self, object_id: str, chunks: List[Dict]) -> List[str]:
+        if not chunks:
+            return []
+        redis_client = await get_redis()
+        hashes = [c["hash"] for c in chunks]
+
+        # Two round-trips for the whole object: which chunks are backed up, and where the rest live
+        present = await redis_client.smismember(BACKED_UP_CHUNKS_KEY, hashes)
+        pending = [h for h, done in zip(hashes, present) if not done]
+        metas = await redis_client.mget([f"chunk:{h}" for h in pending]) if pending else []
+        jobs = [(h, json.loads(meta)["path"]) for h, meta in zip(pending, metas) if meta]
+
+        results = await asyncio.gather(
+            *(self._limiter.submit(self._process_chunk, h, path) for h, path in jobs),
+            return_exceptions=True,
+        )
+
+        backed_up, done, failure = [], [], None
+        for (chunk_hash, _), result in zip(jobs, results):
+            if isinstance(result, ServiceOverloadError):
+                print(f"⚠️ Backup target overloaded for chunk {chunk_hash}: {result}")
+            elif isinstance(result, BaseException):
+                failure = failure or result
+            else:
+                backed_up.append(result)
+                done.append(chunk_hash)
+
+        # Mark what succeeded in one SADD, even if another chunk failed
+        if done:
+            await redis_client.sadd(BACKED_UP_CHUNKS_KEY, *done)
+        if failure:
+            raise failure
         return backed_up
 
     # =============================
@@ -185,7 +336,7 @@ class BackupService:
         if not os.path.exists(backup_dir):
             return None
 
-        versions = sorted(os.listdir(backup_dir))
+        versions = await self._list_versions(object_id, backup_dir)
         if not versions:
             return None
 
@@ -195,15 +346,17 @@ class BackupService:
         if os.path.exists(restore_file):
             return restore_file
 
-        client = self._get_s3_client()
-        if client:
+        client_cm = self._get_s3_client()
+        if client_cm:
             try:
-                with open(restore_file, "wb") as f:
-                    client.download_fileobj(
-                        settings.BACKUP_S3_BUCKET,
-                        f"backups/{object_id}/{chosen_version}",
-                        f
+                async with client_cm as s3:
+                    resp = await s3.get_object(
+                        Bucket=settings.BACKUP_S3_BUCKET,
+                        Key=f"backups/{object_id}/{chosen_version}",
                     )
+                    async with aiofiles.open(restore_file, "wb") as f:
+                        async for chunk in resp["Body"].iter_chunks(S3_PART_SIZE):
+                            await f.write(chunk)
                 return restore_file
             except Exception as e:
                 print(f"S3 restore failed: {e}")
@@ -218,13 +371,21 @@ class BackupService:
         if not os.path.exists(backup_dir):
             return
 
-        versions = sorted(os.listdir(backup_dir))
-        while len(versions) > max_versions:
-            old_version = versions.pop(0)
+        versions = await self._list_versions(object_id, backup_dir)
+        if len(versions) <= max_versions:
+            return
+
+        expired = versions[:-max_versions]
+        for old_version in expired:
             try:
                 os.remove(os.path.join(backup_dir, old_version))
             except Exception:
                 pass
+        try:
+            redis_client = await get_redis()
+            await redis_client.zrem(_versions_key(object_id), *expired)
+        except Exception:
+            pass
 
 
 backup_service = BackupService()
\ No newline at end of file
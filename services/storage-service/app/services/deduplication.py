@@ -1,15 +1,146 @@
 # services/storage-service/app/services/deduplication.py
 
+import asyncio
 import hashlib
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, delete
 from datetime import datetime
-import aiofiles
 from ..models.database import Object, ContentBlock
 from ..config import settings
+from ..database import get_redis
+from ..utils.cache import block_list_key
+from ..utils.fileio import write_file, ensure_dir
+from ..services.encryption import encryption_service
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
 import json
+import orjson
+
+try:
+    # FastCDC (Cython-accelerated when built with it): content-defined block boundaries
+    from fastcdc import fastcdc
+    CDC_AVAILABLE = True
+except ImportError:
+    CDC_AVAILABLE = False
+
+# Redis SET of every hash present in CAS: one SMISMEMBER replaces a stat per block
+CAS_HASHES_KEY = "cas:hashes"
+
+# SHA-256 of 4MB blocks releases the GIL; a pool sized to the cores keeps hashing
+# parallel without crowding out the default executor's file I/O
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="cas-hash")
+
+# Parsed block lists of recently stored/read files, as compact [hash, offset, size] rows
+BLOCK_LIST_TTL = 3600
+
+# How long a losing writer waits for the winning writer's .key sidecar
+KEY_PUBLISH_WAIT = 1.0
+
+def _derive_block_key(kek: bytes, block_index: int) -> bytes:
+    """Per-block DEK from the file's KEK; the KEK is already uniformly random, so expand-only"""
+    return HKDFExpand(
+        algorithm=hashes.SHA256(), length=32, info=block_index.to_bytes(8, "big")
+    ).derive(kek)
+
+def _new_block_key(file_key: Optional[Tuple[bytes, str, int]]) -> Tuple[bytes, str]:
+    """
+    (block_key, key record for the .key sidecar). With a (kek, wrapped_kek, index)
+    file key the record is "wrapped_kek:index", so one wrap covers every block of a
+    file while each block stays decryptable on its own (other files may share it).
+    """
+    if file_key is None:
+        block_key = encryption_service.generate_file_key()
+        return block_key, encryption_service.encrypt_key(block_key)
+    kek, wrapped_kek, block_index = file_key
+    return _derive_block_key(kek, block_index), f"{wrapped_kek}:{block_index}"
+
+def _block_key_from_record(key_record: str) -> bytes:
+    wrapped, sep, block_index = key_record.rpartition(":")
+    if not sep:
+        # Legacy sidecar: a wrapped random key per block
+        return encryption_service.decrypt_key(key_record)
+    return _derive_block_key(encryption_service.decrypt_key(wrapped), int(block_index))
+
+def _create_block(
+    content_path: str, data: bytes, encrypt: bool,
+    file_key: Optional[Tuple[bytes, str, int]] = None,
+) -> bool:
+    """
+    Write the block to a temp file in its shard, then publish it with os.link:
+    readers only ever see complete blocks, and exactly one of several concurrent
+    writers of the same hash wins. Returns False if the block already exists.
+    """
+    shard_dir = ensure_dir(os.path.dirname(content_path))
+    tmp_path = os.path.join(shard_dir, f".{os.path.basename(content_path)}.{uuid.uuid4().hex}.tmp")
+    key_tmp_path = None
+    try:
+        if encrypt:
+            block_key, key_record = _new_block_key(file_key)
+            data = encryption_service.encrypt_file(data, block_key)
+            # Staged next to the block so publishing it after the link is one rename
+            # (in production, use secure key storage)
+            key_tmp_path = tmp_path + '.key'
+            write_file(key_tmp_path, key_record.encode())
+        write_file(tmp_path, data)
+        try:
+            os.link(tmp_path, content_path)
+        except FileExistsError:
+            if encrypt:
+                _await_block_key(content_path)
+            return False
+        if key_tmp_path is not None:
+            # Only the link winner writes the sidecar, so a loser never replaces its key
+            os.replace(key_tmp_path, content_path + '.key')
+        return True
+    finally:
+        # The published block is a second link; the temp names are always dropped
+        _try_unlink(tmp_path)
+        if key_tmp_path is not None:
+            _try_unlink(key_tmp_path)
+
+def _await_block_key(content_path: str):
+    """
+    A writer that lost the link returns only once the winner's .key is in place
+    (one rename after the link), so its caller never references a keyless block.
+    Long-published blocks without a sidecar were stored unencrypted; no wait.
+    """
+    key_path = content_path + '.key'
+    deadline = time.monotonic() + KEY_PUBLISH_WAIT
+    while not os.path.exists(key_path) and time.monotonic() < deadline:
+        try:
+            if time.time() - os.stat(content_path).st_mtime > KEY_PUBLISH_WAIT:
+                return
+        except FileNotFoundError:
+            return
+        time.sleep(0.005)
+
+def _try_unlink(path: str) -> bool:
+    """unlink without a prior exists() stat; False if the file was already gone"""
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _read_block(content_path: str, with_key: bool) -> Tuple[Optional[bytes], Optional[str]]:
+    """Read a block and, if asked, its wrapped key. (None, None) if the block is missing."""
+    try:
+        with open(content_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, None
+    if not with_key:
+        return data, None
+    try:
+        with open(content_path + '.key', 'r') as f:
+            return data, f.read()
+    except FileNotFoundError:
+        return data, None
 
 class DeduplicationService:
     """
@@ -24,12 +155,34 @@ class DeduplicationService:
     
     def __init__(self):
         self.block_size = 4 * 1024 * 1024  # 4MB blocks for deduplication
+        # Content-defined block bounds (used when fastcdc is installed)
+        self.min_block_size = 1 * 1024 * 1024
+        self.max_block_size = 16 * 1024 * 1024
+        # Bounds concurrent block hash/encrypt/write jobs across all files
+        self._block_slots = asyncio.Semaphore(16)
         self.cas_path = getattr(settings, 'CAS_PATH', '/app/storage/cas')
         
     def calculate_block_hash(self, data: bytes) -> str:
         """Calculate SHA-256 hash of data block"""
         return hashlib.sha256(data).hexdigest()
     
+    def iter_block_spans(self, data: bytes):
+        """
+        (offset, length) of each block. Boundaries are content-defined with FastCDC
+        so an insert/delete only changes the blocks around it; fixed-size blocks
+        otherwise.
+        """
+        total_size = len(data)
+        if CDC_AVAILABLE and total_size > self.min_block_size:
+            for chunk in fastcdc(
+                data, min_size=self.min_block_size, avg_size=self.block_size,
+                max_size=self.max_block_size, fat=False,
+            ):
+                yield chunk.offset, chunk.length
+            return
+        for offset in range(0, total_size, self.block_size):
+            yield offset, min(self.block_size, total_size - offset)
+    
     def get_content_address(self, content_hash: str) -> str:
         """
         Get storage path for content hash.
@@ -38,62 +191,61 @@ class DeduplicationService:
         shard = content_hash[:2]
         return os.path.join(self.cas_path, shard, content_hash)
     
-    async def store_block(self, data: bytes, encrypt: bool = True) -> Tuple[str, int, bool]:
+    async def store_block(
+        self, data: bytes, encrypt: bool = True, content_hash: Optional[str] = None,
+        file_key: Optional[Tuple[bytes, str, int]] = None,
+    ) -> Tuple[str, int, bool]:
         """
         Store a block of data in CAS.
+        file_key is (kek, wrapped_kek, block_index) to derive the block key from a
+        per-file KEK instead of wrapping a fresh key per block.
         Returns: (content_hash, size, is_duplicate)
         """
-        # Calculate hash
-        content_hash = self.calculate_block_hash(data)
+        # Calculate hash (hashlib releases the GIL, so blocks hash in parallel)
+        if content_hash is None:
+            content_hash = await self._hash(data)
         content_path = self.get_content_address(content_hash)
         
-        # Check if block already exists (deduplication)
-        if os.path.exists(content_path):
-            return content_hash, len(data), True
-        
-        # Create directory if needed
-        os.makedirs(os.path.dirname(content_path), exist_ok=True)
-        
-        # Encrypt if requested
-        if encrypt:
-            from ..services.encryption import encryption_service
-            block_key = encryption_service.generate_file_key()
-            encrypted_data = encryption_service.encrypt_file(data, block_key)
-            
-            # Store encrypted block
-            async with aiofiles.open(content_path, 'wb') as f:
-                await f.write(encrypted_data)
-            
-            # Store key mapping (in production, use secure key storage)
-            key_path = content_path + '.key'
-            async with aiofiles.open(key_path, 'w') as f:
-                encrypted_key = encryption_service.encrypt_key(block_key)
-                await f.write(encrypted_key)
-        else:
-            # Store raw block
-            async with aiofiles.open(content_path, 'wb') as f:
-                await f.write(data)
-        
-        return content_hash, len(data), False
+        # Deduplication: creating the block fails if the address is already taken
+        created = await asyncio.to_thread(_create_block, content_path, data, encrypt, file_key)
+        if created:
+            # Only once our write is published; a duplicate was indexed by its writer
+            await self._mark_known(content_hash)
+        return content_hash, len(data), not created
+    
+    async def _hash(self, data) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_executor, self.calculate_block_hash, data)
+    
+    async def _mark_known(self, *hashes: str):
+        redis_client = await get_redis()
+        if redis_client and hashes:
+            try:
+                await redis_client.sadd(CAS_HASHES_KEY, *hashes)
+            except Exception as e:
+                print(f"⚠️ CAS hash index update failed: {e}")
+    
+    async def _known_hashes(self, hashes: list) -> list:
+        """Membership of each hash in the CAS index (all False if Redis is unavailable)"""
+        redis_client = await get_redis()
+        if not redis_client or not hashes:
+            return [False] * len(hashes)
+        try:
+            return [bool(x) for x in await redis_client.smismember(CAS_HASHES_KEY, hashes)]
+        except Exception as e:
+            print(f"⚠️ CAS hash index lookup failed: {e}")
+            return [False] * len(hashes)
     
     async def retrieve_block(self, content_hash: str, decrypt: bool = True) -> bytes:
         """Retrieve a block from CAS"""
         content_path = self.get_content_address(content_hash)
         
-        if not os.path.exists(content_path):
+        data, encrypted_key = await asyncio.to_thread(_read_block, content_path, decrypt)
+        if data is None:
             raise FileNotFoundError(f"Block {content_hash} not found")
         
-        async with aiofiles.open(content_path, 'rb') as f:
-            data = await f.read()
-        
-        if decrypt and os.path.exists(content_path + '.key'):
-            from ..services.encryption import encryption_service
-            
-            # Read encryption key
-            async with aiofiles.open(content_path + '.key', 'r') as f:
-                encrypted_key = await f.read()
-            
-            block_key = encryption_service.decrypt_key(encrypted_key)
+        if encrypted_key is not None:
+            block_key = _block_key_from_record(encrypted_key)
             data = encryption_service.decrypt_file(data, block_key)
         
         return data
@@ -108,32 +260,62 @@ class DeduplicationService:
         Process file for deduplication.
         Returns metadata including block hashes and dedup stats.
         """
-        blocks = []
         total_size = len(file_data)
         deduplicated_size = 0
         saved_size = 0
         
-        # Split file into blocks
-        for i in range(0, total_size, self.block_size):
-            block = file_data[i:i + self.block_size]
-            
-            # Store block and check if it's a duplicate
-            block_hash, block_size, is_duplicate = await self.store_block(block)
-            
-            blocks.append({
-                'hash': block_hash,
-                'size': block_size,
-                'offset': i,
-                'is_duplicate': is_duplicate
-            })
-            
-            if is_duplicate:
-                saved_size += block_size
+        # File-level hash is built from the same block slices (one pass over the data)
+        file_sha = hashlib.sha256()
+        view = memoryview(file_data)
+        
+        async def hash_block(block) -> str:
+            async with self._block_slots:
+                return await self._hash(block)
+        
+        async def store_missing(block, block_hash: str, block_index: int) -> bool:
+            async with self._block_slots:
+                _, _, is_duplicate = await self.store_block(
+                    block, content_hash=block_hash, file_key=(kek, wrapped_kek, block_index)
+                )
+            return is_duplicate
+        
+        # Split file into blocks (zero-copy slices) and hash them concurrently
+        spans = list(self.iter_block_spans(file_data))
+        slices = []
+        for offset, length in spans:
+            block = view[offset:offset + length]
+            file_sha.update(block)
+            slices.append(block)
+        hashes = await asyncio.gather(*(hash_block(b) for b in slices))
+        
+        # One round-trip tells which blocks CAS already has; only the rest touch disk
+        known = await self._known_hashes(hashes)
+        missing = [i for i, present in enumerate(known) if not present]
+        # One KEK per file, wrapped once; each new block derives its key from it
+        kek = encryption_service.generate_file_key()
+        wrapped_kek = encryption_service.encrypt_key(kek) if missing else None
+        stored = await asyncio.gather(*(store_missing(slices[i], hashes[i], i) for i in missing))
+        is_duplicate = list(known)
+        for i, dup in zip(missing, stored):
+            is_duplicate[i] = dup
+        
+        blocks = [
+            {
+                'hash': hashes[i],
+                'size': length,
+                'offset': offset,
+                'is_duplicate': is_duplicate[i]
+            }
+            for i, (offset, length) in enumerate(spans)
+        ]
+        
+        for block in blocks:
+            if block['is_duplicate']:
+                saved_size += block['size']
             else:
-                deduplicated_size += block_size
+                deduplicated_size += block['size']
         
-        # Calculate file-level hash
-        file_hash = self.calculate_block_hash(file_data)
+        file_hash = file_sha.hexdigest()
         
         # Check if entire file is duplicate
         existing_file = await db.execute(
@@ -222,6 +404,7 @@ class DeduplicationService:
             db.add(block_ref)
         
         await db.commit()
+        await self._cache_block_list(str(new_file.id), dedup_result['blocks'])
         
         return {
             'file_id': str(new_file.id),
@@ -239,26 +422,56 @@ class DeduplicationService:
         """
         Reconstruct file from content-addressed blocks.
         """
-        # Get file metadata
-        result = await db.execute(
-            select(Object).where(Object.id == file_id)
-        )
-        file_obj = result.scalar_one_or_none()
+        block_rows = await self._get_block_list(file_id, db)
         
-        if not file_obj:
-            raise FileNotFoundError(f"File {file_id} not found")
+        # Reconstruct file: blocks are read and decrypted concurrently, each landing
+        # at its own offset in one preallocated buffer
+        file_data = bytearray(sum(size for _, _, size in block_rows))
+        view = memoryview(file_data)
         
-        # Get blocks info
-        blocks_info = file_obj.dedup_info.get('blocks', [])
+        async def fetch(block_hash: str, offset: int, size: int):
+            async with self._block_slots:
+                view[offset:offset + size] = await self.retrieve_block(block_hash)
         
-        # Reconstruct file from blocks
-        file_data = bytearray()
-        for block_info in sorted(blocks_info, key=lambda x: x['offset']):
-            block_data = await self.retrieve_block(block_info['hash'])
-            file_data.extend(block_data)
+        await asyncio.gather(*(fetch(*row) for row in block_rows))
+        view.release()
         
         return bytes(file_data)
     
+    async def _cache_block_list(self, file_id: str, blocks: list) -> list:
+        """Cache a file's block list as offset-ordered [hash, offset, size] rows"""
+        rows = [
+            [b['hash'], b['offset'], b['size']]
+            for b in sorted(blocks, key=lambda x: x['offset'])
+        ]
+        redis_client = await get_redis()
+        if redis_client:
+            try:
+                await redis_client.set(block_list_key(file_id), orjson.dumps(rows), ex=BLOCK_LIST_TTL)
+            except Exception as e:
+                print(f"⚠️ Block list cache write failed for {file_id}: {e}")
+        return rows
+    
+    async def _get_block_list(self, file_id: str, db: AsyncSession) -> list:
+        """Block rows from Redis; on a miss, only the dedup_info column from Postgres"""
+        redis_client = await get_redis()
+        if redis_client:
+            try:
+                cached = await redis_client.get(block_list_key(file_id))
+                if cached:
+                    return orjson.loads(cached)
+            except Exception as e:
+                print(f"⚠️ Block list cache read failed for {file_id}: {e}")
+        
+        result = await db.execute(
+            select(Object.dedup_info).where(Object.id == file_id)
+        )
+        row = result.first()
+        if row is None:
+            raise FileNotFoundError(f"File {file_id} not found")
+        
+        return await self._cache_block_list(file_id, (row.dedup_info or {}).get('blocks', []))
+    
     async def get_dedup_statistics(self, db: AsyncSession, user_id: Optional[str] = None) -> Dict:
         """
         Get deduplication statistics for user or system.
@@ -321,16 +534,24 @@ class DeduplicationService:
         
         unreferenced = result.scalars().all()
         
-        # Delete unreferenced blocks from storage
-        deleted_count = 0
-        for block_hash in unreferenced:
+        # Delete unreferenced blocks (and their key files) from storage, off the event loop
+        unlink_slots = asyncio.Semaphore(32)
+        
+        async def remove_block(block_hash: str) -> bool:
             content_path = self.get_content_address(block_hash)
-            if os.path.exists(content_path):
-                os.remove(content_path)
-                # Also remove key file if it exists
-                if os.path.exists(content_path + '.key'):
-                    os.remove(content_path + '.key')
-                deleted_count += 1
+            async with unlink_slots:
+                removed, _ = await asyncio.gather(
+                    asyncio.to_thread(_try_unlink, content_path),
+                    asyncio.to_thread(_try_unlink, content_path + '.key'),
+                )
+            return removed
+        
+        deleted_count = sum(await asyncio.gather(*(remove_block(h) for h in unreferenced)))
+        
+        if unreferenced:
+            redis_client = await get_redis()
+            if redis_client:
+                await redis_client.srem(CAS_HASHES_KEY, *unreferenced)
         
         # Remove from database
         if unreferenced:
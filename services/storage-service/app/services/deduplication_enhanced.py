@@ -2,17 +2,84 @@
 import hashlib
 import os
 import asyncio
-from typing import Optional, Dict, Tuple, List
+import time
+import uuid
+from typing import Optional, Dict, Tuple, List, AsyncIterator, Union
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, update, and_
+from sqlalchemy import select, func, insert, update, delete, and_, or_, case, cast, BigInteger
 from datetime import datetime
-import aiofiles
 from ..models.database import Object, ContentBlock, User
 from ..config import settings
-from ..services.encryption import encryption_service
+from ..services.encryption import encryption_service, NONCE_SIZE, GCM_TAG_SIZE
+from ..utils.compression import compressor
+from ..utils.hashing import chunk_hasher, PLAINTEXT_FINGERPRINT
+from ..utils.fileio import ensure_dir
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import json
 import xxhash  # For faster non-cryptographic hashing
 from collections import defaultdict
+from array import array
+
+try:
+    # FastCDC (gear hash, Cython-accelerated when built with it): content-defined boundaries
+    from fastcdc import fastcdc
+    CDC_AVAILABLE = True
+except ImportError:
+    CDC_AVAILABLE = False
+
+CONVERGENT_SALT = b'dedup_convergent_encryption_salt'
+CONVERGENT_KDF_INFO = b'cas-block-key'
+
+# Blocks are shared by address across files, so each stored block describes its own
+# format: BLOCK_MAGIC, format version, flags, then the payload. Blocks without the
+# magic predate it (PBKDF2 key, nonce + tag + ciphertext, never compressed).
+BLOCK_MAGIC = b'CB'
+BLOCK_FORMAT_VERSION = 1  # key = HKDF-SHA256(block address); nonce + ciphertext + tag
+BLOCK_FLAG_ZSTD = 0x01
+BLOCK_FLAG_ENCRYPTED = 0x02
+BLOCK_HEADER_SIZE = len(BLOCK_MAGIC) + 2
+LEGACY_KDF_ITERATIONS = 100000
+MIN_COMPRESSION_GAIN = 64  # store raw unless zstd saves more than this
+CAS_ORPHAN_GRACE = 24 * 3600  # unreferenced CAS blocks older than this are garbage collected
+
+class BlockTable:
+    """
+    A file's block list as parallel columns instead of one dict per block:
+    a handful of arrays however many blocks the file has, and a chunk_info
+    'blocks' entry about half the JSON size.
+    """
+    __slots__ = ('hashes', 'sizes', 'offsets', 'dup_mask')
+    
+    def __init__(self):
+        self.hashes: List[str] = []
+        self.sizes = array('q')
+        self.offsets = array('q')
+        self.dup_mask = bytearray()
+    
+    def append(self, block_hash: str, size: int, offset: int, is_duplicate: bool):
+        self.hashes.append(block_hash)
+        self.sizes.append(size)
+        self.offsets.append(offset)
+        self.dup_mask.append(is_duplicate)
+    
+    def __len__(self) -> int:
+        return len(self.hashes)
+    
+    def new_blocks(self):
+        """(hash, size, offset) of every block that was not a duplicate"""
+        for i, dup in enumerate(self.dup_mask):
+            if not dup:
+                yield self.hashes[i], self.sizes[i], self.offsets[i]
+    
+    def to_json(self) -> Dict:
+        return {
+            'hashes': self.hashes,
+            'sizes': self.sizes.tolist(),
+            'offsets': self.offsets.tolist(),
+            'dup_mask': list(self.dup_mask)
+        }
 
 class EnhancedDeduplicationService:
     """
@@ -22,7 +89,6 @@ class EnhancedDeduplicationService:
     - Variable block size with content-defined chunking
     - Pre-encryption deduplication for better ratios
     - Global deduplication across users (optional)
-    - Bloom filter for quick duplicate detection
     - Async batch processing
     """
     
@@ -32,79 +98,338 @@ class EnhancedDeduplicationService:
         self.max_block_size = 8 * 1024 * 1024   # 8MB max
         self.cas_path = getattr(settings, 'CAS_PATH', '/app/storage/cas')
         self.enable_cross_user_dedup = getattr(settings, 'CROSS_USER_DEDUP', False)
+        # Bounds concurrent CAS block writes per file
+        self.write_concurrency = 16
         
         # Rabin fingerprinting parameters for CDC
         self.window_size = 48
         self.prime = 3
         self.modulus = (1 << 13) - 1  # For average 4MB chunks
-        
-        # Bloom filter for quick duplicate detection (optional)
-        self._init_bloom_filter()
-        
-    def _init_bloom_filter(self):
-        """Initialize bloom filter for quick duplicate detection"""
-        try:
-            from pybloom_live import BloomFilter
-            self.bloom_filter = BloomFilter(capacity=1000000, error_rate=0.001)
-            self.bloom_enabled = True
-        except ImportError:
-            self.bloom_filter = None
-            self.bloom_enabled = False
+        # Weight of the byte leaving the window, computed once instead of per byte
+        self._out_factor = pow(self.prime, self.window_size, 2**32)
     
     def calculate_block_hash(self, data: bytes) -> str:
-        """Calculate SHA-256 hash of data block"""
+        """
+        Content address of a block: BLAKE3 when installed, else SHA-256 (64 hex
+        chars either way). CAS paths are one namespace for all users and an
+        existing address is reused, so the hash must be collision resistant
+        whether or not cross-user dedup is on.
+        """
+        hasher = chunk_hasher()
+        hasher.update(data)
+        return hasher.hexdigest()
+    
+    def calculate_file_hash(self, data: bytes) -> str:
+        """File-level SHA-256 (Object.content_hash, matched against upload fingerprints)"""
         return hashlib.sha256(data).hexdigest()
     
-    def calculate_weak_hash(self, data: bytes) -> str:
-        """Calculate fast weak hash for initial duplicate detection"""
-        return xxhash.xxh64(data).hexdigest()
+    def calculate_weak_hash(self, data: bytes) -> int:
+        """Fast weak hash for initial duplicate detection (XXH3-64 as an int, no hex str)"""
+        return xxhash.xxh3_64_intdigest(data)
     
     def find_chunk_boundaries(self, data: bytes) -> List[int]:
         """
         Content-defined chunking using rolling hash.
         Returns list of chunk boundary positions.
         """
+        return list(self.iter_chunk_boundaries(data))
+    
+    def iter_chunk_boundaries(self, data: bytes):
+        """
+        Chunk boundary positions, yielded as they are found.
+        Uses FastCDC when installed; the Rabin loop below is the pure-Python fallback.
+        """
         if len(data) < self.min_block_size:
-            return [len(data)]
+            yield len(data)
+            return
+        
+        if CDC_AVAILABLE:
+            for chunk in fastcdc(
+                data, min_size=self.min_block_size, avg_size=self.avg_block_size,
+                max_size=self.max_block_size, fat=False,
+            ):
+                yield chunk.offset + chunk.length
+            return
         
-        boundaries = []
+        last = 0
         hash_val = 0
+        # Locals, not attributes, in the per-byte loop (LOAD_FAST vs LOAD_ATTR)
+        out_factor = self._out_factor
+        window = self.window_size
+        prime = self.prime
+        modulus = self.modulus
+        min_size = self.min_block_size
+        max_size = self.max_block_size
+        mask32 = 0xFFFFFFFF
         
         for i in range(len(data)):
             # Rolling hash calculation
-            if i >= self.window_size:
-                hash_val = (hash_val * self.prime + data[i] - 
-                           data[i - self.window_size] * (self.prime ** self.window_size)) % (2**32)
+            if i >= window:
+                hash_val = (hash_val * prime + data[i] - data[i - window] * out_factor) & mask32
             else:
-                hash_val = (hash_val * self.prime + data[i]) % (2**32)
+                hash_val = (hash_val * prime + data[i]) & mask32
             
-            # Check for boundary
-            if i >= self.min_block_size:
-                if (hash_val & self.modulus) == self.modulus:
-                    boundaries.append(i + 1)
-                elif i - (boundaries[-1] if boundaries else 0) >= self.max_block_size:
-                    boundaries.append(i + 1)
+            # Check for boundary (sizes relative to the last cut, so a pass restarted
+            # at a boundary cuts where the whole-buffer pass does)
+            if i + 1 - last >= min_size:
+                if (hash_val & modulus) == modulus or i - last >= max_size:
+                    last = i + 1
+                    yield last
         
         # Add final boundary
-        if not boundaries or boundaries[-1] != len(data):
-            boundaries.append(len(data))
+        if last != len(data):
+            yield len(data)
+    
+    def _iter_chunks(self, file_data: Union[bytes, bytearray, memoryview], file_hasher):
+        """
+        One pass over file_data: each block is cut, fed to the file-level hasher
+        and fingerprinted while it is still cache-warm. Yields (offset, block, block_hash).
+        """
+        # Zero-copy block views: hashlib, xxhash, AESGCM and file writes all take buffers
+        view = memoryview(file_data)
+        start = 0
+        for boundary in self.iter_chunk_boundaries(file_data):
+            block = view[start:boundary]
+            if file_hasher is not None:
+                file_hasher.update(block)
+            yield start, block, self.calculate_block_hash(block)
+            start = boundary
+    
+    async def _find_full_duplicate(self, file_hash: str, user_id: str, db: AsyncSession):
+        """Oldest Object with this content hash (own files only unless cross-user dedup)"""
+        query = select(Object).where(
+            Object.content_hash == file_hash,
+            Object.user_id == user_id if not self.enable_cross_user_dedup else True
+        ).order_by(Object.created_at.asc()).limit(1)
+        result = await db.execute(query)
+        return result.scalars().first()
+    
+    async def _find_existing_block(self, block_hash: str, user_id: str, db: AsyncSession):
+        """Oldest ContentBlock with this hash (own blocks only unless cross-user dedup)"""
+        query = select(ContentBlock).where(ContentBlock.block_hash == block_hash)
+        if not self.enable_cross_user_dedup:
+            # Limit to user's own blocks
+            query = query.join(Object).where(Object.user_id == user_id)
+        
+        # Order by created_at to get the oldest block first
+        query = query.order_by(ContentBlock.created_at.asc())
+        
+        result = await db.execute(query)
+        return result.scalars().first()  # Use .first() instead of .scalar_one_or_none()
+    
+    async def _find_existing_blocks(self, block_hashes: List[str], user_id: str, db: AsyncSession) -> Dict[str, object]:
+        """Batched _find_existing_block: hash -> id of the oldest ContentBlock, in one query"""
+        if not block_hashes:
+            return {}
+        query = select(ContentBlock.id, ContentBlock.block_hash).where(
+            ContentBlock.block_hash.in_(set(block_hashes))
+        )
+        if not self.enable_cross_user_dedup:
+            # Limit to user's own blocks
+            query = query.join(Object).where(Object.user_id == user_id)
+        query = query.order_by(ContentBlock.created_at.asc())
         
-        return boundaries
+        existing = {}
+        for block_id, block_hash in (await db.execute(query)).all():
+            existing.setdefault(block_hash, block_id)
+        return existing
     
+    async def _bump_references(self, ref_bumps: Dict, db: AsyncSession):
+        """All reference count increments (ContentBlock.id -> n) in one UPDATE"""
+        if not ref_bumps:
+            return
+        await db.execute(
+            update(ContentBlock)
+            .where(ContentBlock.id.in_(list(ref_bumps)))
+            .values(reference_count=ContentBlock.reference_count + case(
+                dict(ref_bumps), value=ContentBlock.id, else_=0
+            ))
+        )
+    
+    async def _insert_new_blocks(self, new_file: Object, blocks: BlockTable, new_refs: Dict, db: AsyncSession):
+        """ContentBlock rows for a file's new blocks as one multi-row INSERT"""
+        # Flush the Object first: its id is a Python-side default assigned on flush
+        await db.flush()
+        rows = [
+            {
+                'block_hash': block_hash,
+                'file_id': new_file.id,
+                'block_size': size,
+                'block_offset': offset,
+                'reference_count': new_refs[block_hash]
+            }
+            for block_hash, size, offset in blocks.new_blocks()
+        ]
+        if rows:
+            await db.execute(insert(ContentBlock), rows)
+    
+    def _classify_block(self, block_hash: str, size: int, offset: int, existing_id,
+                        blocks: BlockTable, new_refs: Dict, ref_bumps: Dict, duplicate_blocks: List) -> bool:
+        """
+        Append one block to the file's BlockTable and count the reference it adds:
+        to a stored block (ref_bumps), to an earlier new block of this file, or to
+        itself as a new block (new_refs). Returns whether it was a duplicate.
+        """
+        is_duplicate = existing_id is not None or block_hash in new_refs
+        if is_duplicate:
+            # Duplicate found (of a stored block, or of an earlier block in this file)
+            duplicate_blocks.append({
+                'hash': block_hash,
+                'size': size,
+                'offset': offset,
+                'existing_block_id': str(existing_id) if existing_id is not None else None
+            })
+            if existing_id is not None:
+                ref_bumps[existing_id] += 1
+            else:
+                new_refs[block_hash] += 1
+        else:
+            new_refs[block_hash] = 1
+        blocks.append(block_hash, size, offset, is_duplicate)
+        return is_duplicate
+    
+    async def _write_cas_block(self, block_hash: str, block_data: bytes, encrypt: bool) -> Tuple[str, bool]:
+        """Write a block to its content address unless present. Returns (path, created)."""
+        # Compression, AES-GCM and the write all run off the event loop
+        return await asyncio.to_thread(self._write_cas_block_sync, block_hash, block_data, encrypt)
+    
+    def _write_cas_block_sync(self, block_hash: str, block_data: Union[bytes, memoryview], encrypt: bool) -> Tuple[str, bool]:
+        content_path = self.get_content_address(block_hash)
+        
+        # Compress before encrypting; ciphertext doesn't compress. The key and
+        # nonce still come from the plaintext, so identical blocks converge.
+        compressed = compressor.compress(block_data)
+        if len(compressed) < len(block_data) - MIN_COMPRESSION_GAIN:
+            flags, payload = BLOCK_FLAG_ZSTD, compressed
+        else:
+            flags, payload = 0, block_data
+        if encrypt:
+            flags |= BLOCK_FLAG_ENCRYPTED
+        header = BLOCK_MAGIC + bytes((BLOCK_FORMAT_VERSION, flags))
+        
+        if encrypt:
+            # Same nonce + ciphertext + tag layout as encryption_service.encrypt_file
+            block_to_store = (header, *self._encrypt_block(payload, block_hash))
+        else:
+            block_to_store = (header, payload)
+        
+        # Write a temp file in the shard, then publish it with os.link: readers only
+        # see complete blocks, and EEXIST means another upload already stored it
+        shard_dir = ensure_dir(os.path.dirname(content_path))
+        tmp_path = os.path.join(shard_dir, f".{block_hash}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.writelines(block_to_store)
+            while True:
+                try:
+                    os.link(tmp_path, content_path)
+                    break
+                except FileExistsError:
+                    pass
+                try:
+                    # Refresh mtime: garbage_collect's orphan sweep skips recently used blocks
+                    os.utime(content_path)
+                except FileNotFoundError:
+                    continue  # collected in between; publish ours after all
+                print(f"♻️ Block {block_hash[:8]}... already exists, reusing")
+                return content_path, False
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        
+        if encrypt:
+            print(f"📦 Storing new block {block_hash[:8]}... "
+                  f"({len(block_data)/1024:.1f}KB -> {len(payload)/1024:.1f}KB)")
+        return content_path, True
+    
+    def _encrypt_block(self, payload, block_hash: str) -> Tuple[bytes, bytes]:
+        """
+        Convergent encryption of one block: key and nonce (BLAKE2b, 12 bytes) both
+        from the block's content address. Returns (nonce, ciphertext || tag).
+        """
+        block_key = self.derive_block_key(block_hash)
+        nonce = hashlib.blake2b(block_hash.encode(), digest_size=12).digest()
+        # AESGCM is the one-shot EVP path (AES-NI + CLMUL); one key schedule per block
+        return nonce, AESGCM(block_key).encrypt(nonce, payload, None)
+    
+    def decode_cas_block(self, block_hash: str, stored: bytes, legacy_encrypted: bool) -> bytes:
+        """
+        Plaintext of a stored CAS block, in whichever format that block was written.
+        legacy_encrypted (the owning file's convergent_encryption flag) is only
+        consulted for blocks written before the per-block header existed.
+        """
+        if (len(stored) >= BLOCK_HEADER_SIZE and stored[:len(BLOCK_MAGIC)] == BLOCK_MAGIC
+                and stored[len(BLOCK_MAGIC)] == BLOCK_FORMAT_VERSION):
+            flags = stored[len(BLOCK_MAGIC) + 1]
+            payload = memoryview(stored)[BLOCK_HEADER_SIZE:]
+            if flags & BLOCK_FLAG_ENCRYPTED:
+                payload = AESGCM(self.derive_block_key(block_hash)).decrypt(
+                    payload[:NONCE_SIZE], payload[NONCE_SIZE:], None
+                )
+            if flags & BLOCK_FLAG_ZSTD:
+                return compressor.decompress(payload)
+            return bytes(payload)
+        
+        if not legacy_encrypted:
+            return stored
+        # Legacy: PBKDF2 over the SHA-256 address, nonce + tag + ciphertext
+        key = hashlib.pbkdf2_hmac(
+            'sha256', bytes.fromhex(block_hash), CONVERGENT_SALT, LEGACY_KDF_ITERATIONS, dklen=32
+        )
+        nonce = stored[:NONCE_SIZE]
+        tag = stored[NONCE_SIZE:NONCE_SIZE + GCM_TAG_SIZE]
+        return AESGCM(key).decrypt(nonce, stored[NONCE_SIZE + GCM_TAG_SIZE:] + tag, None)
+    
+    def ensure_shard_dirs(self):
+        """Create the 00..ff CAS shard dirs (startup), so block writes never need makedirs"""
+        for i in range(256):
+            ensure_dir(os.path.join(self.cas_path, f"{i:02x}"))
+    
+    async def iter_cdc_blocks(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Content-defined blocks over a stream of pieces, with the same boundaries as
+        a whole-buffer pass. A cut is only final once max_block_size bytes follow
+        the block's start (near the end of a buffer FastCDC cuts short), so blocks
+        starting closer to the end are carried into the next piece. Small pieces
+        are gathered to 2 * max_block_size before cutting, so each scan emits at
+        least max_block_size bytes; memory stays at one piece plus that.
+        """
+        pending = bytearray()
+        async for piece in chunks:
+            pending += piece
+            if len(pending) < 2 * self.max_block_size:
+                continue
+            start = 0
+            for boundary in self.iter_chunk_boundaries(pending):
+                if start + self.max_block_size > len(pending):
+                    break
+                yield bytes(pending[start:boundary])
+                start = boundary
+            del pending[:start]
+        start = 0
+        if pending:
+            for boundary in self.iter_chunk_boundaries(pending):
+                yield bytes(pending[start:boundary])
+                start = boundary
     
     async def deduplicate_before_encryption(
         self,
-        file_data: bytes,
+        file_data: Union[bytes, bytearray, memoryview],
         file_name: str,
         user_id: str,
-        db: AsyncSession
+        db: AsyncSession,
+        file_hash: Optional[str] = None
     ) -> Dict:
         """
         Perform deduplication before encryption for better dedup ratios.
         This finds duplicate blocks across all users if enabled.
+        Pass file_hash when the caller already has it to skip the file-level hasher.
         """
-        blocks = []
-        boundaries = self.find_chunk_boundaries(file_data)
+        blocks = BlockTable()
+        # File-level SHA-256 fed from the same block slices: one pass over file_data
+        file_hasher = hashlib.sha256() if file_hash is None else None
         
         total_size = len(file_data)
         deduplicated_size = 0
@@ -112,70 +437,34 @@ class EnhancedDeduplicationService:
         new_blocks = []
         duplicate_blocks = []
         
-        start = 0
-        for boundary in boundaries:
-            block = file_data[start:boundary]
-            block_hash = self.calculate_block_hash(block)
-            
-            # Quick check with bloom filter
-            is_potential_duplicate = False
-            if self.bloom_enabled and block_hash in self.bloom_filter:
-                is_potential_duplicate = True
-            
-            # Database check for existing block - FIXED to handle multiple results
-            query = select(ContentBlock).where(ContentBlock.block_hash == block_hash)
-            if not self.enable_cross_user_dedup:
-                # Limit to user's own blocks
-                query = query.join(Object).where(Object.user_id == user_id)
-            
-            # Order by created_at to get the oldest block first
-            query = query.order_by(ContentBlock.created_at.asc())
-            
-            result = await db.execute(query)
-            existing_block = result.scalars().first()  # Use .first() instead of .scalar_one_or_none()
-            
-            if existing_block:
-                # Duplicate found
-                duplicate_blocks.append({
-                    'hash': block_hash,
-                    'size': len(block),
-                    'offset': start,
-                    'existing_block_id': str(existing_block.id)
-                })
+        # Chunk and hash every block in one pass, then look them all up in one round-trip
+        spans = list(self._iter_chunks(file_data, file_hasher))
+        
+        existing = await self._find_existing_blocks([h for _, _, h in spans], user_id, db)
+        ref_bumps = defaultdict(int)  # ContentBlock.id -> references added by this file
+        new_refs = defaultdict(int)  # hash of a block new to CAS -> occurrences in this file
+        
+        for offset, block, block_hash in spans:
+            if self._classify_block(block_hash, len(block), offset, existing.get(block_hash),
+                                    blocks, new_refs, ref_bumps, duplicate_blocks):
                 saved_size += len(block)
-                
-                # Increment reference count
-                await db.execute(
-                    update(ContentBlock)
-                    .where(ContentBlock.id == existing_block.id)
-                    .values(reference_count=ContentBlock.reference_count + 1)
-                )
             else:
                 # New unique block
                 new_blocks.append({
                     'hash': block_hash,
                     'size': len(block),
-                    'offset': start,
+                    'offset': offset,
                     'data': block  # Keep for storage
                 })
                 deduplicated_size += len(block)
-                
-                # Add to bloom filter
-                if self.bloom_enabled:
-                    self.bloom_filter.add(block_hash)
-            
-            blocks.append({
-                'hash': block_hash,
-                'size': len(block),
-                'offset': start,
-                'is_duplicate': existing_block is not None
-            })
-            
-            start = boundary
+        
+        await self._bump_references(ref_bumps, db)
         
         return {
+            'file_hash': file_hash or file_hasher.hexdigest(),
             'blocks': blocks,
             'new_blocks': new_blocks,
+            'new_refs': new_refs,
             'duplicate_blocks': duplicate_blocks,
             'total_size': total_size,
             'deduplicated_size': deduplicated_size,
@@ -185,21 +474,25 @@ class EnhancedDeduplicationService:
         }
     
 
-    def derive_key_from_content(self, data: bytes) -> bytes:
+    def derive_block_key(self, block_hash: str) -> bytes:
         """
-        Derive encryption key from content hash (convergent encryption).
-        This ensures identical data always gets encrypted the same way.
+        Derive a block's encryption key from its content address (convergent
+        encryption): identical data always gets encrypted the same way, and a
+        reader holding the address from chunk_info can derive the key again.
         """
-        # Use PBKDF2 to derive a key from the content hash
-        content_hash = hashlib.sha256(data).digest()
+        # HKDF, not PBKDF2: the input is a full-entropy collision-resistant digest, and
+        # convergent encryption already reveals equal plaintexts, so a work factor adds nothing
         # Use a fixed salt for convergent encryption (not random!)
-        salt = b'dedup_convergent_encryption_salt'
-        key = hashlib.pbkdf2_hmac('sha256', content_hash, salt, 100000, dklen=32)
-        return key
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=CONVERGENT_SALT,
+            info=CONVERGENT_KDF_INFO
+        ).derive(bytes.fromhex(block_hash))
 
     async def store_deduplicated_file(
         self,
-        file_data: bytes,
+        file_data: Union[bytes, bytearray, memoryview],
         file_name: str,
         user_id: str,
         db: AsyncSession,
@@ -207,139 +500,157 @@ class EnhancedDeduplicationService:
         encrypt: bool = True
     ) -> Dict:
         """
-        Enhanced file storage with pre-encryption deduplication.
+        Enhanced file storage with pre-encryption deduplication, for data already
+        in memory. Block storage is store_deduplicated_stream over the one buffer.
         """
+        # Full-file duplicate check first: a re-upload of an identical file then
+        # costs one hash pass and one indexed lookup, with no chunking or block
+        # lookups. hashlib releases the GIL, so hash off the event loop.
         try:
-            # Perform deduplication analysis
-            dedup_result = await self.deduplicate_before_encryption(
-                file_data, file_name, user_id, db
-            )
+            file_hash = await asyncio.to_thread(self.calculate_file_hash, file_data)
+            existing_file = await self._find_full_duplicate(file_hash, user_id, db)
+            if existing_file:
+                print(f"🎯 Full duplicate found! File hash: {file_hash[:16]}...")
+                return await self._store_reference(
+                    existing_file, file_name, user_id, file_hash, len(file_data), db, metadata
+                )
+        except Exception as e:
+            await db.rollback()
+            raise Exception(f"Deduplication failed: {str(e)}")
+        
+        async def whole():
+            yield file_data
+        
+        return await self.store_deduplicated_stream(whole(), file_name, user_id, db, metadata, encrypt)
+    
+    async def store_deduplicated_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        file_name: str,
+        user_id: str,
+        db: AsyncSession,
+        metadata: Optional[Dict] = None,
+        encrypt: bool = True,
+        fingerprint: Optional[str] = None
+    ) -> Dict:
+        """
+        Deduplicated storage over an async stream of plaintext pieces.
+        Blocks are hashed, looked up and written to CAS as they complete and the
+        file hash is updated incrementally. New blocks are written by background
+        tasks (at most write_concurrency in flight) while chunking continues, so
+        memory stays bounded to the in-flight blocks rather than the whole file.
+        """
+        write_tasks = []  # every write task, so a failed write is never dropped unseen
+        write_slots = asyncio.Semaphore(self.write_concurrency)
+        try:
+            file_hasher = hashlib.sha256()
+            blocks = BlockTable()
+            stored_blocks = []
+            duplicate_blocks = []
+            total_size = 0
+            saved_size = 0
+            new_count = 0
             
-            # Calculate file-level hash
-            file_hash = self.calculate_block_hash(file_data)
+            async def hashed(source):
+                async for piece in source:
+                    file_hasher.update(piece)
+                    yield piece
             
-            # Check for full-file duplicate
-            query = select(Object).where(
-                Object.content_hash == file_hash,
-                Object.user_id == user_id if not self.enable_cross_user_dedup else True
-            ).order_by(Object.created_at.asc())
+            async def write_block(block_hash, block, offset):
+                try:
+                    content_path, _ = await self._write_cas_block(block_hash, block, encrypt)
+                    stored_blocks.append({
+                        'hash': block_hash,
+                        'path': content_path,
+                        'size': len(block),
+                        'offset': offset
+                    })
+                finally:
+                    write_slots.release()
+            
+            # Per-file lookup cache: a repeated hash hits the DB once, and its
+            # reference bumps are summed into one UPDATE after the loop
+            known_ids = {}  # hash -> ContentBlock.id of an already-stored block
+            ref_bumps = defaultdict(int)
+            new_refs = defaultdict(int)
+            
+            async for block in self.iter_cdc_blocks(hashed(chunks)):
+                block_hash = self.calculate_block_hash(block)
+                offset = total_size
+                total_size += len(block)
+                
+                if block_hash in new_refs:
+                    existing_id = None
+                elif block_hash in known_ids:
+                    existing_id = known_ids[block_hash]
+                else:
+                    existing_block = await self._find_existing_block(block_hash, user_id, db)
+                    existing_id = existing_block.id if existing_block else None
+                    if existing_id is not None:
+                        known_ids[block_hash] = existing_id
+                
+                if self._classify_block(block_hash, len(block), offset, existing_id,
+                                        blocks, new_refs, ref_bumps, duplicate_blocks):
+                    saved_size += len(block)
+                else:
+                    # Backpressure: wait for a free slot before reading further
+                    await write_slots.acquire()
+                    task = asyncio.create_task(write_block(block_hash, block, offset))
+                    write_tasks.append(task)
+                    new_count += 1
+            
+            # Raises the first failed write before anything is committed
+            await asyncio.gather(*write_tasks)
+            stored_blocks.sort(key=lambda b: b['offset'])
+            
+            if total_size == 0:
+                return {'status': 'empty', 'saved_size': 0, 'dedup_ratio': 0}
             
-            result = await db.execute(query)
-            existing_file = result.scalars().first()
+            file_hash = file_hasher.hexdigest()
+            dedup_ratio = (saved_size / total_size * 100) if total_size > 0 else 0
+            
+            # Check for full-file duplicate
+            existing_file = await self._find_full_duplicate(file_hash, user_id, db)
             
             if existing_file:
-                # Full file duplicate found
+                # Full file duplicate found. Blocks written above stay: CAS addresses are
+                # shared, so a concurrent upload may already reference them. Any left
+                # unreferenced are removed by garbage_collect.
                 print(f"🎯 Full duplicate found! File hash: {file_hash[:16]}...")
-                
-                new_file = Object(
-                    file_name=file_name,
-                    user_id=user_id,
-                    content_hash=file_hash,
-                    file_size=dedup_result['total_size'],
-                    storage_type='deduplicated_reference',
-                    dedup_info={
-                        'reference_file_id': str(existing_file.id),
-                        'is_full_duplicate': True,
-                        'saved_size': dedup_result['total_size']
-                    },
-                    mime_type=metadata.get('mime_type') if metadata else None,
-                    folder_id=metadata.get('folder_id') if metadata else None,
-                    # Reference the same encryption key
-                    encryption_key=existing_file.encryption_key
+                return await self._store_reference(
+                    existing_file, file_name, user_id, file_hash, total_size, db, metadata
                 )
-                db.add(new_file)
-                await db.commit()
-                
-                return {
-                    'file_id': str(new_file.id),
-                    'status': 'full_duplicate',
-                    'saved_size': dedup_result['total_size'],
-                    'dedup_ratio': 100.0,
-                    'duplicate_blocks': []
-                }
             
-            # Store new unique blocks
-            stored_blocks = []
+            # Only now that this file will reference them
+            await self._bump_references(ref_bumps, db)
             
-            # For convergent encryption, use a master key for the file metadata
-            # but derive block keys from content
             if encrypt:
                 # Generate a master key for file metadata (user-specific)
                 master_key = encryption_service.generate_file_key()
                 encrypted_master_key = encryption_service.encrypt_key(master_key)
             else:
-                master_key = None
                 encrypted_master_key = None
             
-            for new_block in dedup_result['new_blocks']:
-                block_data = new_block['data']
-                
-                # Check if this block already exists in CAS
-                content_path = self.get_content_address(new_block['hash'])
-                
-                if not os.path.exists(content_path):
-                    # Block doesn't exist, store it
-                    if encrypt:
-                        # Use convergent encryption - derive key from content
-                        block_key = self.derive_key_from_content(block_data)
-                        
-                        # Encrypt using AES-GCM with the derived key
-                        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-                        from cryptography.hazmat.backends import default_backend
-                        import os as crypto_os
-                        
-                        # Generate a deterministic nonce from block hash
-                        nonce = hashlib.sha256(f"{new_block['hash']}_nonce".encode()).digest()[:12]
-                        
-                        cipher = Cipher(
-                            algorithms.AES(block_key),
-                            modes.GCM(nonce),
-                            backend=default_backend()
-                        )
-                        encryptor = cipher.encryptor()
-                        encrypted_data = encryptor.update(block_data) + encryptor.finalize()
-                        
-                        # Store encrypted block with tag
-                        block_to_store = nonce + encryptor.tag + encrypted_data
-                        
-                        print(f"📦 Storing new block {new_block['hash'][:8]}... ({len(block_data)/1024:.1f}KB)")
-                    else:
-                        block_to_store = block_data
-                    
-                    # Create directory if needed
-                    os.makedirs(os.path.dirname(content_path), exist_ok=True)
-                    
-                    # Store block
-                    async with aiofiles.open(content_path, 'wb') as f:
-                        await f.write(block_to_store)
-                else:
-                    print(f"♻️ Block {new_block['hash'][:8]}... already exists, reusing")
-                
-                stored_blocks.append({
-                    'hash': new_block['hash'],
-                    'path': content_path,
-                    'size': new_block['size'],
-                    'offset': new_block['offset']
-                })
-            
-            # Create file object with dedup info
             new_file = Object(
                 file_name=file_name,
                 user_id=user_id,
                 content_hash=file_hash,
-                file_size=dedup_result['total_size'],
+                file_size=total_size,
                 storage_type='content_addressed',
                 chunk_info={
-                    'blocks': dedup_result['blocks'],
+                    'blocks': blocks.to_json(),
                     'stored_blocks': stored_blocks,
-                    'version': 2,
+                    'version': 3,  # 'blocks' is column-oriented (BlockTable)
+                    # Block format (KDF, layout, codec) is recorded per block in its header
                     'convergent_encryption': encrypt  # Mark as using convergent encryption
                 },
                 dedup_info={
-                    'saved_size': dedup_result['saved_size'],
-                    'dedup_ratio': dedup_result['dedup_ratio'],
-                    'unique_blocks': len(dedup_result['new_blocks']),
-                    'duplicate_blocks': len(dedup_result['duplicate_blocks'])
+                    'saved_size': saved_size,
+                    'dedup_ratio': dedup_ratio,
+                    'unique_blocks': new_count,
+                    'duplicate_blocks': len(duplicate_blocks),
+                    # Upload-time fingerprint, for register_precomputed lookups
+                    'upload_fingerprint': fingerprint
                 },
                 mime_type=metadata.get('mime_type') if metadata else None,
                 folder_id=metadata.get('folder_id') if metadata else None,
@@ -348,34 +659,108 @@ class EnhancedDeduplicationService:
             db.add(new_file)
             
             # Create ContentBlock entries for new blocks only
-            for block in dedup_result['blocks']:
-                if not block['is_duplicate']:
-                    content_block = ContentBlock(
-                        block_hash=block['hash'],
-                        file_id=new_file.id,
-                        block_size=block['size'],
-                        block_offset=block['offset'],
-                        reference_count=1
-                    )
-                    db.add(content_block)
+            await self._insert_new_blocks(new_file, blocks, new_refs, db)
             
             await db.commit()
             
-            print(f"✅ File stored with deduplication:")
-            print(f"   - Unique blocks: {len(dedup_result['new_blocks'])}")
-            print(f"   - Duplicate blocks: {len(dedup_result['duplicate_blocks'])}")
-            print(f"   - Saved: {dedup_result['saved_size']/1024/1024:.1f}MB ({dedup_result['dedup_ratio']:.1f}%)")
+            print(f"✅ File stored with deduplication (streamed):")
+            print(f"   - Unique blocks: {new_count}")
+            print(f"   - Duplicate blocks: {len(duplicate_blocks)}")
+            print(f"   - Saved: {saved_size/1024/1024:.1f}MB ({dedup_ratio:.1f}%)")
             
             return {
                 'file_id': str(new_file.id),
                 'status': 'stored_with_dedup',
-                'saved_size': dedup_result['saved_size'],
-                'dedup_ratio': dedup_result['dedup_ratio'],
-                'unique_blocks': len(dedup_result['new_blocks']),
-                'total_blocks': len(dedup_result['blocks']),
-                'duplicate_blocks': dedup_result['duplicate_blocks']
+                'saved_size': saved_size,
+                'dedup_ratio': dedup_ratio,
+                'unique_blocks': new_count,
+                'total_blocks': len(blocks),
+                'duplicate_blocks': duplicate_blocks
             }
             
+        except Exception as e:
+            for task in write_tasks:
+                task.cancel()
+            await asyncio.gather(*write_tasks, return_exceptions=True)
+            await db.rollback()
+            raise Exception(f"Deduplication failed: {str(e)}")
+    
+    async def _store_reference(
+        self,
+        existing_file: Object,
+        file_name: str,
+        user_id: str,
+        content_hash: str,
+        total_size: int,
+        db: AsyncSession,
+        metadata: Optional[Dict] = None
+    ) -> Dict:
+        """Create a deduplicated_reference Object pointing at existing_file"""
+        new_file = Object(
+            file_name=file_name,
+            user_id=user_id,
+            content_hash=content_hash,
+            file_size=total_size,
+            storage_type='deduplicated_reference',
+            dedup_info={
+                'reference_file_id': str(existing_file.id),
+                'is_full_duplicate': True,
+                'saved_size': total_size
+            },
+            mime_type=metadata.get('mime_type') if metadata else None,
+            folder_id=metadata.get('folder_id') if metadata else None,
+            # Reference the same encryption key
+            encryption_key=existing_file.encryption_key
+        )
+        db.add(new_file)
+        await db.commit()
+        
+        return {
+            'file_id': str(new_file.id),
+            'status': 'full_duplicate',
+            'saved_size': total_size,
+            'dedup_ratio': 100.0,
+            'duplicate_blocks': []
+        }
+    
+    async def register_precomputed(
+        self,
+        fingerprint: str,
+        file_name: str,
+        user_id: str,
+        total_size: int,
+        db: AsyncSession,
+        metadata: Optional[Dict] = None
+    ) -> Optional[Dict]:
+        """
+        Full-duplicate check from the fingerprint computed while the upload was
+        being encrypted - no stored bytes are read back or decrypted.
+        Returns None when there is no duplicate and the content must be
+        streamed through store_deduplicated_stream.
+        """
+        if not fingerprint:
+            return None
+        try:
+            # Fingerprints are tagged with their kind (utils.hashing.tagged_fingerprint)
+            kind, _, digest = fingerprint.partition(":")
+            match = Object.dedup_info['upload_fingerprint'].as_string() == fingerprint
+            if kind == PLAINTEXT_FINGERPRINT:
+                # content_hash is the plaintext SHA-256 except on chunked uploads (combined_hash)
+                match = or_(match, and_(Object.content_hash == digest, Object.storage_type != 'chunked'))
+            query = select(Object).where(
+                match,
+                Object.file_size == total_size,
+                Object.user_id == user_id if not self.enable_cross_user_dedup else True
+            ).order_by(Object.created_at.asc())
+            
+            existing_file = (await db.execute(query)).scalars().first()
+            if existing_file is None:
+                return None
+            
+            print(f"🎯 Full duplicate found from upload fingerprint {fingerprint[:16]}...")
+            return await self._store_reference(
+                existing_file, file_name, user_id, existing_file.content_hash, total_size, db, metadata
+            )
         except Exception as e:
             await db.rollback()
             raise Exception(f"Deduplication failed: {str(e)}")
@@ -389,42 +774,29 @@ class EnhancedDeduplicationService:
         """
         Get detailed deduplication analytics.
         """
-        # Base query
+        # File and block aggregates in one round-trip (two one-row subqueries)
+        dedup_types = ['content_addressed', 'deduplicated_reference']
+        saved = func.coalesce(cast(Object.dedup_info['saved_size'].as_string(), BigInteger), 0)
+        files = select(
+            func.count(Object.id).label('total_files'),
+            func.coalesce(func.sum(Object.file_size), 0).label('logical_size'),
+            func.coalesce(func.sum(saved), 0).label('saved_size')
+        ).where(Object.storage_type.in_(dedup_types))
         if user_id:
             # User-specific analytics
-            objects_query = select(Object).where(
-                Object.user_id == user_id,
-                Object.storage_type.in_(['content_addressed', 'deduplicated_reference'])
-            )
-            blocks_query = select(ContentBlock).join(Object).where(Object.user_id == user_id)
-        else:
-            # System-wide analytics
-            objects_query = select(Object).where(
-                Object.storage_type.in_(['content_addressed', 'deduplicated_reference'])
-            )
-            blocks_query = select(ContentBlock)
-        
-        # Get file statistics
-        files_result = await db.execute(objects_query)
-        files = files_result.scalars().all()
-        
-        total_files = len(files)
-        total_logical_size = sum(f.file_size for f in files)
-        total_saved = sum(
-            f.dedup_info.get('saved_size', 0) 
-            for f in files 
-            if f.dedup_info
-        )
+            files = files.where(Object.user_id == user_id)
+        files = files.subquery()
         
-        # Get block statistics - FIXED query
-        blocks_result = await db.execute(
-            select(
-                func.count(ContentBlock.id).label('total_blocks'),
-                func.sum(ContentBlock.block_size).label('total_block_size'),
-                func.avg(ContentBlock.reference_count).label('avg_references')
-            )
-        )
-        block_stats = blocks_result.first()
+        blocks = select(
+            func.count(ContentBlock.id).label('total_blocks'),
+            func.sum(ContentBlock.block_size).label('total_block_size'),
+            func.avg(ContentBlock.reference_count).label('avg_references')
+        ).subquery()
+        
+        stats = (await db.execute(select(files, blocks))).mappings().one()
+        total_files = stats['total_files']
+        total_logical_size = int(stats['logical_size'])
+        total_saved = int(stats['saved_size'])
         
         # Calculate metrics
         physical_size = total_logical_size - total_saved
@@ -453,9 +825,9 @@ class EnhancedDeduplicationService:
                 'compression_ratio': round(total_logical_size / physical_size, 2) if physical_size > 0 else 1
             },
             'blocks': {
-                'total_blocks': block_stats.total_blocks or 0,
-                'total_size': block_stats.total_block_size or 0,
-                'avg_references': float(block_stats.avg_references or 0)
+                'total_blocks': stats['total_blocks'] or 0,
+                'total_size': stats['total_block_size'] or 0,
+                'avg_references': float(stats['avg_references'] or 0)
             },
             'top_duplicates': [
                 {
@@ -470,63 +842,116 @@ class EnhancedDeduplicationService:
     async def garbage_collect(self, db: AsyncSession) -> Dict:
         """
         Enhanced garbage collection with safety checks.
+        A CAS file is only removed when every ContentBlock row for its hash is
+        unreferenced; zero-reference rows of hashes still live elsewhere are
+        dropped without touching the file.
         """
-        # Find blocks with zero references
-        unreferenced = await db.execute(
-            select(ContentBlock)
-            .where(ContentBlock.reference_count <= 0)
+        # Hashes with no live reference anywhere (block_hash is indexed)
+        result = await db.execute(
+            select(ContentBlock.block_hash)
+            .group_by(ContentBlock.block_hash)
+            .having(func.max(ContentBlock.reference_count) <= 0)
         )
-        unreferenced_blocks = unreferenced.scalars().all()
+        dead_hashes = result.scalars().all()
         
-        deleted_count = 0
-        freed_space = 0
         errors = []
+        unlink_slots = asyncio.Semaphore(32)
         
-        for block in unreferenced_blocks:
+        async def remove_block(block_hash: str, cutoff: Optional[float] = None) -> int:
             try:
-                # Double-check no files reference this block
-                file_refs = await db.execute(
-                    select(func.count(Object.id))
-                    .where(
-                        Object.chunk_info['blocks'].contains(
-                            [{'hash': block.block_hash}]
-                        )
+                async with unlink_slots:
+                    return await asyncio.to_thread(
+                        self._remove_cas_block, self.get_content_address(block_hash), cutoff
                     )
-                )
-                ref_count = file_refs.scalar()
-                
-                if ref_count == 0:
-                    # Safe to delete
-                    content_path = self.get_content_address(block.block_hash)
-                    if os.path.exists(content_path):
-                        file_size = os.path.getsize(content_path)
-                        os.remove(content_path)
-                        freed_space += file_size
-                        
-                        # Remove key file if exists
-                        if os.path.exists(content_path + '.key'):
-                            os.remove(content_path + '.key')
-                    
-                    await db.delete(block)
-                    deleted_count += 1
-                else:
-                    # Fix reference count
-                    block.reference_count = ref_count
-                    
-            except Exception as e:
+            except OSError as e:
                 errors.append({
-                    'block_hash': block.block_hash,
+                    'block_hash': block_hash,
                     'error': str(e)
                 })
+                return 0
+        
+        freed_space = sum(await asyncio.gather(*(remove_block(h) for h in dead_hashes)))
+        
+        # Blocks on disk with no ContentBlock row at all (written by a store that then
+        # failed or turned out to be a full duplicate). Only ones older than the grace
+        # period, so blocks of uploads still in progress are left alone.
+        cutoff = time.time() - CAS_ORPHAN_GRACE
+        candidates, stale_temp_space = await asyncio.to_thread(self._scan_cas, cutoff)
+        freed_space += stale_temp_space
+        orphans = []
+        for i in range(0, len(candidates), 1000):
+            batch = candidates[i:i + 1000]
+            result = await db.execute(
+                select(ContentBlock.block_hash).where(ContentBlock.block_hash.in_(batch)).distinct()
+            )
+            referenced = set(result.scalars().all())
+            orphans.extend(h for h in batch if h not in referenced)
+        freed_space += sum(await asyncio.gather(*(remove_block(h, cutoff) for h in orphans)))
         
+        # Keep the rows of blocks whose file could not be removed, so the next run retries
+        failed = [e['block_hash'] for e in errors]
+        stmt = delete(ContentBlock).where(ContentBlock.reference_count <= 0)
+        if failed:
+            stmt = stmt.where(ContentBlock.block_hash.notin_(failed))
+        await db.execute(stmt)
         await db.commit()
         
         return {
-            'deleted_blocks': deleted_count,
+            'deleted_blocks': len(dead_hashes) + len(orphans) - len(failed),
+            'orphan_blocks': len(orphans),
             'freed_space': freed_space,
             'errors': errors
         }
     
+    def _scan_cas(self, cutoff: float) -> Tuple[List[str], int]:
+        """
+        Hashes of CAS blocks last modified before cutoff (one scandir per shard).
+        Temp files left by writers that died before publishing are removed on
+        the way; returns (hashes, bytes freed).
+        """
+        hashes = []
+        freed = 0
+        try:
+            shards = [e.path for e in os.scandir(self.cas_path) if e.is_dir()]
+        except FileNotFoundError:
+            return hashes, freed
+        for shard in shards:
+            for entry in os.scandir(shard):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if st.st_mtime >= cutoff:
+                    continue
+                # Block files are named by their 64-hex address; skip .key sidecars etc.
+                if len(entry.name) == 64:
+                    hashes.append(entry.name)
+                elif entry.name.startswith('.') and entry.name.endswith(('.tmp', '.tmp.key')):
+                    try:
+                        os.remove(entry.path)
+                        freed += st.st_size
+                    except FileNotFoundError:
+                        pass
+        return hashes, freed
+    
+    @staticmethod
+    def _remove_cas_block(content_path: str, cutoff: Optional[float] = None) -> int:
+        """Remove a CAS block (and legacy .key sidecar); returns bytes freed.
+        With cutoff, keep it if it was written or reused (mtime refreshed) since."""
+        try:
+            st = os.stat(content_path)
+            if cutoff is not None and st.st_mtime >= cutoff:
+                return 0
+            freed = st.st_size
+            os.remove(content_path)
+        except FileNotFoundError:
+            freed = 0
+        try:
+            os.remove(content_path + '.key')
+        except FileNotFoundError:
+            pass
+        return freed
+    
     def get_content_address(self, content_hash: str) -> str:  
         """Get storage path for content hash.
         Uses first 2 chars for sharding: /cas/ab/abcdef123456...
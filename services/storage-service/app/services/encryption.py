@@ -3,8 +3,11 @@
 import os
 import base64
 import hashlib
-from typing import Union
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Union, Tuple
 
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from ..config import settings
 
@@ -27,6 +30,69 @@ def _get_master_key() -> bytes:
 
 MASTER_KEY = _get_master_key()
 NONCE_SIZE = 12  # recommended nonce size for AES-GCM
+GCM_TAG_SIZE = 16
+FUSED_TILE_SIZE = 64 * 1024  # fits in L2 so hash + encrypt share one read
+
+_MASTER_AESGCM = AESGCM(MASTER_KEY)
+
+def cipher_backend() -> str:
+    """OpenSSL build behind `cryptography` and whether the CPU has AES-NI (logged at startup).
+    All AES-GCM here goes through OpenSSL EVP, which uses AES-NI/CLMUL when present."""
+    from cryptography.hazmat.backends.openssl.backend import backend
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next((line.split() for line in f if line.startswith("flags")), [])
+        aesni = "AES-NI" if "aes" in flags else "no AES-NI"
+    except OSError:
+        aesni = "AES-NI unknown"
+    return f"AES-256-GCM via {backend.openssl_version_text()} ({aesni})"
+
+@lru_cache(maxsize=1024)
+def _unwrap_key(wrapped_b64: str) -> bytes:
+    """Unwrap a stored file key once; repeat lookups (per chunk, per download) hit the cache."""
+    wrapped = base64.b64decode(wrapped_b64)
+    return _MASTER_AESGCM.decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], None)
+
+def _normalize_key(file_key: Union[bytes, str]) -> bytes:
+    """Accept raw 32 bytes, or a str/bytes base64 encoding of them"""
+    if isinstance(file_key, str):
+        file_key = file_key.encode()
+    if len(file_key) != 32:
+        try:
+            file_key = base64.b64decode(file_key)
+        except Exception:
+            pass
+    return file_key
+
+@dataclass(frozen=True, slots=True)
+class FileKey:
+    """
+    A file key normalised once at the API boundary, with its AESGCM context
+    (key schedule) built once. encrypt_*/decrypt_* take it without any
+    per-call type checks or base64 probing.
+    """
+    raw: bytes
+    aead: AESGCM
+
+    @classmethod
+    def from_any(cls, file_key: Union["FileKey", bytes, str]) -> "FileKey":
+        if isinstance(file_key, FileKey):
+            return file_key
+        raw = _normalize_key(file_key)
+        return cls(raw, AESGCM(raw))
+
+KeyLike = Union[FileKey, bytes, str]
+
+def _raw_key(file_key: KeyLike) -> bytes:
+    return file_key.raw if isinstance(file_key, FileKey) else _normalize_key(file_key)
+
+def _aead(file_key: Union[KeyLike, AESGCM]) -> AESGCM:
+    if isinstance(file_key, FileKey):
+        return file_key.aead
+    if isinstance(file_key, AESGCM):
+        return file_key
+    # Compatibility path for callers still passing str/bytes: one key schedule per call
+    return AESGCM(_normalize_key(file_key))
 
 class EncryptionService:
     """
@@ -36,17 +102,24 @@ class EncryptionService:
       - generate_file_key() -> bytes (32 bytes)
       - encrypt_key(file_key: bytes) -> str (base64)
       - decrypt_key(wrapped_b64: str) -> bytes (raw file key)
-      - encrypt_file(data: bytes, file_key: bytes) -> bytes (nonce + ciphertext)
-      - decrypt_file(enc: bytes, file_key: bytes) -> bytes
-      - encrypt_chunk(chunk_data: bytes, file_key: bytes, chunk_index: int) -> bytes
-      - decrypt_chunk(enc_chunk: bytes, file_key: bytes, chunk_index: int) -> bytes
+      - encrypt_file(data: bytes, file_key: FileKey) -> bytes (nonce + ciphertext)
+      - file_encryptor(file_key) -> (nonce, encryptor) for streaming encrypt_file output
+      - file_decryptor(file_key, nonce, tag) -> decryptor for streaming decrypt_file input
+      - decrypt_file(enc: bytes, file_key: FileKey) -> bytes
+      - encrypt_chunk(chunk_data: bytes, file_key: FileKey | AESGCM, chunk_index: int) -> bytes
+      - decrypt_chunk(enc_chunk: bytes, file_key: FileKey, chunk_index: int) -> bytes
+      - encrypt_and_hash_chunk(chunk_data, file_key, chunk_index, hasher=None) -> (bytes, hex digest)
 
     Backwards-compatibility:
       - encrypt_data / decrypt_data are aliases for encrypt_file / decrypt_file
+      - file_key may still be raw/base64 bytes or str; FileKey.from_any does that
+        normalisation once, so hot loops should pass a FileKey
     """
 
     def __init__(self):
         self._master = MASTER_KEY
+        # One AESGCM (key schedule) for the master key, shared with _unwrap_key
+        self._master_aead = _MASTER_AESGCM
 
     # ---- Key material ----
     def generate_file_key(self) -> bytes:
@@ -58,80 +131,89 @@ class EncryptionService:
         if isinstance(file_key, str):
             file_key = file_key.encode()
         nonce = os.urandom(NONCE_SIZE)
-        ct = AESGCM(self._master).encrypt(nonce, file_key, None)
+        ct = self._master_aead.encrypt(nonce, file_key, None)
         wrapped = nonce + ct
         return base64.b64encode(wrapped).decode()
 
     def decrypt_key(self, wrapped_b64: str) -> bytes:
         """Unwrap a base64(wrapped) file key and return raw file key bytes."""
-        wrapped = base64.b64decode(wrapped_b64)
-        nonce = wrapped[:NONCE_SIZE]
-        ct = wrapped[NONCE_SIZE:]
-        return AESGCM(self._master).decrypt(nonce, ct, None)
+        return _unwrap_key(wrapped_b64)
 
     # ---- Whole-file encryption ----
-    def encrypt_file(self, data: bytes, file_key: Union[bytes, str]) -> bytes:
+    def encrypt_file(self, data: bytes, file_key: KeyLike) -> bytes:
         """Encrypt whole-file bytes. Returns nonce + ciphertext bytes."""
-        if isinstance(file_key, str):
-            file_key = file_key.encode()
-        if len(file_key) != 32:
-            try:
-                file_key = base64.b64decode(file_key)
-            except Exception:
-                pass
         nonce = os.urandom(NONCE_SIZE)
-        ct = AESGCM(file_key).encrypt(nonce, data, None)
+        ct = _aead(file_key).encrypt(nonce, data, None)
         return nonce + ct
 
-    def decrypt_file(self, enc: bytes, file_key: Union[bytes, str]) -> bytes:
+    def file_encryptor(self, file_key: KeyLike):
+        """Streaming counterpart of encrypt_file: returns (nonce, encryptor).
+        Writing nonce, every update() output, then finalize() + encryptor.tag
+        produces the same layout encrypt_file does."""
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce, Cipher(algorithms.AES(_raw_key(file_key)), modes.GCM(nonce)).encryptor()
+
+    def file_decryptor(self, file_key: KeyLike, nonce: bytes, tag: bytes):
+        """Streaming counterpart of decrypt_file. Feed the ciphertext between the
+        nonce and the trailing tag through update(); finalize() verifies the tag."""
+        return Cipher(algorithms.AES(_raw_key(file_key)), modes.GCM(nonce, tag)).decryptor()
+
+    def decrypt_file(self, enc: bytes, file_key: KeyLike) -> bytes:
         """Decrypt bytes produced by encrypt_file (nonce + ciphertext)."""
-        if isinstance(file_key, str):
-            file_key = file_key.encode()
-        if len(file_key) != 32:
-            try:
-                file_key = base64.b64decode(file_key)
-            except Exception:
-                pass
-        nonce = enc[:NONCE_SIZE]
-        ct = enc[NONCE_SIZE:]
-        return AESGCM(file_key).decrypt(nonce, ct, None)
+        # memoryview slices: the ciphertext is not copied before decrypting
+        view = memoryview(enc)
+        return _aead(file_key).decrypt(view[:NONCE_SIZE], view[NONCE_SIZE:], None)
 
     # ---- Chunk-level encryption (uses AAD) ----
-    def encrypt_chunk(self, chunk_data: bytes, file_key: Union[bytes, str], chunk_index: int) -> bytes:
-        """Encrypt a chunk and bind its chunk_index as AAD. Returned: nonce + ciphertext."""
-        if isinstance(file_key, str):
-            file_key = file_key.encode()
-        if len(file_key) != 32:
-            try:
-                file_key = base64.b64decode(file_key)
-            except Exception:
-                pass
+    def encrypt_chunk(self, chunk_data: bytes, file_key: Union[KeyLike, AESGCM], chunk_index: int) -> bytes:
+        """Encrypt a chunk and bind its chunk_index as AAD. Returned: nonce + ciphertext.
+
+        Accepts a FileKey or prepared AESGCM instance so per-upload callers can reuse it.
+        """
         aad = str(chunk_index).encode()
         nonce = os.urandom(NONCE_SIZE)
-        ct = AESGCM(file_key).encrypt(nonce, chunk_data, aad)
-        return nonce + ct
-
-    def decrypt_chunk(self, encrypted_chunk: bytes, file_key: Union[bytes, str], chunk_index: int) -> bytes:
+        return nonce + _aead(file_key).encrypt(nonce, chunk_data, aad)
+
+    def encrypt_and_hash_chunk(self, chunk_data: bytes, file_key: KeyLike, chunk_index: int, hasher=None) -> Tuple[bytes, str]:
+        """
+        encrypt_chunk + hash of the plaintext in one pass over 64KB tiles, so
+        each tile is hashed and encrypted while it is still in cache.
+        hasher is any hashlib-style object (default SHA-256).
+        Output format is identical to encrypt_chunk (nonce + ciphertext + tag).
+        """
+        n = len(chunk_data)
+        nonce = os.urandom(NONCE_SIZE)
+        encryptor = Cipher(algorithms.AES(_raw_key(file_key)), modes.GCM(nonce)).encryptor()
+        encryptor.authenticate_additional_data(str(chunk_index).encode())
+        digest = hasher if hasher is not None else hashlib.sha256()
+
+        # update_into needs block_size - 1 bytes of slack past the data
+        out = bytearray(NONCE_SIZE + n + GCM_TAG_SIZE + 15)
+        out[:NONCE_SIZE] = nonce
+        out_view = memoryview(out)
+        src = memoryview(chunk_data)
+        pos = NONCE_SIZE
+        for i in range(0, n, FUSED_TILE_SIZE):
+            tile = src[i:i + FUSED_TILE_SIZE]
+            digest.update(tile)
+            pos += encryptor.update_into(tile, out_view[pos:])
+        encryptor.finalize()
+        out_view[pos:pos + GCM_TAG_SIZE] = encryptor.tag
+        return bytes(out_view[:pos + GCM_TAG_SIZE]), digest.hexdigest()
+
+    def decrypt_chunk(self, encrypted_chunk: bytes, file_key: KeyLike, chunk_index: int) -> bytes:
         """Decrypt a chunk encrypted with encrypt_chunk. Verifies chunk_index via AAD."""
-        if isinstance(file_key, str):
-            file_key = file_key.encode()
-        if len(file_key) != 32:
-            try:
-                file_key = base64.b64decode(file_key)
-            except Exception:
-                pass
         aad = str(chunk_index).encode()
-        nonce = encrypted_chunk[:NONCE_SIZE]
-        ct = encrypted_chunk[NONCE_SIZE:]
-        return AESGCM(file_key).decrypt(nonce, ct, aad)
+        view = memoryview(encrypted_chunk)
+        return _aead(file_key).decrypt(view[:NONCE_SIZE], view[NONCE_SIZE:], aad)
 
     # ---- Backwards-compatible aliases ----
     # Some older code expects `encrypt_data` / `decrypt_data` names (e.g. storage.retrieve_file).
-    def encrypt_data(self, data: bytes, file_key: Union[bytes, str]) -> bytes:
+    def encrypt_data(self, data: bytes, file_key: KeyLike) -> bytes:
         """Alias for encrypt_file (keeps older API)."""
         return self.encrypt_file(data, file_key)
 
-    def decrypt_data(self, encrypted_data: bytes, file_key: Union[bytes, str]) -> bytes:
+    def decrypt_data(self, encrypted_data: bytes, file_key: KeyLike) -> bytes:
         """Alias for decrypt_file (keeps older API)."""
         return self.decrypt_file(encrypted_data, file_key)
 
@@ -0,0 +1,52 @@
+# services/storage-service/app/services/redis_batcher.py
+"""Coalesce Redis script calls from concurrent requests into one pipeline"""
+import asyncio
+from ..database import get_redis
+
+class RedisBatcher:
+    """
+    Calls queued within one window are sent as a single non-transactional
+    pipeline; each caller still awaits its own result (or exception).
+    The flush is scheduled by the first call in a window, so an idle
+    service runs no timer.
+    """
+
+    def __init__(self, window: float = 0.01):
+        self.window = window
+        self._pending = []
+        self._flush_task = None
+
+    async def run_script(self, script, keys, args):
+        """Queue a registered script call and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((script, keys, args, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+        return await future
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        batch, self._pending = self._pending, []
+        self._flush_task = None
+
+        try:
+            redis_client = await get_redis()
+            pipe = redis_client.pipeline(transaction=False)
+            for script, keys, args, _ in batch:
+                await script(keys=keys, args=args, client=pipe)
+            results = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (*_, future), result in zip(batch, results):
+            if future.done():  # caller was cancelled
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+redis_batcher = RedisBatcher()
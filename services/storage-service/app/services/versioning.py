@@ -1,23 +1,39 @@
 # services/storage-service/app/services/versioning.py
 
-from typing import Optional, List
+from datetime import datetime
+from typing import AsyncIterator, Optional, List
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from ..models.database import Object, FileVersion
 from ..services.storage import storage_service
 import json
 
+def version_insert(archive: dict, new_version: dict):
+    """
+    Two-row INSERT ... ON CONFLICT DO NOTHING RETURNING for _insert_versions.
+    A multi-VALUES insert needs the same columns in every row, so the new row
+    gets an explicit created_at (the archive keeps the file's own).
+    """
+    new_version = {"created_at": datetime.utcnow(), **new_version}
+    return (
+        pg_insert(FileVersion)
+        .values([archive, new_version])
+        .on_conflict_do_nothing(constraint='unique_file_version')
+        .returning(FileVersion)
+    )
+
 class VersioningService:
     
     async def create_version(
         self,
         db: AsyncSession,
         file_id: str,
-        new_content: bytes,
+        new_content: AsyncIterator[bytes],
         user_id: str,
         comment: Optional[str] = None
     ) -> FileVersion:
-        """Create a new version of a file"""
+        """Create a new version of a file from a stream of content chunks"""
         
         # Get current file
         result = await db.execute(
@@ -31,75 +47,90 @@ class VersioningService:
         if not current_file.versioning_enabled:
             raise ValueError(f"Versioning disabled for file {file_id}")
         
-        # Save current version as history before updating
-        await self._archive_current_version(db, current_file)
+        # History row for the current version; inserted together with the new one
+        archive = self._archive_row(current_file)
         
-        # Process new content
-        content_hash = hashlib.sha256(new_content).hexdigest()
+        # Buffer only up to the inline threshold; anything larger is streamed to storage
+        head = bytearray()
+        chunks = new_content.__aiter__()
+        async for chunk in chunks:
+            head += chunk
+            if len(head) >= 1048576:  # 1MB - inline
+                break
         
         # Store new version data
-        if len(new_content) < 1048576:  # 1MB - inline
+        if len(head) < 1048576:
             storage_info = await storage_service.store_inline(
-                new_content,
+                bytes(head),
                 {"user_id": str(user_id)},
                 current_file.encryption_key
             )
         else:
-            storage_info = await storage_service.store_single(
-                new_content,
+            async def rest():
+                yield bytes(head)
+                async for chunk in chunks:
+                    yield chunk
+            
+            storage_info = await storage_service.store_single_stream(
+                rest(),
                 {"user_id": str(user_id)},
                 current_file.encryption_key
             )
+        content_hash = storage_info["hash"]
+        file_size = storage_info["size"]
         
         # Create version record
         new_version_number = current_file.current_version + 1
-        version = FileVersion(
-            file_id=file_id,
+        version = await self._insert_versions(db, archive, dict(
+            file_id=current_file.id,
             version_number=new_version_number,
-            file_size=len(new_content),
+            file_size=file_size,
             content_hash=content_hash,
             storage_path=storage_info.get('path') or storage_info.get('storage_key'),
             chunk_info=storage_info,
             created_by=user_id,
             comment=comment
-        )
+        ))
         
         # Update main file record
         current_file.current_version = new_version_number
         current_file.version_count = new_version_number
-        current_file.file_size = len(new_content)
+        current_file.file_size = file_size
         current_file.content_hash = content_hash
         current_file.last_accessed = datetime.utcnow()
         
-        db.add(version)
         await db.commit()
         
         return version
     
-    async def _archive_current_version(self, db: AsyncSession, file_obj: Object):
-        """Archive the current version before creating new one"""
-        
-        # Check if current version already archived
-        existing = await db.execute(
-            select(FileVersion).filter(
-                FileVersion.file_id == file_obj.id,
-                FileVersion.version_number == file_obj.current_version
-            )
+    def _archive_row(self, file_obj: Object) -> dict:
+        """FileVersion row archiving the current version before a new one is created"""
+        return dict(
+            file_id=file_obj.id,
+            version_number=file_obj.current_version,
+            file_size=file_obj.file_size,
+            content_hash=file_obj.content_hash,
+            storage_path=file_obj.object_path or file_obj.storage_key,
+            chunk_info=file_obj.chunk_info,
+            created_by=file_obj.user_id,
+            created_at=file_obj.created_at,
+            comment=None
+        )
+    
+    async def _insert_versions(self, db: AsyncSession, archive: dict, new_version: dict) -> FileVersion:
+        """
+        Archive row + new version row in one INSERT. ON CONFLICT DO NOTHING on
+        (file_id, version_number) skips an already-archived current version,
+        replacing the separate existence SELECT. Returns the new FileVersion.
+        """
+        inserted = (await db.scalars(version_insert(archive, new_version))).all()
+        for version in inserted:
+            if version.version_number == new_version["version_number"]:
+                return version
+        # The new row itself hit the constraint: a concurrent update took this number
+        raise ValueError(
+            f"Version {new_version['version_number']} of file {new_version['file_id']} already exists"
         )
-        
-        if not existing.scalar_one_or_none():
-            # Create archive entry for current version
-            archive = FileVersion(
-                file_id=file_obj.id,
-                version_number=file_obj.current_version,
-                file_size=file_obj.file_size,
-                content_hash=file_obj.content_hash,
-                storage_path=file_obj.object_path or file_obj.storage_key,
-                chunk_info=file_obj.chunk_info,
-                created_by=file_obj.user_id,
-                created_at=file_obj.created_at
-            )
-            db.add(archive)
     
     async def get_version(
         self,
@@ -155,15 +186,12 @@ class VersioningService:
         )
         current_file = result.scalar_one_or_none()
         
-        # Archive current version
-        await self._archive_current_version(db, current_file)
-        
         # Restore the selected version
         new_version_number = current_file.current_version + 1
         
-        # Create new version entry (restore is a new version)
-        restored_version = FileVersion(
-            file_id=file_id,
+        # Archive current version + new version entry (restore is a new version)
+        await self._insert_versions(db, self._archive_row(current_file), dict(
+            file_id=current_file.id,
             version_number=new_version_number,
             file_size=version.file_size,
             content_hash=version.content_hash,
@@ -171,7 +199,7 @@ class VersioningService:
             chunk_info=version.chunk_info,
             created_by=user_id,
             comment=f"Restored from version {version_number}"
-        )
+        ))
         
         # Update main file
         current_file.current_version = new_version_number
@@ -179,7 +207,6 @@ class VersioningService:
         current_file.file_size = version.file_size
         current_file.content_hash = version.content_hash
         
-        db.add(restored_version)
         await db.commit()
         
         return current_file
@@ -1,30 +1,32 @@
 from aiocache import Cache
 from aiocache.serializers import JsonSerializer
 from functools import wraps
-import hashlib
-import json
-import uuid
-import datetime
+from typing import Optional
+import logging
+import pickle
+import orjson
+import xxhash
+from sqlalchemy.ext.asyncio import AsyncSession
 import decimal
+from ..database import get_redis
+
+logger = logging.getLogger(__name__)
 
 def _custom_default(obj):
-    """Convert unsupported types to JSON-safe values"""
-    if isinstance(obj, uuid.UUID):
-        return str(obj)
-    if isinstance(obj, (datetime.datetime, datetime.date)):
-        return obj.isoformat()
+    """Convert types orjson doesn't handle natively (it already does UUID/datetime/date)"""
     if isinstance(obj, decimal.Decimal):
         return float(obj)
-    # Let json raise TypeError for anything else
+    # Let orjson raise TypeError for anything else
     raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
 def _custom_dumps(value):
-    return json.dumps(value, default=_custom_default)
+    # NON_STR_KEYS: int/UUID dict keys become strings, as json.dumps did
+    return orjson.dumps(value, default=_custom_default, option=orjson.OPT_NON_STR_KEYS)
 
 def _custom_loads(value):
     if value is None:   # ✅ handle cache misses
         return None
-    return json.loads(value)
+    return orjson.loads(value)
 
 # Custom JSON serializer with safe None handling
 class CustomJsonSerializer(JsonSerializer):
@@ -39,10 +41,22 @@ class CustomJsonSerializer(JsonSerializer):
 # Global cache client
 cache = Cache(Cache.REDIS, endpoint="redis", port=6379, serializer=CustomJsonSerializer())
 
-def cache_key(*args, **kwargs):
-    """Generate cache key from function + args"""
-    key = hashlib.md5(f"{args}{kwargs}".encode()).hexdigest()
-    return f"cache:{key}"
+def _keyable(value):
+    # Injected DB sessions don't identify the result (and their repr embeds an address)
+    return not isinstance(value, AsyncSession)
+
+def cache_key(func_name, args=(), kwargs=None):
+    """Generate cache key from function + args: XXH3-128 over the pickled call"""
+    call = (
+        func_name,
+        tuple(a for a in args if _keyable(a)),
+        {k: v for k, v in (kwargs or {}).items() if _keyable(v)},
+    )
+    try:
+        blob = pickle.dumps(call, protocol=5)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        blob = repr(call).encode()
+    return f"cache:{xxhash.xxh3_128_hexdigest(blob)}"
 
 def cached(expire=60):
     """Decorator for caching async function results"""
@@ -62,7 +76,53 @@ def cached(expire=60):
                 await cache.set(key, result, ttl=expire)
             except TypeError as e:
                 # Log but don’t fail if serialization breaks
-                print(f"[Cache Warning] Could not cache result for {func.__name__}: {e}")
+                logger.warning("Could not cache result for %s: %s", func.__name__, e)
             return result
         return wrapper
     return decorator
+
+# File listing page cache (raw JSON blobs keyed per user/folder/page)
+FILE_LIST_TTL = 30
+
+def file_list_key(user_id, folder_id: Optional[str], offset: int, limit: Optional[int]) -> str:
+    return f"list:{user_id}:{folder_id or 'root'}:{offset}:{limit or 'all'}"
+
+async def invalidate_file_list(user_id):
+    """Drop every cached file listing page for a user"""
+    redis_client = await get_redis()
+    if not redis_client:
+        return
+    keys = [key async for key in redis_client.scan_iter(match=f"list:{user_id}:*", count=500)]
+    if keys:
+        await redis_client.delete(*keys)
+
+# Per-user /storage/stats aggregate cache
+STORAGE_STATS_TTL = 60
+
+def storage_stats_key(user_id) -> str:
+    return f"stats:{user_id}"
+
+async def invalidate_storage_stats(user_id):
+    """Drop the cached storage stats for a user"""
+    redis_client = await get_redis()
+    if redis_client:
+        await redis_client.delete(storage_stats_key(user_id))
+
+# Per-object download metadata (row subset keyed by file id)
+OBJECT_META_TTL = 300
+
+def object_meta_key(file_id) -> str:
+    return f"obj:{file_id}"
+
+def block_list_key(file_id) -> str:
+    """Cached CAS block list of a content-addressed file (services.deduplication)"""
+    return f"dedup:blocks:{file_id}"
+
+async def invalidate_object_meta(*file_ids):
+    """Drop cached download metadata and block lists for deleted/changed objects"""
+    redis_client = await get_redis()
+    if redis_client and file_ids:
+        await redis_client.delete(
+            *[object_meta_key(file_id) for file_id in file_ids],
+            *[block_list_key(file_id) for file_id in file_ids],
+        )
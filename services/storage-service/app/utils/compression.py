@@ -1,8 +1,138 @@
 # services/storage-service/app/utils/compression.py
 
+import asyncio
+import queue
+import threading
+from contextlib import contextmanager
 import zstandard as zstd
 from ..config import settings
 
+CODEC = "zstd"
+
+def _load_dict():
+    """Trained dictionary for small repetitive payloads (logs, JSON), if configured"""
+    if not settings.ZSTD_DICT_PATH:
+        return None
+    with open(settings.ZSTD_DICT_PATH, 'rb') as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+COMPRESSION_DICT = _load_dict()
+
+# Long-window (LDM) contexts allocate ~window-sized buffers each; at most this many exist
+LARGE_CCTX_POOL_SIZE = 2
+
+def _new_large_cctx():
+    return zstd.ZstdCompressor(
+        compression_params=zstd.ZstdCompressionParameters.from_level(
+            settings.COMPRESSION_LEVEL,
+            window_log=settings.COMPRESSION_LONG_WINDOW_LOG,
+            enable_ldm=True,
+            write_checksum=True,
+        ),
+        dict_data=COMPRESSION_DICT,
+    )
+
+class _ThreadLocalCodec:
+    """
+    ZstdCompressor/ZstdDecompressor contexts are not thread-safe, and chunks are
+    compressed on the upload thread pool, so each thread gets its own context.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._large_pool: queue.LifoQueue = queue.LifoQueue()
+        self._large_lock = threading.Lock()
+        self._large_created = 0
+
+    def _cctx(self):
+        cctx = getattr(self._local, "cctx", None)
+        if cctx is None:
+            # threads=-1 lets zstd split one large buffer across all cores
+            cctx = zstd.ZstdCompressor(
+                level=settings.COMPRESSION_LEVEL,
+                threads=settings.COMPRESSION_THREADS,
+                dict_data=COMPRESSION_DICT,
+            )
+            self._local.cctx = cctx
+        return cctx
+
+    @contextmanager
+    def _large_cctx(self):
+        """Borrow a single-object compressor: long-distance matching over a 128MB
+        window finds repeats far apart in big files; frames carry a checksum. The
+        window stays within zstd's default decoder limit, so _dctx reads it.
+        Each context holds ~window-sized buffers, so they come from a small shared
+        pool (not one per thread) and run single-threaded rather than threads=-1."""
+        try:
+            cctx = self._large_pool.get_nowait()
+        except queue.Empty:
+            with self._large_lock:
+                create = self._large_created < LARGE_CCTX_POOL_SIZE
+                if create:
+                    self._large_created += 1
+            cctx = _new_large_cctx() if create else self._large_pool.get()
+        try:
+            yield cctx
+        finally:
+            self._large_pool.put(cctx)
+
+    def _dctx(self):
+        dctx = getattr(self._local, "dctx", None)
+        if dctx is None:
+            dctx = zstd.ZstdDecompressor(dict_data=COMPRESSION_DICT)
+            self._local.dctx = dctx
+        return dctx
+
+    def compress(self, data: bytes) -> bytes:
+        return self._cctx().compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._dctx().decompress(data)
+
+    async def compress_async(self, data: bytes) -> bytes:
+        """compress() on a worker thread (that thread's own context), off the event loop"""
+        return await asyncio.to_thread(self.compress, data)
+
+    @contextmanager
+    def _borrow(self, large: bool):
+        if large:
+            with self._large_cctx() as cctx:
+                yield cctx
+        else:
+            yield self._cctx()
+
+    @contextmanager
+    def stream_writer(self, dst, size: int = -1, large: bool = False):
+        """Compressing file-like wrapper around dst (a frame per `with` block; dst stays open)"""
+        with self._borrow(large) as cctx:
+            with cctx.stream_writer(dst, size=size, closefd=False) as writer:
+                yield writer
+
+    def compress_stream(self, src, dst, size: int = -1, large: bool = False) -> int:
+        """Compress file-like src into dst without buffering it whole.
+        Passing size records the content size so decompress() can read the frame."""
+        with self._borrow(large) as cctx:
+            _, written = cctx.copy_stream(src, dst, size=size)
+        return written
+
 # Initialize compression/decompression objects
-compressor = zstd.ZstdCompressor(level=settings.COMPRESSION_LEVEL)
-decompressor = zstd.ZstdDecompressor()
\ No newline at end of file
+compressor = _ThreadLocalCodec()
+decompressor = compressor
+
+PROBE_SIZE = 4096
+PROBE_MIN_RATIO = 0.95  # skip zstd unless the sample shrinks by more than 5%
+
+def looks_compressible(data) -> bool:
+    """Compress a 4KB head sample; JPEG/MP4/ZIP-like payloads barely shrink,
+    so compressing them whole would only burn CPU"""
+    sample = memoryview(data)[:PROBE_SIZE]
+    return len(compressor.compress(sample)) < len(sample) * PROBE_MIN_RATIO
+
+def codec_metadata(compressed: bool) -> dict:
+    """file_metadata fields describing how the stored bytes were compressed"""
+    if not compressed:
+        return {"compressed": False}
+    meta = {"compressed": True, "codec": CODEC, "level": settings.COMPRESSION_LEVEL}
+    if COMPRESSION_DICT is not None:
+        meta["dict_id"] = COMPRESSION_DICT.dict_id()
+    return meta
@@ -0,0 +1,43 @@
+# services/storage-service/app/utils/concurrency.py
+
+import asyncio
+
+
+class ServiceOverloadError(Exception):
+    """A remote target asked us to slow down (503 / 429 / SlowDown)"""
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit, like TCP congestion control: every success widens
+    the window by 1/limit (about +1 per round-trip), every overload halves it.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 64):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def submit(self, fn, *args):
+        """Run `await fn(*args)` once a slot is free, adjusting the limit on the outcome"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        try:
+            result = await fn(*args)
+        except ServiceOverloadError:
+            self._limit = max(self.min_limit, self._limit / 2)
+            raise
+        else:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            return result
+        finally:
+            async with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
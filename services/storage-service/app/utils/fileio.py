@@ -0,0 +1,24 @@
+# services/storage-service/app/utils/fileio.py
+
+import os
+
+def write_file(path: str, data: bytes):
+    """Write a buffer with raw os.write calls (no Python file object buffering);
+    run via asyncio.to_thread - one executor hop, unlike aiofiles"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+# Directories known to exist; shard paths repeat (256 per tier), so makedirs runs once each
+_ready_dirs: set = set()
+
+def ensure_dir(path: str) -> str:
+    """makedirs once per path for the life of the process; returns path"""
+    if path not in _ready_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ready_dirs.add(path)
+    return path
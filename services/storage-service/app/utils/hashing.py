@@ -0,0 +1,35 @@
+# services/storage-service/app/utils/hashing.py
+
+import hashlib
+from typing import List
+
+# BLAKE3 is several times faster than SHA-256 on CPUs without SHA-NI;
+# fall back to SHA-256 when the wheel isn't installed
+try:
+    import blake3
+    CHUNK_HASH_ALGO = "blake3"
+except ImportError:
+    blake3 = None
+    CHUNK_HASH_ALGO = "sha256"
+
+def chunk_hasher(algo: str = CHUNK_HASH_ALGO):
+    """New incremental hasher for upload chunk fingerprints"""
+    if algo == "blake3":
+        if blake3 is None:
+            raise RuntimeError("blake3 hashing requested but the blake3 package is not installed")
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.sha256()
+
+def combined_hash(chunk_hashes: List[str], algo: str = CHUNK_HASH_ALGO) -> str:
+    """File fingerprint over the ordered per-chunk hex digests (64 hex chars either way)"""
+    hasher = chunk_hasher(algo)
+    hasher.update("".join(chunk_hashes).encode())
+    return hasher.hexdigest()
+
+# Upload fingerprint kinds: plaintext SHA-256 of the whole file (single uploads),
+# or combined_hash over chunk digests ("chunks-<algo>")
+PLAINTEXT_FINGERPRINT = "sha256"
+
+def tagged_fingerprint(kind: str, digest: str) -> str:
+    """Prefix a fingerprint with its kind, so different kinds never match each other"""
+    return f"{kind}:{digest}"
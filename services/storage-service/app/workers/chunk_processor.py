@@ -4,11 +4,22 @@ from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
 import asyncio
 import aiofiles
 import os
-import json
-import hashlib
+import orjson
 from ..services.encryption import encryption_service
 from ..services.storage import storage_service
 from ..database import get_redis
+from ..utils.hashing import chunk_hasher
+
+CHUNK_BATCH_SIZE = 64  # chunks fetched per poll; one offset commit per batch
+CHUNK_HASHES_TTL = 3600  # same lifetime as the upload:{id} session
+
+def chunk_hashes_key(upload_id: str) -> str:
+    return f"upload:{upload_id}:hashes"
+
+def _hash_chunk(chunk_data: bytes) -> str:
+    hasher = chunk_hasher()
+    hasher.update(chunk_data)
+    return hasher.hexdigest()
 
 class ChunkProcessor:
     def __init__(self):
@@ -17,33 +28,59 @@ class ChunkProcessor:
             bootstrap_servers='kafka:9092',
             group_id='chunk-processors',
             auto_offset_reset='earliest',
-            enable_auto_commit=True,
-            max_poll_records=10  # Process 10 chunks at a time
+            # Offsets are committed after each batch is processed, so a crash
+            # re-delivers in-flight chunks instead of dropping them
+            enable_auto_commit=False,
+            max_poll_records=CHUNK_BATCH_SIZE
         )
+        # Chunks processed concurrently; hashing/compression run on worker threads
+        self.concurrency = os.cpu_count() or 4
         self.producer = AIOKafkaProducer(
             bootstrap_servers='kafka:9092',
-            value_serializer=lambda v: json.dumps(v).encode()
+            value_serializer=orjson.dumps
         )
     
     async def start(self):
+        print(f"🔁 Event loop: {type(asyncio.get_running_loop()).__module__}")
         await self.consumer.start()
         await self.producer.start()
         
+        slots = asyncio.Semaphore(self.concurrency)
+        
+        async def process(msg):
+            async with slots:
+                await self.process_chunk(orjson.loads(msg.value))
+        
         try:
-            async for msg in self.consumer:
-                await self.process_chunk(json.loads(msg.value))
+            while True:
+                batches = await self.consumer.getmany(timeout_ms=100, max_records=CHUNK_BATCH_SIZE)
+                messages = [msg for batch in batches.values() for msg in batch]
+                if not messages:
+                    continue
+                await asyncio.gather(*(process(msg) for msg in messages))
+                await self.consumer.commit()
         finally:
             await self.consumer.stop()
             await self.producer.stop()
     
+    async def _record_chunk_hash(self, upload_id: str, chunk_index: int, chunk_hash: str):
+        """HSET one field of upload:{id}:hashes. O(1) per chunk and no read-modify-write,
+        so concurrently processed chunks of one upload cannot clobber each other."""
+        redis_client = await get_redis()
+        hashes_key = chunk_hashes_key(upload_id)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(hashes_key, chunk_index, chunk_hash)
+            pipe.expire(hashes_key, CHUNK_HASHES_TTL)
+            await pipe.execute()
+    
     async def process_chunk(self, chunk_info):
         try:
             # Read temp chunk
             async with aiofiles.open(chunk_info['chunk_path'], 'rb') as f:
                 chunk_data = await f.read()
             
-            # Calculate hash
-            chunk_hash = hashlib.sha256(chunk_data).hexdigest()
+            # Calculate hash (BLAKE3 when installed, like the upload path)
+            chunk_hash = await asyncio.to_thread(_hash_chunk, chunk_data)
             
             # Decrypt key
             file_key = encryption_service.decrypt_key(chunk_info['encryption_key'])
@@ -52,16 +89,7 @@ class ChunkProcessor:
             await storage_service.save_chunk(chunk_data, chunk_hash, file_key)
             
             # Update Redis with chunk hash
-            redis_client = await get_redis()
-            session_key = f"upload:{chunk_info['upload_id']}"
-            session_data = await redis_client.get(session_key)
-            
-            if session_data:
-                session = json.loads(session_data)
-                if len(session["chunk_hashes"]) <= chunk_info['chunk_index']:
-                    session["chunk_hashes"].extend([None] * (chunk_info['chunk_index'] + 1 - len(session["chunk_hashes"])))
-                session["chunk_hashes"][chunk_info['chunk_index']] = chunk_hash
-                await redis_client.setex(session_key, 3600, json.dumps(session))
+            await self._record_chunk_hash(chunk_info['upload_id'], chunk_info['chunk_index'], chunk_hash)
             
             # Clean up temp file
             os.remove(chunk_info['chunk_path'])
@@ -83,5 +111,11 @@ class ChunkProcessor:
             })
 
 if __name__ == "__main__":
+    # Same loop the API runs on (uvicorn --loop uvloop); uvloop ships with uvicorn[standard]
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     processor = ChunkProcessor()
     asyncio.run(processor.start())
\ No newline at end of file
@@ -0,0 +1,90 @@
+# services/storage-service/tests/test_versioning.py
+
+import asyncio
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.services.versioning import version_insert, versioning_service
+
+
+def _rows():
+    file_obj = SimpleNamespace(
+        id=uuid.uuid4(),
+        current_version=1,
+        file_size=10,
+        content_hash="a" * 64,
+        object_path="/data/objects/aa/a.obj",
+        storage_key=None,
+        chunk_info=None,
+        user_id=uuid.uuid4(),
+        created_at=datetime(2024, 1, 1),
+    )
+    archive = versioning_service._archive_row(file_obj)
+    new_version = dict(
+        file_id=file_obj.id,
+        version_number=2,
+        file_size=20,
+        content_hash="b" * 64,
+        storage_path="/data/objects/bb/b.obj",
+        chunk_info={},
+        created_by=file_obj.user_id,
+        comment="second",
+    )
+    return archive, new_version
+
+
+def test_version_insert_renders_both_rows():
+    archive, new_version = _rows()
+    compiled = version_insert(archive, new_version).compile(dialect=postgresql.dialect())
+    params = compiled.construct_params()
+
+    sql = str(compiled)
+    assert "ON CONFLICT ON CONSTRAINT unique_file_version DO NOTHING" in sql
+    assert "RETURNING" in sql
+    # Both rows carry explicit values for every column either of them sets
+    assert params["created_at_m0"] == datetime(2024, 1, 1)
+    assert params["created_at_m1"] is not None
+    assert params["comment_m0"] is None
+    assert params["comment_m1"] == "second"
+
+
+class _Result:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+
+class _Session:
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    async def scalars(self, stmt):
+        self.statements.append(stmt)
+        return _Result(self.rows)
+
+
+def test_insert_versions_returns_new_row():
+    archive, new_version = _rows()
+    new_row = SimpleNamespace(version_number=2)
+    db = _Session([SimpleNamespace(version_number=1), new_row])
+
+    version = asyncio.run(versioning_service._insert_versions(db, archive, new_version))
+
+    assert version is new_row
+    assert len(db.statements) == 1
+
+
+def test_insert_versions_conflict_on_new_row_raises():
+    archive, new_version = _rows()
+    # Archive inserted, new version skipped by ON CONFLICT (concurrent update)
+    db = _Session([SimpleNamespace(version_number=1)])
+
+    with pytest.raises(ValueError, match="already exists"):
+        asyncio.run(versioning_service._insert_versions(db, archive, new_version))